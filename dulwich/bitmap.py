@@ -0,0 +1,453 @@
+# bitmap.py -- Reading and writing of pack bitmap indexes
+# Copyright (C) 2015 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Reading and writing of pack bitmap indexes (.bitmap files).
+
+A pack bitmap stores, for a selection of commits in a pack, the set of
+objects reachable from that commit. Bit i of a bitmap refers to the i-th
+object in the pack, ordered by offset. The bitmaps are compressed using
+EWAH, as described in git's Documentation/technical/bitmap-format.txt.
+
+Bitmaps are represented in memory as (arbitrarily large) integers, which
+makes union, intersection and difference cheap.
+"""
+
+import binascii
+from bisect import bisect_left
+import stat
+import struct
+
+from dulwich.errors import (
+    ChecksumMismatch,
+    )
+from dulwich.file import GitFile
+from dulwich.objects import (
+    Blob,
+    Commit,
+    S_ISGITLINK,
+    Tag,
+    Tree,
+    hex_to_sha,
+    sha_to_hex,
+    )
+from dulwich.pack import (
+    DeltaChainIterator,
+    SHA1Writer,
+    _bit_length,
+    _load_file_contents,
+    )
+
+BITMAP_SIGNATURE = b'BITM'
+BITMAP_VERSION = 1
+
+# Every object reachable from a bitmapped commit is in the pack
+BITMAP_OPT_FULL_DAG = 1
+# A name-hash for every object follows the bitmap entries
+BITMAP_OPT_HASH_CACHE = 4
+
+_EWAH_CLEAN_WORDS = (0, 0xffffffffffffffff)
+_RLW_RUNNING_BITS = 32
+_RLW_LARGEST_RUNNING_COUNT = (1 << _RLW_RUNNING_BITS) - 1
+_RLW_LARGEST_LITERAL_COUNT = (1 << 31) - 1
+
+_TYPE_BITMAP_ORDER = (Commit.type_num, Tree.type_num, Blob.type_num,
+                      Tag.type_num)
+
+
+def _bits_to_words(bits):
+    """Split a bitmap into 64-bit words, least significant word first."""
+    if not bits:
+        return []
+    hexbits = '%x' % bits
+    num_words = (len(hexbits) + 15) // 16
+    data = binascii.unhexlify(hexbits.zfill(num_words * 16))
+    words = list(struct.unpack('>%dQ' % num_words, data))
+    words.reverse()
+    return words
+
+
+def _words_to_bits(words):
+    """Combine 64-bit words, least significant word first, into a bitmap."""
+    if not words:
+        return 0
+    data = struct.pack('>%dQ' % len(words), *reversed(words))
+    return int(binascii.hexlify(data), 16)
+
+
+def _positions_to_bits(positions):
+    """Create a bitmap with the bits at the given positions set."""
+    if not positions:
+        return 0
+    buf = bytearray((max(positions) >> 3) + 1)
+    for pos in positions:
+        buf[pos >> 3] |= 1 << (pos & 7)
+    buf.reverse()
+    return int(binascii.hexlify(bytes(buf)), 16)
+
+
+def _bits_to_bytes(bits):
+    """Split a bitmap into a bytearray, least significant byte first."""
+    hexbits = '%x' % bits
+    buf = bytearray(binascii.unhexlify(hexbits.zfill(len(hexbits) + 1 & ~1)))
+    buf.reverse()
+    return buf
+
+
+def _test_bit(buf, pos):
+    """Check whether a bit is set in a bitmap split by _bits_to_bytes.
+
+    Unlike (bits >> pos) & 1, this doesn't copy the whole bitmap.
+    """
+    i = pos >> 3
+    return i < len(buf) and (buf[i] >> (pos & 7)) & 1
+
+
+def iter_bits(bits):
+    """Iterate over the positions of the bits set in a bitmap, in order."""
+    for i, word in enumerate(_bits_to_words(bits)):
+        base = i * 64
+        while word:
+            lowest = word & -word
+            yield base + _bit_length(lowest) - 1
+            word ^= lowest
+
+
+def read_ewah(data, offset=0):
+    """Read an EWAH-compressed bitmap.
+
+    :param data: Buffer to read from
+    :param offset: Offset of the bitmap in data
+    :return: Tuple with the bitmap and the offset just past it
+    """
+    bit_size, word_count = struct.unpack_from('>LL', data, offset)
+    offset += 8
+    buf = struct.unpack_from('>%dQ' % word_count, data, offset)
+    # Skip the position of the last run-length word, only used for appending
+    offset += 8 * word_count + 4
+    words = []
+    i = 0
+    while i < word_count:
+        rlw = buf[i]
+        running_len = (rlw >> 1) & _RLW_LARGEST_RUNNING_COUNT
+        literal_words = rlw >> (1 + _RLW_RUNNING_BITS)
+        words.extend([_EWAH_CLEAN_WORDS[rlw & 1]] * running_len)
+        words.extend(buf[i + 1:i + 1 + literal_words])
+        i += 1 + literal_words
+    return _words_to_bits(words) & ((1 << bit_size) - 1), offset
+
+
+def write_ewah(f, bits):
+    """Write an EWAH-compressed bitmap.
+
+    :param f: File-like object to write to
+    :param bits: Bitmap to write
+    """
+    words = _bits_to_words(bits)
+    buf = []
+    i = 0
+    while True:
+        running_bit = 0
+        running_len = 0
+        if i < len(words) and words[i] in _EWAH_CLEAN_WORDS:
+            clean = words[i]
+            running_bit = clean & 1
+            while (i < len(words) and words[i] == clean and
+                   running_len < _RLW_LARGEST_RUNNING_COUNT):
+                running_len += 1
+                i += 1
+        start = i
+        while (i < len(words) and words[i] not in _EWAH_CLEAN_WORDS and
+               i - start < _RLW_LARGEST_LITERAL_COUNT):
+            i += 1
+        rlw_pos = len(buf)
+        buf.append(running_bit | (running_len << 1) |
+                   ((i - start) << (1 + _RLW_RUNNING_BITS)))
+        buf.extend(words[start:i])
+        if i >= len(words):
+            break
+    f.write(struct.pack('>LL', _bit_length(bits), len(buf)))
+    f.write(struct.pack('>%dQ' % len(buf), *buf))
+    f.write(struct.pack('>L', rlw_pos))
+
+
+class PackBitmap(object):
+    """Reachability bitmaps for the commits in a pack.
+
+    :ivar index: The PackIndex of the pack
+    """
+
+    def __init__(self, index, type_bitmaps, entries, contents=None):
+        """Create a new PackBitmap.
+
+        :param index: PackIndex of the pack the bitmaps are for
+        :param type_bitmaps: Dictionary mapping type numbers to the bitmap of
+            objects of that type
+        :param entries: Dictionary mapping binary commit SHA1s to either their
+            bitmap, or a tuple with the offset of their EWAH bitmap in
+            contents and the SHA1 of the entry it is XORed with (or None)
+        :param contents: Buffer with the contents of the bitmap file
+        """
+        self.index = index
+        self._type_bitmaps = type_bitmaps
+        self._entries = entries
+        self._contents = contents
+        by_offset = sorted((offset, sha) for (sha, offset, crc32)
+                           in index.iterentries())
+        self._offsets = [offset for (offset, sha) in by_offset]
+        self._shas = [sha for (offset, sha) in by_offset]
+
+    def close(self):
+        if self._contents is not None and getattr(
+                self._contents, 'close', None) is not None:
+            self._contents.close()
+        self._contents = None
+
+    def __len__(self):
+        """Number of commits with a stored bitmap."""
+        return len(self._entries)
+
+    def __iter__(self):
+        """Iterate over the binary SHA1s of the commits with a bitmap."""
+        return iter(self._entries)
+
+    def __contains__(self, sha):
+        """Check whether a commit has a stored bitmap."""
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        return sha in self._entries
+
+    def position(self, sha):
+        """Return the bit position of an object in the pack.
+
+        :param sha: Hex or binary SHA1 of the object
+        :raise KeyError: if the object is not in the pack
+        """
+        return bisect_left(self._offsets, self.index.object_index(sha))
+
+    def sha_at(self, position):
+        """Return the binary SHA1 of the object at a bit position."""
+        return self._shas[position]
+
+    def type_bitmap(self, type_num):
+        """Return the bitmap of all objects of a type."""
+        return self._type_bitmaps.get(type_num, 0)
+
+    def get(self, sha):
+        """Return the stored bitmap for a commit.
+
+        :param sha: Hex or binary SHA1 of the commit
+        :return: Bitmap of all objects reachable from the commit, or None if
+            there is no bitmap for the commit
+        """
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        entry = self._entries.get(sha)
+        if entry is None or not isinstance(entry, tuple):
+            return entry
+        offset, xor_sha = entry
+        bits = read_ewah(self._contents, offset)[0]
+        if xor_sha is not None:
+            bits ^= self.get(xor_sha)
+        self._entries[sha] = bits
+        return bits
+
+    def add(self, sha, bits):
+        """Store the bitmap for a commit."""
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        self._entries[sha] = bits
+
+    def reachable(self, heads, get_object):
+        """Compute the bitmap of all objects reachable from a set of objects.
+
+        Stored bitmaps are used where possible; the remainder of the graph
+        is walked.
+
+        :param heads: Iterable over hex SHA1s to start from
+        :param get_object: Function to retrieve an object by hex SHA1
+        :return: Bitmap of the objects reachable from heads
+        :raise KeyError: if an object that is not in the pack is reachable
+        """
+        found = 0
+        found_buf = bytearray()
+        walked = set()
+        todo = list(heads)
+        while todo:
+            sha = todo.pop()
+            pos = self.position(sha)
+            if pos in walked or _test_bit(found_buf, pos):
+                continue
+            stored = self.get(sha)
+            if stored is not None:
+                found |= stored
+                found_buf = _bits_to_bytes(found)
+                continue
+            walked.add(pos)
+            obj = get_object(sha)
+            if isinstance(obj, Commit):
+                todo.extend(obj.parents)
+                todo.append(obj.tree)
+            elif isinstance(obj, Tree):
+                for name, mode, entry_sha in obj.iteritems():
+                    if stat.S_ISDIR(mode):
+                        todo.append(entry_sha)
+                    elif not S_ISGITLINK(mode):
+                        walked.add(self.position(entry_sha))
+            elif isinstance(obj, Tag):
+                todo.append(obj.object[1])
+        return found | _positions_to_bits(walked)
+
+    def missing_objects(self, haves, wants, get_object, tagged=None):
+        """Find the objects reachable from wants but not from haves.
+
+        :param haves: Iterable over hex SHA1s of objects in common
+        :param wants: Iterable over hex SHA1s of objects to send
+        :param get_object: Function to retrieve an object by hex SHA1
+        :param tagged: Optional dict of pointed-to sha -> tag sha; tags that
+            point at objects that are sent are sent too
+        :return: List of hex SHA1s, in pack order
+        :raise KeyError: if an object that is not in the pack is reachable
+        """
+        have_bits = self.reachable(haves, get_object)
+        missing = self.reachable(wants, get_object) & ~have_bits
+        if tagged:
+            have_buf = _bits_to_bytes(have_bits)
+            missing_buf = _bits_to_bytes(missing)
+            tag_positions = []
+            for target, tag in tagged.items():
+                try:
+                    target_pos = self.position(target)
+                except KeyError:
+                    continue
+                if _test_bit(missing_buf, target_pos):
+                    tag_pos = self.position(tag)
+                    if not _test_bit(have_buf, tag_pos):
+                        tag_positions.append(tag_pos)
+            missing |= _positions_to_bits(tag_positions)
+        return [sha_to_hex(self._shas[pos]) for pos in iter_bits(missing)]
+
+
+def read_pack_bitmap(f, index):
+    """Read a pack bitmap from a file-like object.
+
+    :param f: File-like object to read from
+    :param index: PackIndex of the pack the bitmap is for
+    :return: A PackBitmap
+    """
+    contents, size = _load_file_contents(f)
+    if contents[:4] != BITMAP_SIGNATURE:
+        raise AssertionError('Not a pack bitmap file')
+    version, flags, entry_count = struct.unpack_from('>HHL', contents, 4)
+    if version != BITMAP_VERSION:
+        raise AssertionError('Version was %d' % version)
+    pack_checksum = contents[12:32]
+    if pack_checksum != index.get_pack_checksum():
+        raise ChecksumMismatch(sha_to_hex(index.get_pack_checksum()),
+                               sha_to_hex(pack_checksum))
+    offset = 32
+    type_bitmaps = {}
+    for type_num in _TYPE_BITMAP_ORDER:
+        type_bitmaps[type_num], offset = read_ewah(contents, offset)
+    names = sorted(sha for (sha, pack_offset, crc32) in index.iterentries())
+    entries = {}
+    entry_shas = []
+    for i in range(entry_count):
+        idx_pos, xor_offset, entry_flags = struct.unpack_from(
+            '>LBB', contents, offset)
+        offset += 6
+        sha = names[idx_pos]
+        if xor_offset:
+            xor_sha = entry_shas[i - xor_offset]
+        else:
+            xor_sha = None
+        entries[sha] = (offset, xor_sha)
+        entry_shas.append(sha)
+        bit_size, word_count = struct.unpack_from('>LL', contents, offset)
+        offset += 12 + 8 * word_count
+    return PackBitmap(index, type_bitmaps, entries, contents)
+
+
+def load_pack_bitmap(path, index):
+    """Load a pack bitmap by path.
+
+    :param path: Path to the bitmap file
+    :param index: PackIndex of the pack the bitmap is for
+    :return: A PackBitmap
+    """
+    with GitFile(path, 'rb') as f:
+        return read_pack_bitmap(f, index)
+
+
+def write_pack_bitmap(f, bitmap):
+    """Write a pack bitmap to a file.
+
+    :param f: File-like object to write to
+    :param bitmap: PackBitmap to write
+    :return: SHA1 of the written bitmap file
+    """
+    f = SHA1Writer(f)
+    index = bitmap.index
+    f.write(BITMAP_SIGNATURE)
+    f.write(struct.pack('>HHL', BITMAP_VERSION, BITMAP_OPT_FULL_DAG,
+                        len(bitmap)))
+    f.write(index.get_pack_checksum())
+    for type_num in _TYPE_BITMAP_ORDER:
+        write_ewah(f, bitmap.type_bitmap(type_num))
+    names = sorted(sha for (sha, offset, crc32) in index.iterentries())
+    for sha in sorted(bitmap):
+        f.write(struct.pack('>LBB', bisect_left(names, sha), 0, 0))
+        write_ewah(f, bitmap.get(sha))
+    return f.write_sha()
+
+
+class _TypeNumIterator(DeltaChainIterator):
+    """Delta chain iterator that yields offsets and type numbers."""
+
+    def _result(self, unpacked):
+        return unpacked.offset, unpacked.obj_type_num
+
+
+def build_pack_bitmap(pack, commits):
+    """Compute the reachability bitmaps for commits in a pack.
+
+    :param pack: Pack that contains every object reachable from commits
+    :param commits: Iterable over hex SHA1s of the commits to store bitmaps
+        for
+    :return: A PackBitmap
+    :raise KeyError: if an object reachable from commits is not in the pack
+    """
+    # The bitmap refers to the index, so keep it open while it is built.
+    with pack._using('index') as index:
+        bitmap = PackBitmap(index, {}, {})
+        type_positions = {}
+        with pack._using('data') as data:
+            for offset, type_num in _TypeNumIterator.for_pack_data(
+                    data, resolve_ext_ref=pack.resolve_ext_ref):
+                type_positions.setdefault(type_num, []).append(
+                    bisect_left(bitmap._offsets, offset))
+        for type_num, positions in type_positions.items():
+            bitmap._type_bitmaps[type_num] = _positions_to_bits(positions)
+        # Oldest commits first, so that the bitmaps of ancestors can be
+        # reused
+        commits = sorted((pack[sha] for sha in set(commits)),
+                         key=lambda commit: commit.commit_time)
+        for commit in commits:
+            bitmap.add(commit.id,
+                       bitmap.reachable([commit.id], pack.__getitem__))
+    return bitmap
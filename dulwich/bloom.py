@@ -0,0 +1,275 @@
+# bloom.py -- Changed-path Bloom filters
+# Copyright (C) 2015 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Changed-path Bloom filters, as stored in commit-graph files.
+
+The Bloom filter of a commit contains the paths that were changed relative
+to its first parent (or all paths, for root commits), along with their
+leading directories. If a path is not in the filter, the commit did not
+change it and there is no need to compare trees.
+
+The hashing scheme (version 1) matches the one used by C git.
+
+ObjectBloomFilter is an in-memory Bloom filter of object SHA1s, used by
+object stores to quickly rule out objects they don't have.
+"""
+
+import struct
+
+from dulwich.diff_tree import (
+    tree_changes,
+    )
+
+BLOOM_HASH_VERSION = 1
+BLOOM_NUM_HASHES = 7
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_MAX_CHANGED_PATHS = 512
+
+_SEED0 = 0x293ae76f
+_SEED1 = 0x7e646e2c
+
+
+def _signed_byte(b):
+    # C git (hash version 1) hashes paths as signed chars.
+    if b >= 0x80:
+        return (b - 0x100) & 0xffffffff
+    return b
+
+
+def _rotate_left(value, count):
+    return ((value << count) | (value >> (32 - count))) & 0xffffffff
+
+
+def murmur3_seeded(seed, data):
+    """Calculate the 32-bit murmur3 hash of a string, as used by C git.
+
+    :param seed: Seed for the hash
+    :param data: Data to hash
+    :return: 32-bit hash value
+    """
+    c1 = 0xcc9e2d51
+    c2 = 0x1b873593
+    data = [_signed_byte(b) for b in bytearray(data)]
+    length = len(data)
+    len4 = length // 4
+    for i in range(len4):
+        k = (data[4 * i] | (data[4 * i + 1] << 8) | (data[4 * i + 2] << 16) |
+             (data[4 * i + 3] << 24)) & 0xffffffff
+        k = (k * c1) & 0xffffffff
+        k = _rotate_left(k, 15)
+        k = (k * c2) & 0xffffffff
+        seed ^= k
+        seed = (_rotate_left(seed, 13) * 5 + 0xe6546b64) & 0xffffffff
+    tail = data[len4 * 4:]
+    if tail:
+        k1 = 0
+        for i in reversed(range(len(tail))):
+            k1 ^= (tail[i] << (8 * i)) & 0xffffffff
+        k1 = (k1 * c1) & 0xffffffff
+        k1 = _rotate_left(k1, 15)
+        k1 = (k1 * c2) & 0xffffffff
+        seed ^= k1
+    seed ^= length & 0xffffffff
+    seed ^= seed >> 16
+    seed = (seed * 0x85ebca6b) & 0xffffffff
+    seed ^= seed >> 13
+    seed = (seed * 0xc2b2ae35) & 0xffffffff
+    seed ^= seed >> 16
+    return seed
+
+
+def bloom_key(path, num_hashes=BLOOM_NUM_HASHES):
+    """Calculate the hash values for a path.
+
+    :param path: Path, without trailing slash
+    :param num_hashes: Number of hash values to calculate
+    :return: Tuple with num_hashes hash values
+    """
+    hash0 = murmur3_seeded(_SEED0, path)
+    hash1 = murmur3_seeded(_SEED1, path)
+    return tuple((hash0 + i * hash1) & 0xffffffff for i in range(num_hashes))
+
+
+class BloomFilter(object):
+    """A changed-path Bloom filter for a single commit."""
+
+    def __init__(self, data, num_hashes=BLOOM_NUM_HASHES):
+        """Create a new BloomFilter.
+
+        :param data: Contents of the filter
+        :param num_hashes: Number of hash values per path
+        """
+        self.data = bytes(data)
+        self.num_hashes = num_hashes
+        self._bits = bytearray(self.data)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.data)
+
+    def __eq__(self, other):
+        return (isinstance(other, BloomFilter) and self.data == other.data and
+                self.num_hashes == other.num_hashes)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    @classmethod
+    def from_paths(cls, paths, num_hashes=BLOOM_NUM_HASHES,
+                   bits_per_entry=BLOOM_BITS_PER_ENTRY):
+        """Create a BloomFilter containing a set of paths.
+
+        :param paths: Set of paths, usually from commit_changed_paths(), or
+            None for a filter that contains all paths
+        :param num_hashes: Number of hash values per path
+        :param bits_per_entry: Number of bits in the filter per path
+        :return: A BloomFilter
+        """
+        if paths is None:
+            return cls(b'\xff', num_hashes)
+        size = max(1, (len(paths) * bits_per_entry + 7) // 8)
+        bits = bytearray(size)
+        for path in paths:
+            for h in bloom_key(path, num_hashes):
+                h %= size * 8
+                bits[h // 8] |= 1 << (h % 8)
+        return cls(bits, num_hashes)
+
+    def contains_key(self, key):
+        """Check whether a path might be in this filter.
+
+        :param key: Hash values of the path, as returned by bloom_key()
+        :return: False if the path is definitely not in this filter, True if
+            it may be
+        """
+        bits = self._bits
+        if not bits:
+            return True
+        num_bits = len(bits) * 8
+        for h in key:
+            h %= num_bits
+            if not bits[h // 8] & (1 << (h % 8)):
+                return False
+        return True
+
+    def contains(self, path):
+        """Check whether a path might be in this filter.
+
+        :param path: Path, without trailing slash
+        :return: False if the path is definitely not in this filter, True if
+            it may be
+        """
+        return self.contains_key(bloom_key(path, self.num_hashes))
+
+
+def sha_bloom_key(sha, num_hashes=BLOOM_NUM_HASHES):
+    """Calculate the hash values for an object.
+
+    SHA1s are uniformly distributed already, so the hash values are derived
+    from the SHA1 itself rather than hashing it again.
+
+    :param sha: Binary SHA1
+    :param num_hashes: Number of hash values to calculate
+    :return: Tuple with num_hashes hash values
+    """
+    hash0, hash1 = struct.unpack('>LL', sha[:8])
+    return tuple((hash0 + i * hash1) & 0xffffffff for i in range(num_hashes))
+
+
+class ObjectBloomFilter(object):
+    """A Bloom filter of object SHA1s, that objects can be added to.
+
+    :ivar capacity: Number of objects the filter was sized for
+    :ivar count: Number of objects added so far
+    """
+
+    def __init__(self, capacity, num_hashes=BLOOM_NUM_HASHES,
+                 bits_per_entry=BLOOM_BITS_PER_ENTRY):
+        """Create a new, empty ObjectBloomFilter.
+
+        :param capacity: Number of objects to size the filter for; the
+            false positive rate goes up if more objects are added
+        :param num_hashes: Number of hash values per object
+        :param bits_per_entry: Number of bits in the filter per object
+        """
+        self.capacity = capacity
+        self.count = 0
+        self.num_hashes = num_hashes
+        self._bits = bytearray(max(1, (capacity * bits_per_entry + 7) // 8))
+        self._num_bits = len(self._bits) * 8
+
+    def add(self, sha):
+        """Add an object.
+
+        :param sha: Binary SHA1 of the object
+        """
+        bits = self._bits
+        num_bits = self._num_bits
+        for h in sha_bloom_key(sha, self.num_hashes):
+            h %= num_bits
+            bits[h // 8] |= 1 << (h % 8)
+        self.count += 1
+
+    def __contains__(self, sha):
+        """Check whether an object might be in this filter.
+
+        :param sha: Binary SHA1 of the object
+        :return: False if the object is definitely not in this filter, True
+            if it may be
+        """
+        bits = self._bits
+        num_bits = self._num_bits
+        for h in sha_bloom_key(sha, self.num_hashes):
+            h %= num_bits
+            if not bits[h // 8] & (1 << (h % 8)):
+                return False
+        return True
+
+
+def commit_changed_paths(store, commit,
+                         max_changed_paths=BLOOM_MAX_CHANGED_PATHS):
+    """Find the paths changed by a commit, relative to its first parent.
+
+    :param store: Object store to retrieve objects from
+    :param commit: Commit object
+    :param max_changed_paths: Maximum number of paths to collect
+    :return: Set of the changed paths and their leading directories, or None
+        if more than max_changed_paths paths were changed
+    """
+    if commit.parents:
+        parent_tree = store[commit.parents[0]].tree
+    else:
+        parent_tree = None
+    paths = set()
+    num_changes = 0
+    for change in tree_changes(store, parent_tree, commit.tree):
+        num_changes += 1
+        if num_changes > max_changed_paths:
+            return None
+        path = change.new.path
+        if path is None:
+            path = change.old.path
+        while path:
+            if path in paths:
+                break
+            paths.add(path)
+            path = path.rpartition(b'/')[0]
+    if len(paths) > max_changed_paths:
+        return None
+    return paths
+
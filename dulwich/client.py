@@ -82,6 +82,9 @@ from dulwich.protocol import (
     extract_capabilities,
     )
 from dulwich.pack import (
+    generate_pack_records,
+    order_pack_objects,
+    write_pack_data,
     write_pack_objects,
     )
 from dulwich.refs import (
@@ -793,7 +796,15 @@ class LocalGitClient(GitClient):
             # that the client still expects a 0-object pack in most cases.
             if objects_iter is None:
                 return
-            write_pack_objects(ProtocolFile(None, pack_data), objects_iter)
+            if objects_iter:
+                objects = order_pack_objects(
+                    objects_iter.itershas(),
+                    lambda sha: r.object_store.get_object_info(sha)[0])
+                shas = [sha for (sha, path) in objects]
+            else:
+                shas = []
+            write_pack_data(ProtocolFile(None, pack_data), len(shas),
+                            generate_pack_records(r.object_store, shas))
 
     def get_refs(self, path):
         """Retrieve the current refs from a git smart server."""
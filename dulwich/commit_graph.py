@@ -0,0 +1,394 @@
+# commit_graph.py -- Reading and writing of commit-graph files
+# Copyright (C) 2015 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Reading and writing of commit-graph files (objects/info/commit-graph).
+
+A commit-graph file stores the tree, parents and commit time of a set of
+commits, along with their generation number, so that the commit graph can
+be walked without inflating and parsing commit objects. See git's
+Documentation/technical/commit-graph-format.txt for the format.
+
+The generation number of a commit is one more than the maximum generation
+number of its parents (1 for root commits). A commit can only be an ancestor
+of another commit if its generation number is lower.
+
+A commit-graph file can also contain a changed-path Bloom filter for every
+commit (see dulwich.bloom).
+"""
+
+from hashlib import sha1
+import struct
+
+from dulwich.bloom import (
+    BLOOM_BITS_PER_ENTRY,
+    BLOOM_HASH_VERSION,
+    BLOOM_NUM_HASHES,
+    BloomFilter,
+    )
+from dulwich.errors import (
+    ChecksumMismatch,
+    )
+from dulwich.file import GitFile
+from dulwich.objects import (
+    hex_to_sha,
+    sha_to_hex,
+    )
+from dulwich.pack import (
+    SHA1Writer,
+    _load_file_contents,
+    bisect_find_sha,
+    )
+
+COMMIT_GRAPH_FILENAME = 'commit-graph'
+COMMIT_GRAPH_SIGNATURE = b'CGPH'
+COMMIT_GRAPH_VERSION = 1
+COMMIT_GRAPH_OID_VERSION_SHA1 = 1
+
+COMMIT_GRAPH_CHUNK_OIDFANOUT = b'OIDF'
+COMMIT_GRAPH_CHUNK_OIDLOOKUP = b'OIDL'
+COMMIT_GRAPH_CHUNK_DATA = b'CDAT'
+COMMIT_GRAPH_CHUNK_EXTRAEDGES = b'EDGE'
+COMMIT_GRAPH_CHUNK_BLOOMINDEXES = b'BIDX'
+COMMIT_GRAPH_CHUNK_BLOOMDATA = b'BDAT'
+
+GENERATION_NUMBER_MAX = 0x3fffffff
+
+_PARENT_NONE = 0x70000000
+_PARENT_EXTRA_EDGES = 0x80000000
+_LAST_EDGE = 0x80000000
+_COMMIT_DATA_SIZE = 36
+
+
+class CommitGraph(object):
+    """A commit-graph file."""
+
+    def __init__(self, filename, file=None, contents=None, size=None):
+        """Open a commit-graph file.
+
+        :param filename: Path to the commit-graph file
+        :param file: Optional open file object for the commit-graph file
+        :param contents: Optional contents of the file
+        :param size: Optional size of the file
+        """
+        self._filename = filename
+        if file is None:
+            self._file = GitFile(filename, 'rb')
+        else:
+            self._file = file
+        if contents is None:
+            self._contents, self._size = _load_file_contents(self._file, size)
+        else:
+            self._contents, self._size = (contents, size)
+        if self._contents[:4] != COMMIT_GRAPH_SIGNATURE:
+            raise AssertionError('Not a commit-graph file')
+        version, oid_version, num_chunks, num_base_graphs = struct.unpack_from(
+            '>BBBB', self._contents, 4)
+        if version != COMMIT_GRAPH_VERSION:
+            raise AssertionError('Version was %d' % version)
+        if oid_version != COMMIT_GRAPH_OID_VERSION_SHA1:
+            raise AssertionError('Unsupported object id version %d' %
+                                 oid_version)
+        if num_base_graphs != 0:
+            # Positions in a split graph continue those of its base graphs,
+            # so they can't be resolved from this file alone.
+            raise AssertionError('Split commit-graph files are not supported')
+        chunks = {}
+        for i in range(num_chunks):
+            chunk_id, chunk_offset = struct.unpack_from(
+                '>4sQ', self._contents, 8 + i * 12)
+            chunks[chunk_id] = chunk_offset
+        for chunk_id in (COMMIT_GRAPH_CHUNK_OIDFANOUT,
+                         COMMIT_GRAPH_CHUNK_OIDLOOKUP,
+                         COMMIT_GRAPH_CHUNK_DATA):
+            if chunk_id not in chunks:
+                raise AssertionError('Missing required chunk %r' % chunk_id)
+        self._fan_out_table = struct.unpack_from(
+            '>256L', self._contents, chunks[COMMIT_GRAPH_CHUNK_OIDFANOUT])
+        self._name_offset = chunks[COMMIT_GRAPH_CHUNK_OIDLOOKUP]
+        self._data_offset = chunks[COMMIT_GRAPH_CHUNK_DATA]
+        self._edge_offset = chunks.get(COMMIT_GRAPH_CHUNK_EXTRAEDGES)
+        self._bloom_index_offset = chunks.get(COMMIT_GRAPH_CHUNK_BLOOMINDEXES)
+        self._bloom_data_offset = chunks.get(COMMIT_GRAPH_CHUNK_BLOOMDATA)
+        if (self._bloom_index_offset is None or
+                self._bloom_data_offset is None):
+            self._bloom_index_offset = self._bloom_data_offset = None
+        else:
+            hash_version, self._bloom_num_hashes, bits_per_entry = (
+                struct.unpack_from('>LLL', self._contents,
+                                   self._bloom_data_offset))
+            if hash_version != BLOOM_HASH_VERSION:
+                # Filters hashed differently can't be used
+                self._bloom_index_offset = self._bloom_data_offset = None
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._filename)
+
+    def close(self):
+        self._file.close()
+        if getattr(self._contents, 'close', None) is not None:
+            self._contents.close()
+
+    def __len__(self):
+        """Return the number of commits in this commit graph."""
+        return self._fan_out_table[-1]
+
+    def _unpack_name(self, i):
+        offset = self._name_offset + i * 20
+        return bytes(self._contents[offset:offset + 20])
+
+    def _position(self, sha):
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        idx = ord(sha[:1])
+        if idx == 0:
+            start = 0
+        else:
+            start = self._fan_out_table[idx-1]
+        end = self._fan_out_table[idx]
+        i = bisect_find_sha(start, end, sha, self._unpack_name)
+        if i is None or i >= len(self):
+            raise KeyError(sha)
+        return i
+
+    def __contains__(self, sha):
+        try:
+            self._position(sha)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        """Iterate over the binary SHA1s of the commits in this graph."""
+        for i in range(len(self)):
+            yield self._unpack_name(i)
+
+    def _unpack_parents(self, i):
+        parent1, parent2 = struct.unpack_from(
+            '>LL', self._contents, self._data_offset + i * _COMMIT_DATA_SIZE + 20)
+        parents = []
+        if parent1 != _PARENT_NONE:
+            parents.append(parent1)
+        if parent2 & _PARENT_EXTRA_EDGES:
+            offset = self._edge_offset + (parent2 & ~_PARENT_EXTRA_EDGES) * 4
+            while True:
+                edge = struct.unpack_from('>L', self._contents, offset)[0]
+                parents.append(edge & ~_LAST_EDGE)
+                if edge & _LAST_EDGE:
+                    break
+                offset += 4
+        elif parent2 != _PARENT_NONE:
+            parents.append(parent2)
+        return parents
+
+    def _unpack_generation_and_time(self, i):
+        gen_and_time_hi, time_lo = struct.unpack_from(
+            '>LL', self._contents,
+            self._data_offset + i * _COMMIT_DATA_SIZE + 28)
+        return gen_and_time_hi >> 2, ((gen_and_time_hi & 0x3) << 32) | time_lo
+
+    def get_tree(self, sha):
+        """Return the tree of a commit.
+
+        :param sha: Hex or binary SHA1 of the commit
+        :return: Hex SHA1 of the tree
+        :raise KeyError: if the commit is not in this graph
+        """
+        offset = self._data_offset + self._position(sha) * _COMMIT_DATA_SIZE
+        return sha_to_hex(bytes(self._contents[offset:offset + 20]))
+
+    def get_parents(self, sha):
+        """Return the parents of a commit.
+
+        :param sha: Hex or binary SHA1 of the commit
+        :return: List of hex SHA1s of the parents
+        :raise KeyError: if the commit is not in this graph
+        """
+        return [sha_to_hex(self._unpack_name(p))
+                for p in self._unpack_parents(self._position(sha))]
+
+    def get_commit_time(self, sha):
+        """Return the commit time of a commit.
+
+        :param sha: Hex or binary SHA1 of the commit
+        :raise KeyError: if the commit is not in this graph
+        """
+        return self._unpack_generation_and_time(self._position(sha))[1]
+
+    def get_generation(self, sha):
+        """Return the generation number of a commit.
+
+        :param sha: Hex or binary SHA1 of the commit
+        :raise KeyError: if the commit is not in this graph
+        """
+        return self._unpack_generation_and_time(self._position(sha))[0]
+
+    def get_bloom_filter(self, sha):
+        """Return the changed-path Bloom filter of a commit.
+
+        :param sha: Hex or binary SHA1 of the commit
+        :return: A BloomFilter, or None if this graph has no Bloom filters
+        :raise KeyError: if the commit is not in this graph
+        """
+        i = self._position(sha)
+        if self._bloom_index_offset is None:
+            return None
+        if i == 0:
+            start = 0
+        else:
+            start = struct.unpack_from(
+                '>L', self._contents, self._bloom_index_offset + (i - 1) * 4)[0]
+        end = struct.unpack_from(
+            '>L', self._contents, self._bloom_index_offset + i * 4)[0]
+        offset = self._bloom_data_offset + 12
+        return BloomFilter(self._contents[offset + start:offset + end],
+                           self._bloom_num_hashes)
+
+    def check(self):
+        """Check that the stored checksum matches the actual checksum."""
+        actual = self.calculate_checksum()
+        stored = self.get_stored_checksum()
+        if actual != stored:
+            raise ChecksumMismatch(sha_to_hex(stored), sha_to_hex(actual))
+
+    def calculate_checksum(self):
+        """Calculate the SHA1 checksum over this commit graph.
+
+        :return: This is a 20-byte binary digest
+        """
+        return sha1(self._contents[:-20]).digest()
+
+    def get_stored_checksum(self):
+        """Return the SHA1 checksum stored for this commit graph.
+
+        :return: 20-byte binary digest
+        """
+        return bytes(self._contents[-20:])
+
+
+def load_commit_graph(path):
+    """Load a commit-graph file by path.
+
+    :param path: Path to the commit-graph file
+    :return: A CommitGraph
+    """
+    with GitFile(path, 'rb') as f:
+        return CommitGraph(path, file=f)
+
+
+def compute_generations(parents):
+    """Compute the generation numbers of a set of commits.
+
+    :param parents: Dictionary mapping commit SHA1s to lists of parent SHA1s
+    :return: Dictionary mapping commit SHA1s to generation numbers
+    :raise KeyError: if a parent of a commit is not in parents
+    """
+    generations = {}
+    for sha in parents:
+        todo = [sha]
+        while todo:
+            current = todo[-1]
+            if current in generations:
+                todo.pop()
+                continue
+            pending = [p for p in parents[current] if p not in generations]
+            if pending:
+                todo.extend(pending)
+                continue
+            todo.pop()
+            generations[current] = min(
+                GENERATION_NUMBER_MAX,
+                1 + max([generations[p] for p in parents[current]] or [0]))
+    return generations
+
+
+def write_commit_graph(f, commits, bloom_filters=None):
+    """Write a commit-graph file.
+
+    :param f: File-like object to write to
+    :param commits: Iterable over Commit objects; the parents of every commit
+        must be included as well
+    :param bloom_filters: Optional dictionary mapping the SHA1s of all commits
+        to their changed-path BloomFilter objects
+    :return: SHA1 of the written commit-graph file
+    :raise KeyError: if the parent of a commit is not in commits
+    """
+    commits = dict((hex_to_sha(c.id), c) for c in commits)
+    shas = sorted(commits)
+    positions = dict((sha, i) for (i, sha) in enumerate(shas))
+    generations = compute_generations(dict(
+        (c.id, c.parents) for c in commits.values()))
+
+    fan_out_table = [0] * 0x100
+    for sha in shas:
+        fan_out_table[ord(sha[:1])] += 1
+    for i in range(1, 0x100):
+        fan_out_table[i] += fan_out_table[i - 1]
+    data = []
+    edges = []
+    for sha in shas:
+        commit = commits[sha]
+        parents = [positions[hex_to_sha(p)] for p in commit.parents]
+        parent1 = parents[0] if parents else _PARENT_NONE
+        if len(parents) > 2:
+            parent2 = _PARENT_EXTRA_EDGES | len(edges)
+            edges.extend(parents[1:-1])
+            edges.append(_LAST_EDGE | parents[-1])
+        elif len(parents) == 2:
+            parent2 = parents[1]
+        else:
+            parent2 = _PARENT_NONE
+        commit_time = commit.commit_time
+        data.append(hex_to_sha(commit.tree) + struct.pack(
+            '>LLLL', parent1, parent2,
+            (generations[commit.id] << 2) | ((commit_time >> 32) & 0x3),
+            commit_time & 0xffffffff))
+    chunks = [
+        (COMMIT_GRAPH_CHUNK_OIDFANOUT, struct.pack('>256L', *fan_out_table)),
+        (COMMIT_GRAPH_CHUNK_OIDLOOKUP, b''.join(shas)),
+        (COMMIT_GRAPH_CHUNK_DATA, b''.join(data)),
+        ]
+    if edges:
+        chunks.append((COMMIT_GRAPH_CHUNK_EXTRAEDGES,
+                       struct.pack('>%dL' % len(edges), *edges)))
+    if bloom_filters is not None:
+        bloom_index = []
+        bloom_data = [struct.pack('>LLL', BLOOM_HASH_VERSION,
+                                  BLOOM_NUM_HASHES, BLOOM_BITS_PER_ENTRY)]
+        end = 0
+        for sha in shas:
+            data = bloom_filters[commits[sha].id].data
+            end += len(data)
+            bloom_index.append(end)
+            bloom_data.append(data)
+        chunks.append((COMMIT_GRAPH_CHUNK_BLOOMINDEXES,
+                       struct.pack('>%dL' % len(bloom_index), *bloom_index)))
+        chunks.append((COMMIT_GRAPH_CHUNK_BLOOMDATA, b''.join(bloom_data)))
+
+    f = SHA1Writer(f)
+    f.write(COMMIT_GRAPH_SIGNATURE)
+    f.write(struct.pack('>BBBB', COMMIT_GRAPH_VERSION,
+                        COMMIT_GRAPH_OID_VERSION_SHA1, len(chunks), 0))
+    offset = 8 + (len(chunks) + 1) * 12
+    for chunk_id, chunk in chunks:
+        f.write(chunk_id + struct.pack('>Q', offset))
+        offset += len(chunk)
+    f.write(b'\0' * 4 + struct.pack('>Q', offset))
+    for chunk_id, chunk in chunks:
+        f.write(chunk)
+    return f.write_sha()
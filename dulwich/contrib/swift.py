@@ -41,7 +41,6 @@ from dulwich.greenthreads import (
     GreenThreadsObjectStoreIterator,
     )
 
-from dulwich.lru_cache import LRUSizeCache
 from dulwich.objects import (
     Blob,
     Commit,
@@ -65,8 +64,9 @@ from dulwich.pack import (
     write_pack_index_v2,
     load_pack_index_file,
     read_pack_header,
-    _compute_object_size,
+    DeltaBaseCache,
     unpack_object,
+    unpack_object_header,
     write_pack_object,
     )
 from dulwich.protocol import TCP_GIT_PORT
@@ -572,13 +572,15 @@ class SwiftPackData(PackData):
         pack_reader = SwiftPackReader(self.scon, self._filename,
                                       self.pack_length)
         (version, self._num_objects) = read_pack_header(pack_reader.read)
-        self._offset_cache = LRUSizeCache(1024*1024*self.scon.cache_length,
-                                          compute_size=_compute_object_size)
+        self._offset_cache = DeltaBaseCache(
+            1024*1024*self.scon.cache_length)
         self.pack = None
 
     def get_object_at(self, offset):
-        if offset in self._offset_cache:
+        try:
             return self._offset_cache[offset]
+        except KeyError:
+            pass
         assert isinstance(offset, long) or isinstance(offset, int),\
             'offset was %r' % offset
         assert offset >= self._header_size
@@ -588,6 +590,23 @@ class SwiftPackData(PackData):
         unpacked, _ = unpack_object(pack_reader.read)
         return (unpacked.pack_type_num, unpacked._obj())
 
+    def _unpack_header_at(self, offset):
+        assert offset >= self._header_size
+        pack_reader = SwiftPackReader(self.scon, self._filename,
+                                      self.pack_length)
+        pack_reader.seek(offset)
+        return unpack_object_header(pack_reader.read)
+
+    def get_unpacked_object_at(self, offset, include_comp=False):
+        assert offset >= self._header_size
+        pack_reader = SwiftPackReader(self.scon, self._filename,
+                                      self.pack_length)
+        pack_reader.seek(offset)
+        unpacked, _ = unpack_object(pack_reader.read, compute_crc32=True,
+                                    include_comp=include_comp)
+        unpacked.offset = offset
+        return unpacked
+
     def get_stored_checksum(self):
         pack_reader = SwiftPackReader(self.scon, self._filename,
                                       self.pack_length)
@@ -616,6 +635,7 @@ class SwiftPack(Pack):
         self._idx_load = lambda: swift_load_pack_index(self.scon,
                                                        self._idx_path)
         self._data_load = lambda: SwiftPackData(self.scon, self._data_path)
+        self._bitmap_load = lambda: None
 
     @property
     def pack_info(self):
@@ -31,6 +31,7 @@ from dulwich.objects import (
 from dulwich.object_store import (
     MissingObjectFinder,
     _collect_filetree_revs,
+    _initial_objects_to_send,
     ObjectStoreIterator,
     )
 
@@ -98,8 +99,8 @@ class GreenThreadsMissingObjectFinder(MissingObjectFinder):
         for t in have_tags:
             self.sha_done.add(t)
         missing_tags = want_tags.difference(have_tags)
-        wants = missing_commits.union(missing_tags)
-        self.objects_to_send = set([(w, None, False) for w in wants])
+        self.objects_to_send = _initial_objects_to_send(
+            object_store, missing_commits, missing_tags)
         if progress is None:
             self.progress = lambda x: None
         else:
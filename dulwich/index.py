@@ -30,6 +30,7 @@ from dulwich.objects import (
     Blob,
     S_IFGITLINK,
     S_ISGITLINK,
+    ShaFile,
     Tree,
     hex_to_sha,
     sha_to_hex,
@@ -484,21 +485,28 @@ def build_index_from_tree(root_path, index_path, object_store, tree_id,
     if not isinstance(root_path, bytes):
         root_path = root_path.encode(sys.getfilesystemencoding())
 
+    entries = {}
     for entry in object_store.iter_tree_contents(tree_id):
         if not validate_path(entry.path, validate_path_element):
             continue
-        full_path = _tree_to_fs_path(root_path, entry.path)
-
-        if not os.path.exists(os.path.dirname(full_path)):
-            os.makedirs(os.path.dirname(full_path))
-
-        # FIXME: Merge new index into working tree
-        obj = object_store[entry.sha]
-        build_file_from_blob(obj, entry.mode, full_path,
-            honor_filemode=honor_filemode)
-        # Add file to index
-        st = os.lstat(full_path)
-        index[entry.path] = index_entry_from_stat(st, entry.sha, 0)
+        entries.setdefault(entry.sha, []).append(entry)
+
+    # Retrieve the blobs in a batch, so the object store can read them in
+    # the order in which they are stored.
+    for sha, type_num, uncomp in object_store.iter_raw_objects(entries):
+        obj = ShaFile.from_raw_string(type_num, uncomp, sha=sha)
+        for entry in entries[sha]:
+            full_path = _tree_to_fs_path(root_path, entry.path)
+
+            if not os.path.exists(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+
+            # FIXME: Merge new index into working tree
+            build_file_from_blob(obj, entry.mode, full_path,
+                honor_filemode=honor_filemode)
+            # Add file to index
+            st = os.lstat(full_path)
+            index[entry.path] = index_entry_from_stat(st, entry.sha, 0)
 
     index.write()
 
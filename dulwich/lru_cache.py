@@ -184,6 +184,19 @@ class LRUCache(object):
         """Get the key:value pairs as a dict."""
         return dict((k, n.value) for k, n in self._cache.items())
 
+    def remove(self, key, cleanup=True):
+        """Remove an entry from the cache, if it is there.
+
+        :param key: The key of the entry
+        :param cleanup: Whether to call the cleanup function of the entry
+        """
+        node = self._cache.get(key)
+        if node is None:
+            return
+        if not cleanup:
+            node.cleanup = None
+        self._remove_node(node)
+
     def cleanup(self):
         """Clear the cache until it shrinks to the requested size.
 
@@ -227,6 +240,8 @@ class LRUCache(object):
     def _remove_node(self, node):
         if node is self._least_recently_used:
             self._least_recently_used = node.prev
+        elif node is self._most_recently_used:
+            self._most_recently_used = self._cache[node.next_key]
         self._cache.pop(node.key)
         # If we have removed all entries, remove the head pointer as well
         if self._least_recently_used is None:
@@ -354,6 +369,14 @@ class LRUSizeCache(LRUCache):
         self._value_size -= node.size
         LRUCache._remove_node(self, node)
 
+    def value_size(self):
+        """Get the total size of the cached values."""
+        return self._value_size
+
+    def max_size(self):
+        """Get the maximum total size of the values we will cache."""
+        return self._max_size
+
     def resize(self, max_size, after_cleanup_size=None):
         """Change the number of bytes that will be cached."""
         self._update_max_size(max_size, after_cleanup_size=after_cleanup_size)
@@ -0,0 +1,268 @@
+# midx.py -- Reading and writing of multi-pack indexes
+# Copyright (C) 2015 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Reading and writing of multi-pack indexes (objects/pack/multi-pack-index).
+
+A multi-pack index maps every object in a set of packs to the pack that
+contains it and its offset in that pack, so that an object can be found
+with a single lookup rather than one per pack. See git's
+Documentation/technical/multi-pack-index.txt for the format.
+"""
+
+from hashlib import sha1
+import struct
+
+from dulwich.errors import (
+    ChecksumMismatch,
+    )
+from dulwich.file import GitFile
+from dulwich.objects import (
+    hex_to_sha,
+    sha_to_hex,
+    )
+from dulwich.pack import (
+    SHA1Writer,
+    _load_file_contents,
+    bisect_find_sha,
+    )
+
+MIDX_FILENAME = 'multi-pack-index'
+MIDX_SIGNATURE = b'MIDX'
+MIDX_VERSION = 1
+MIDX_OID_VERSION_SHA1 = 1
+
+MIDX_CHUNK_PACKNAMES = b'PNAM'
+MIDX_CHUNK_OIDFANOUT = b'OIDF'
+MIDX_CHUNK_OIDLOOKUP = b'OIDL'
+MIDX_CHUNK_OBJECTOFFSETS = b'OOFF'
+MIDX_CHUNK_LARGEOFFSETS = b'LOFF'
+
+_LARGE_OFFSET_FLAG = 0x80000000
+
+
+class MultiPackIndex(object):
+    """A multi-pack index, covering the objects in several packs."""
+
+    def __init__(self, filename, file=None, contents=None, size=None):
+        """Open a multi-pack index.
+
+        :param filename: Path to the multi-pack index file
+        :param file: Optional open file object for the multi-pack index
+        :param contents: Optional contents of the file
+        :param size: Optional size of the file
+        """
+        self._filename = filename
+        if file is None:
+            self._file = GitFile(filename, 'rb')
+        else:
+            self._file = file
+        if contents is None:
+            self._contents, self._size = _load_file_contents(self._file, size)
+        else:
+            self._contents, self._size = (contents, size)
+        if self._contents[:4] != MIDX_SIGNATURE:
+            raise AssertionError('Not a multi-pack index file')
+        (version, oid_version, num_chunks, num_base_files,
+         num_packs) = struct.unpack_from('>BBBBL', self._contents, 4)
+        if version != MIDX_VERSION:
+            raise AssertionError('Version was %d' % version)
+        if oid_version != MIDX_OID_VERSION_SHA1:
+            raise AssertionError('Unsupported object id version %d' %
+                                 oid_version)
+        self._chunks = {}
+        for i in range(num_chunks):
+            chunk_id, chunk_offset, next_offset = struct.unpack_from(
+                '>4sQ4xQ', self._contents, 12 + i * 12)
+            self._chunks[chunk_id] = (chunk_offset, next_offset)
+        for chunk_id in (MIDX_CHUNK_PACKNAMES, MIDX_CHUNK_OIDFANOUT,
+                         MIDX_CHUNK_OIDLOOKUP, MIDX_CHUNK_OBJECTOFFSETS):
+            if chunk_id not in self._chunks:
+                raise AssertionError('Missing required chunk %r' % chunk_id)
+        start, end = self._chunks[MIDX_CHUNK_PACKNAMES]
+        self.pack_names = [
+            name.decode('utf-8') for name in
+            bytes(self._contents[start:end]).split(b'\0')
+            if name][:num_packs]
+        self._fan_out_offset = self._chunks[MIDX_CHUNK_OIDFANOUT][0]
+        self._fan_out_table = struct.unpack_from(
+            '>256L', self._contents, self._fan_out_offset)
+        self._name_offset = self._chunks[MIDX_CHUNK_OIDLOOKUP][0]
+        self._offset_offset = self._chunks[MIDX_CHUNK_OBJECTOFFSETS][0]
+        self._large_offset_offset = self._chunks.get(
+            MIDX_CHUNK_LARGEOFFSETS, (None, None))[0]
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._filename)
+
+    def close(self):
+        self._file.close()
+        if getattr(self._contents, 'close', None) is not None:
+            self._contents.close()
+
+    def __len__(self):
+        """Return the number of objects in this multi-pack index."""
+        return self._fan_out_table[-1]
+
+    def _unpack_name(self, i):
+        offset = self._name_offset + i * 20
+        return bytes(self._contents[offset:offset + 20])
+
+    def _unpack_location(self, i):
+        pack_id, offset = struct.unpack_from(
+            '>LL', self._contents, self._offset_offset + i * 8)
+        if offset & _LARGE_OFFSET_FLAG:
+            offset = struct.unpack_from(
+                '>Q', self._contents, self._large_offset_offset +
+                (offset & ~_LARGE_OFFSET_FLAG) * 8)[0]
+        return pack_id, offset
+
+    def _object_position(self, sha):
+        idx = ord(sha[:1])
+        if idx == 0:
+            start = 0
+        else:
+            start = self._fan_out_table[idx-1]
+        end = self._fan_out_table[idx]
+        i = bisect_find_sha(start, end, sha, self._unpack_name)
+        if i is None or i >= len(self):
+            raise KeyError(sha)
+        return i
+
+    def __contains__(self, sha):
+        try:
+            self.object_location(sha)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        """Iterate over the binary SHA1s of the objects in this index."""
+        for i in range(len(self)):
+            yield self._unpack_name(i)
+
+    def iterentries(self):
+        """Iterate over the entries in this multi-pack index.
+
+        :return: iterator over tuples with object name, index of the pack in
+            pack_names and offset in that pack.
+        """
+        for i in range(len(self)):
+            pack_id, offset = self._unpack_location(i)
+            yield self._unpack_name(i), pack_id, offset
+
+    def object_location(self, sha):
+        """Find the pack and offset of an object.
+
+        :param sha: Hex or binary SHA1 of the object
+        :return: Tuple with the index of the pack in pack_names and the offset
+            of the object in that pack
+        :raise KeyError: if the object is not in this index
+        """
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        return self._unpack_location(self._object_position(sha))
+
+    def check(self):
+        """Check that the stored checksum matches the actual checksum."""
+        actual = self.calculate_checksum()
+        stored = self.get_stored_checksum()
+        if actual != stored:
+            raise ChecksumMismatch(sha_to_hex(stored), sha_to_hex(actual))
+
+    def calculate_checksum(self):
+        """Calculate the SHA1 checksum over this multi-pack index.
+
+        :return: This is a 20-byte binary digest
+        """
+        return sha1(self._contents[:-20]).digest()
+
+    def get_stored_checksum(self):
+        """Return the SHA1 checksum stored for this multi-pack index.
+
+        :return: 20-byte binary digest
+        """
+        return bytes(self._contents[-20:])
+
+
+def load_multi_pack_index(path):
+    """Load a multi-pack index by path.
+
+    :param path: Path to the multi-pack index file
+    :return: A MultiPackIndex
+    """
+    with GitFile(path, 'rb') as f:
+        return MultiPackIndex(path, file=f)
+
+
+def write_multi_pack_index(f, packs):
+    """Write a multi-pack index.
+
+    :param f: File-like object to write to
+    :param packs: List of (name, PackIndex) tuples, where name is the file
+        name of the pack index (e.g. "pack-<sha>.idx"). If an object is in
+        several packs, it is looked up in the first of them.
+    :return: SHA1 of the written multi-pack index
+    """
+    names = sorted(name for (name, index) in packs)
+    pack_ids = dict((name, i) for (i, name) in enumerate(names))
+    locations = {}
+    for name, index in packs:
+        pack_id = pack_ids[name]
+        for sha, offset, crc32 in index.iterentries():
+            locations.setdefault(sha, (pack_id, offset))
+    shas = sorted(locations)
+
+    pack_names = b''.join(name.encode('utf-8') + b'\0' for name in names)
+    pack_names += b'\0' * (-len(pack_names) % 4)
+    fan_out_table = [0] * 0x100
+    for sha in shas:
+        fan_out_table[ord(sha[:1])] += 1
+    for i in range(1, 0x100):
+        fan_out_table[i] += fan_out_table[i - 1]
+    offsets = []
+    large_offsets = []
+    for sha in shas:
+        pack_id, offset = locations[sha]
+        if offset >= _LARGE_OFFSET_FLAG:
+            offsets.append(struct.pack(
+                '>LL', pack_id, _LARGE_OFFSET_FLAG | len(large_offsets)))
+            large_offsets.append(struct.pack('>Q', offset))
+        else:
+            offsets.append(struct.pack('>LL', pack_id, offset))
+    chunks = [
+        (MIDX_CHUNK_PACKNAMES, [pack_names]),
+        (MIDX_CHUNK_OIDFANOUT, [struct.pack('>256L', *fan_out_table)]),
+        (MIDX_CHUNK_OIDLOOKUP, shas),
+        (MIDX_CHUNK_OBJECTOFFSETS, offsets),
+        ]
+    if large_offsets:
+        chunks.append((MIDX_CHUNK_LARGEOFFSETS, large_offsets))
+
+    f = SHA1Writer(f)
+    f.write(MIDX_SIGNATURE)
+    f.write(struct.pack('>BBBBL', MIDX_VERSION, MIDX_OID_VERSION_SHA1,
+                        len(chunks), 0, len(names)))
+    offset = 12 + (len(chunks) + 1) * 12
+    for chunk_id, data in chunks:
+        f.write(chunk_id + struct.pack('>Q', offset))
+        offset += sum(len(d) for d in data)
+    f.write(b'\0' * 4 + struct.pack('>Q', offset))
+    for chunk_id, data in chunks:
+        f.write(b''.join(data))
+    return f.write_sha()
@@ -33,10 +33,35 @@ from dulwich.diff_tree import (
     tree_changes,
     walk_trees,
     )
+from dulwich.bitmap import (
+    build_pack_bitmap,
+    write_pack_bitmap,
+    )
+from dulwich.bloom import (
+    BLOOM_NUM_HASHES,
+    BloomFilter,
+    ObjectBloomFilter,
+    commit_changed_paths,
+    )
+from dulwich.commit_graph import (
+    COMMIT_GRAPH_FILENAME,
+    load_commit_graph,
+    write_commit_graph,
+    )
 from dulwich.errors import (
+    NotCommitError,
     NotTreeError,
     )
 from dulwich.file import GitFile
+from dulwich.lru_cache import (
+    LRUCache,
+    LRUSizeCache,
+    )
+from dulwich.midx import (
+    MIDX_FILENAME,
+    load_multi_pack_index,
+    write_multi_pack_index,
+    )
 from dulwich.objects import (
     Commit,
     ShaFile,
@@ -53,9 +78,13 @@ from dulwich.pack import (
     Pack,
     PackData,
     PackInflater,
+    generate_pack_records,
     iter_sha1,
+    order_pack_objects,
+    write_pack_data,
     write_pack_header,
     write_pack_index_v2,
+    write_pack_rev,
     write_pack_object,
     write_pack_objects,
     compute_file_sha,
@@ -66,6 +95,9 @@ from dulwich.pack import (
 INFODIR = 'info'
 PACKDIR = 'pack'
 
+# Number of SHA1s of missing objects that PackBasedObjectStore remembers.
+DEFAULT_MISSING_OBJECT_CACHE_SIZE = 1024
+
 
 class BaseObjectStore(object):
     """Object store interface."""
@@ -98,6 +130,14 @@ class BaseObjectStore(object):
         """
         return self.contains_packed(sha) or self.contains_loose(sha)
 
+    def contains_many(self, shas):
+        """Check which of several objects are present.
+
+        :param shas: Iterable of hex SHA1s
+        :return: Set of the SHA1s that are present
+        """
+        return set(sha for sha in shas if sha in self)
+
     @property
     def packs(self):
         """Iterable of pack objects."""
@@ -116,6 +156,41 @@ class BaseObjectStore(object):
         type_num, uncomp = self.get_raw(sha)
         return ShaFile.from_raw_string(type_num, uncomp, sha=sha)
 
+    def get_object_info(self, sha):
+        """Find the type and size of an object.
+
+        :param sha: sha for the object.
+        :return: tuple with numeric type and length of the object contents.
+        :raise KeyError: if the object is not in this store
+        """
+        type_num, uncomp = self.get_raw(sha)
+        return type_num, len(uncomp)
+
+    def iter_raw_objects(self, shas):
+        """Obtain the raw text for a batch of objects.
+
+        Objects are not necessarily returned in the order they were requested
+        in; implementations can reorder them to make retrieval cheaper.
+
+        :param shas: Iterable over SHA1s of objects
+        :return: Iterator over (sha, type_num, contents) tuples, with one
+            entry for every distinct SHA1
+        :raise KeyError: if one of the objects is not in this store
+        """
+        for sha in set(shas):
+            type_num, uncomp = self.get_raw(sha)
+            yield sha, type_num, uncomp
+
+    def get_unpacked_object(self, sha, include_comp=False):
+        """Obtain an object as it is stored in a pack.
+
+        :param sha: sha for the object.
+        :param include_comp: If True, include compressed data in the result.
+        :return: UnpackedObject, see Pack.get_unpacked_object
+        :raise KeyError: if the object is not stored in a pack
+        """
+        raise KeyError(sha)
+
     def __iter__(self):
         """Iterate over the SHAs that are present in this store."""
         raise NotImplementedError(self.__iter__)
@@ -163,8 +238,7 @@ class BaseObjectStore(object):
                 yield entry
 
     def find_missing_objects(self, haves, wants, progress=None,
-                             get_tagged=None,
-                             get_parents=lambda commit: commit.parents):
+                             get_tagged=None, get_parents=None):
         """Find the missing objects required for a set of revisions.
 
         :param haves: Iterable over SHAs already in common.
@@ -194,6 +268,67 @@ class BaseObjectStore(object):
             sha = next(graphwalker)
         return haves
 
+    def find_thin_pack_bases(self, haves, objects=None):
+        """Find the trees and blobs that the receiver of a thin pack has.
+
+        These can be used as delta bases for the objects in the pack, see
+        generate_thin_pack_records.
+
+        Like git, if the objects being sent are given, only the trees of the
+        boundary commits are used: the haves that are parents of the commits
+        being sent. Only the entries with the path of an object being sent
+        are returned, and only subtrees with such a path are walked.
+
+        :param haves: SHA1s of commits that the receiver has; other SHA1s
+            are ignored
+        :param objects: Optional sequence of (sha, path) tuples of the
+            objects being sent, as returned by find_missing_objects
+        :return: Iterator over (sha, path) tuples, with paths like the ones
+            from find_missing_objects
+        """
+        paths = None
+        if objects is not None:
+            boundary = set()
+            paths = set()
+            have_set = set(haves)
+            for sha, path in objects:
+                if path is not None:
+                    paths.add(path)
+                    continue
+                # Commits and tags have no path.
+                try:
+                    parents = self.get_parents(sha)
+                except (KeyError, NotCommitError):
+                    continue
+                boundary.update(parent for parent in parents
+                                if parent in have_set)
+            haves = [have for have in haves if have in boundary]
+        seen = set()
+        for have in haves:
+            try:
+                commit = self[have]
+            except KeyError:
+                continue
+            if not isinstance(commit, Commit):
+                continue
+            todo = [(commit.tree, "")]
+            while todo:
+                tree_sha, tree_path = todo.pop()
+                if tree_sha in seen:
+                    continue
+                seen.add(tree_sha)
+                yield tree_sha, tree_path
+                for name, mode, sha in self[tree_sha].iteritems():
+                    if S_ISGITLINK(mode):
+                        continue
+                    if paths is not None and name not in paths:
+                        continue
+                    if stat.S_ISDIR(mode):
+                        todo.append((sha, name))
+                    elif sha not in seen:
+                        seen.add(sha)
+                        yield sha, name
+
     def generate_pack_contents(self, have, want, progress=None):
         """Iterate over the contents of a pack file.
 
@@ -218,14 +353,92 @@ class BaseObjectStore(object):
             obj = self[sha]
         return obj
 
-    def _collect_ancestors(self, heads, common=set(),
-                           get_parents=lambda commit: commit.parents):
+    @property
+    def commit_graph(self):
+        """The commit graph of this store, or None if it does not have one."""
+        return None
+
+    def _get_commit(self, sha):
+        commit = self[sha]
+        if not isinstance(commit, Commit):
+            raise NotCommitError(sha)
+        return commit
+
+    def get_parents(self, sha):
+        """Retrieve the parents of a commit.
+
+        The commit graph is used if it covers the commit, so that the commit
+        does not have to be read and parsed.
+
+        :param sha: SHA1 of the commit
+        :return: List of SHA1s of the parents
+        :raise KeyError: if the commit is not in this store
+        :raise NotCommitError: if the object is not a commit
+        """
+        commit_graph = self.commit_graph
+        if commit_graph is not None:
+            try:
+                return commit_graph.get_parents(sha)
+            except KeyError:
+                pass
+        return self._get_commit(sha).parents
+
+    def get_commit_time(self, sha):
+        """Retrieve the commit time of a commit.
+
+        :param sha: SHA1 of the commit
+        :return: Commit time, in seconds since the epoch
+        :raise KeyError: if the commit is not in this store
+        :raise NotCommitError: if the object is not a commit
+        """
+        commit_graph = self.commit_graph
+        if commit_graph is not None:
+            try:
+                return commit_graph.get_commit_time(sha)
+            except KeyError:
+                pass
+        return self._get_commit(sha).commit_time
+
+    def get_generation(self, sha):
+        """Retrieve the generation number of a commit.
+
+        A commit can only be an ancestor of another commit with a higher
+        generation number.
+
+        :param sha: SHA1 of the commit
+        :return: Generation number, or None if it is not known
+        """
+        commit_graph = self.commit_graph
+        if commit_graph is not None:
+            try:
+                return commit_graph.get_generation(sha)
+            except KeyError:
+                pass
+        return None
+
+    def get_bloom_filter(self, sha):
+        """Retrieve the changed-path Bloom filter of a commit.
+
+        :param sha: SHA1 of the commit
+        :return: A dulwich.bloom.BloomFilter with the paths changed by the
+            commit relative to its first parent, or None if it is not known
+        """
+        commit_graph = self.commit_graph
+        if commit_graph is not None:
+            try:
+                return commit_graph.get_bloom_filter(sha)
+            except KeyError:
+                pass
+        return None
+
+    def _collect_ancestors(self, heads, common=set(), get_parents=None):
         """Collect all ancestors of heads up to (excluding) those in common.
 
         :param heads: commits to start from
         :param common: commits to end at, or empty set to walk repository
             completely
-        :param get_parents: Optional function for getting the parents of a commit.
+        :param get_parents: Optional function for getting the parents of a
+            commit. Defaults to get_parents of this store.
         :return: a tuple (A, B) where A - all commits reachable
             from heads but not present in common, B - common (shared) elements
             that are directly reachable from heads
@@ -240,8 +453,10 @@ class BaseObjectStore(object):
                 bases.add(e)
             elif e not in commits:
                 commits.add(e)
-                cmt = self[e]
-                queue.extend(get_parents(cmt))
+                if get_parents is None:
+                    queue.extend(self.get_parents(e))
+                else:
+                    queue.extend(get_parents(self[e]))
         return (commits, bases)
 
     def close(self):
@@ -251,35 +466,233 @@ class BaseObjectStore(object):
 
 class PackBasedObjectStore(BaseObjectStore):
 
-    def __init__(self):
+    # Multi-pack index, if any, and the packs for its pack names (None for
+    # packs that are gone)
+    _midx = None
+    _midx_packs = ()
+
+    # Bloom filter of the objects in the packs, built the first time an
+    # object is not found in any pack if use_pack_bloom is set. Objects from
+    # packs that are removed stay in it, which only costs an occasional
+    # unnecessary lookup.
+    _pack_bloom = None
+
+    # Whether to build a Bloom filter of the packed objects. Building it
+    # reads every entry of every pack index, which only pays off for
+    # long-lived stores that look up many missing objects, so this is off
+    # by default.
+    use_pack_bloom = False
+
+    # Whether find_missing_objects may use pack bitmaps. Objects found
+    # through a bitmap have no path, which order_pack_objects and the delta
+    # search for thin packs rely on, so this is off by default.
+    use_bitmaps = False
+
+    def __init__(self, object_cache_size=None):
+        """Create a new PackBasedObjectStore.
+
+        Objects that were found to be missing are remembered until objects
+        are added to the store, or new packs appear in it; only the loose
+        objects are checked for them until then.
+
+        :param object_cache_size: Optional maximum size (in bytes of raw
+            object data) of the cache of parsed objects returned by
+            __getitem__. Objects are not cached if this is None.
+        """
         self._pack_cache = {}
+        self._object_cache = None
+        self.set_object_cache_size(object_cache_size)
+        self._missing_objects = LRUCache(DEFAULT_MISSING_OBJECT_CACHE_SIZE)
+
+    def set_object_cache_size(self, max_size):
+        """Set the maximum size of the cache of parsed objects.
+
+        Objects returned from the cache are shared between callers, so they
+        should not be modified while the cache is enabled.
+
+        :param max_size: Maximum size in bytes of raw object data, or None to
+            disable the cache
+        """
+        self._object_cache_hits = 0
+        self._object_cache_misses = 0
+        if max_size is None:
+            self._object_cache = None
+        elif self._object_cache is None:
+            self._object_cache = LRUSizeCache(
+                max_size, compute_size=lambda obj: obj.raw_length())
+        else:
+            self._object_cache.resize(max_size)
+
+    def object_cache_stats(self):
+        """Return statistics for the cache of parsed objects.
+
+        :return: Dictionary with the number of cache hits and misses, the
+            number of cached objects and their total size, or None if the
+            cache is disabled
+        """
+        cache = self._object_cache
+        if cache is None:
+            return None
+        return {
+            'hits': self._object_cache_hits,
+            'misses': self._object_cache_misses,
+            'count': len(cache),
+            'size': cache.value_size(),
+            'max_size': cache.max_size(),
+            }
+
+    def __getitem__(self, sha):
+        """Obtain an object by SHA1."""
+        cache = self._object_cache
+        if cache is None:
+            return super(PackBasedObjectStore, self).__getitem__(sha)
+        if len(sha) == 20:
+            sha = sha_to_hex(sha)
+        obj = cache.get(sha)
+        if obj is not None:
+            self._object_cache_hits += 1
+            return obj
+        self._object_cache_misses += 1
+        obj = super(PackBasedObjectStore, self).__getitem__(sha)
+        cache.add(sha, obj)
+        return obj
 
     @property
     def alternates(self):
         return []
 
+    def _find_pack(self, sha):
+        """Find the pack that contains an object.
+
+        This does not check alternates.
+
+        :param sha: Hex or binary SHA1 of the object
+        :return: Tuple with the pack and the offset of the object in it
+        :raise KeyError: if the object is not in any pack
+        """
+        packs = self.packs
+        bloom = self._pack_bloom
+        if bloom is not None:
+            if (hex_to_sha(sha) if len(sha) == 40 else sha) not in bloom:
+                raise KeyError(sha)
+        skip = set()
+        if self._midx is not None:
+            try:
+                pack_id, offset = self._midx.object_location(sha)
+            except KeyError:
+                # Not in any of the packs covered by the multi-pack index
+                skip = set(id(pack) for pack in self._midx_packs)
+            else:
+                pack = self._midx_packs[pack_id]
+                if pack is not None:
+                    return pack, offset
+        for pack in packs:
+            if id(pack) in skip:
+                continue
+            try:
+                return pack, pack.index.object_index(sha)
+            except KeyError:
+                pass
+        raise KeyError(sha)
+
     def contains_packed(self, sha):
         """Check if a particular object is present by SHA1 and is packed.
 
         This does not check alternates.
         """
-        for pack in self.packs:
-            if sha in pack:
-                return True
-        return False
+        try:
+            self._find_pack(sha)
+        except KeyError:
+            if self.use_pack_bloom and self._pack_bloom is None:
+                self._build_pack_bloom()
+            return False
+        return True
 
     def __contains__(self, sha):
         """Check if a particular object is present by SHA1.
 
         This method makes no distinction between loose and packed objects.
         """
+        if len(sha) == 20:
+            sha = sha_to_hex(sha)
+        # Refresh the packs first, new packs invalidate the missing objects.
+        self.packs
+        if sha in self._missing_objects:
+            # Missing objects are not in the packs or alternates, but they
+            # may have been added as loose objects by another process.
+            return self.contains_loose(sha)
         if self.contains_packed(sha) or self.contains_loose(sha):
             return True
         for alternate in self.alternates:
             if sha in alternate:
                 return True
+        self._missing_objects.add(sha, None)
         return False
 
+    def contains_many(self, shas):
+        """Check which of several objects are present.
+
+        The objects are looked up in bulk in each of the pack indexes.
+
+        :param shas: Iterable of hex SHA1s
+        :return: Set of the SHA1s that are present
+        """
+        packs = list(self.packs)
+        shas = set(shas)
+        # Missing objects are only checked for as loose objects.
+        present = set(sha for sha in shas if sha in self._missing_objects
+                      and self.contains_loose(sha))
+        remaining = set(sha for sha in shas if sha not in self._missing_objects)
+        bloom = self._pack_bloom
+        if bloom is None:
+            candidates = set(remaining)
+        else:
+            candidates = set(sha for sha in remaining
+                             if hex_to_sha(sha) in bloom)
+        for pack in packs:
+            if not candidates:
+                break
+            found = pack.index.contains_many(candidates)
+            present |= found
+            candidates -= found
+        if candidates and self.use_pack_bloom and bloom is None:
+            self._build_pack_bloom()
+        for sha in remaining - present:
+            if self.contains_loose(sha) or any(
+                    sha in alternate for alternate in self.alternates):
+                present.add(sha)
+            else:
+                self._missing_objects.add(sha, None)
+        return present
+
+    def _build_pack_bloom(self):
+        """Build the Bloom filter of the objects in the packs."""
+        packs = list(self.packs)
+        bloom = ObjectBloomFilter(
+            max(DEFAULT_MISSING_OBJECT_CACHE_SIZE,
+                2 * sum(len(pack) for pack in packs)))
+        for pack in packs:
+            for sha, offset, crc32 in pack.index.iterentries():
+                bloom.add(sha)
+        self._pack_bloom = bloom
+
+    def _objects_added(self, packs=()):
+        """Note that objects were added to this store.
+
+        :param packs: Packs that were added, if any
+        """
+        self._missing_objects.clear()
+        bloom = self._pack_bloom
+        if bloom is None:
+            return
+        if bloom.count + sum(len(pack) for pack in packs) > bloom.capacity:
+            # Start over with a larger filter once it is needed
+            self._pack_bloom = None
+            return
+        for pack in packs:
+            for sha, offset, crc32 in pack.index.iterentries():
+                bloom.add(sha)
+
     def _pack_cache_stale(self):
         """Check whether the pack cache is stale."""
         raise NotImplementedError(self._pack_cache_stale)
@@ -289,13 +702,22 @@ class PackBasedObjectStore(BaseObjectStore):
 
         """
         self._pack_cache[base_name] = pack
+        self._objects_added([pack])
 
     def close(self):
         pack_cache = self._pack_cache
         self._pack_cache = {}
+        self._pack_bloom = None
+        self._missing_objects.clear()
         while pack_cache:
             (name, pack) = pack_cache.popitem()
             pack.close()
+        if self._object_cache is not None:
+            self._object_cache.clear()
+        if self._midx is not None:
+            self._midx.close()
+            self._midx = None
+            self._midx_packs = ()
 
     @property
     def packs(self):
@@ -318,6 +740,12 @@ class PackBasedObjectStore(BaseObjectStore):
     def _get_loose_object(self, sha):
         raise NotImplementedError(self._get_loose_object)
 
+    def _get_loose_object_info(self, sha):
+        obj = self._get_loose_object(sha)
+        if obj is None:
+            return None
+        return obj.type_num, obj.raw_length()
+
     def _remove_loose_object(self, sha):
         raise NotImplementedError(self._remove_loose_object)
 
@@ -326,13 +754,14 @@ class PackBasedObjectStore(BaseObjectStore):
 
         :return: Number of objects packed
         """
-        objects = set()
-        for sha in self._iter_loose_objects():
-            objects.add((self._get_loose_object(sha), None))
-        self.add_objects(list(objects))
-        for obj, path in objects:
-            self._remove_loose_object(obj.id)
-        return len(objects)
+        # Only keep the SHAs around; the objects are read while they are
+        # written to the pack.
+        shas = list(self._iter_loose_objects())
+        self.add_objects(
+            (self._get_loose_object(sha), None) for sha in shas)
+        for sha in shas:
+            self._remove_loose_object(sha)
+        return len(shas)
 
     def __iter__(self):
         """Iterate over the SHAs that are present in this store."""
@@ -360,11 +789,12 @@ class PackBasedObjectStore(BaseObjectStore):
             hexsha = None
         else:
             raise AssertionError("Invalid object name %r" % name)
-        for pack in self.packs:
-            try:
-                return pack.get_raw(sha)
-            except KeyError:
-                pass
+        try:
+            pack, offset = self._find_pack(sha)
+        except KeyError:
+            pass
+        else:
+            return pack.get_raw_at(offset)
         if hexsha is None:
             hexsha = sha_to_hex(name)
         ret = self._get_loose_object(hexsha)
@@ -377,50 +807,257 @@ class PackBasedObjectStore(BaseObjectStore):
                 pass
         raise KeyError(hexsha)
 
+    def get_object_info(self, sha):
+        """Find the type and size of an object.
+
+        For packed objects, only the object headers are read; deltas are not
+        resolved.
+
+        :param sha: sha for the object.
+        :return: tuple with numeric type and length of the object contents.
+        :raise KeyError: if the object is not in this store
+        """
+        if len(sha) == 40:
+            hexsha = sha
+            sha = hex_to_sha(sha)
+        elif len(sha) == 20:
+            hexsha = None
+        else:
+            raise AssertionError("Invalid object name %r" % sha)
+        try:
+            pack, offset = self._find_pack(sha)
+        except KeyError:
+            pass
+        else:
+            return pack.data.get_object_info_at(offset)
+        if hexsha is None:
+            hexsha = sha_to_hex(sha)
+        ret = self._get_loose_object_info(hexsha)
+        if ret is not None:
+            return ret
+        for alternate in self.alternates:
+            try:
+                return alternate.get_object_info(hexsha)
+            except KeyError:
+                pass
+        raise KeyError(hexsha)
+
+    def iter_raw_objects(self, shas):
+        """Obtain the raw text for a batch of objects.
+
+        Packed objects are grouped by pack and read in offset order, sharing
+        delta bases between them. Loose objects and objects in alternates
+        are returned last.
+
+        :param shas: Iterable over SHA1s of objects
+        :return: Iterator over (sha, type_num, contents) tuples, with one
+            entry for every distinct SHA1
+        :raise KeyError: if one of the objects is not in this store
+        """
+        by_pack = {}
+        remaining = []
+        for sha in set(shas):
+            try:
+                pack, offset = self._find_pack(sha)
+            except KeyError:
+                remaining.append(sha)
+            else:
+                by_pack.setdefault(id(pack), (pack, {}))[1][offset] = sha
+        for pack, offsets in by_pack.values():
+            for offset, type_num, uncomp in pack.iter_raw_at(offsets):
+                yield offsets[offset], type_num, uncomp
+        for sha in remaining:
+            type_num, uncomp = self.get_raw(sha)
+            yield sha, type_num, uncomp
+
+    def get_unpacked_object(self, sha, include_comp=False):
+        """Obtain an object as it is stored in a pack.
+
+        This does not check alternates.
+
+        :param sha: sha for the object.
+        :param include_comp: If True, include compressed data in the result.
+        :return: UnpackedObject, see Pack.get_unpacked_object
+        :raise KeyError: if the object is not stored in a pack
+        """
+        pack, offset = self._find_pack(sha)
+        return pack.get_unpacked_object(sha, include_comp=include_comp)
+
+    def find_missing_objects(self, haves, wants, progress=None,
+                             get_tagged=None, get_parents=None):
+        """Find the missing objects required for a set of revisions.
+
+        If use_bitmaps is set and a pack has a bitmap that covers everything
+        reachable from the wants and haves, the bitmap is used rather than
+        walking the graph. The objects are then returned in pack order,
+        without paths.
+
+        :param haves: Iterable over SHAs already in common.
+        :param wants: Iterable over SHAs of objects to fetch.
+        :param progress: Simple progress function that will be called with
+            updated progress strings.
+        :param get_tagged: Function that returns a dict of pointed-to sha -> tag
+            sha for including tags.
+        :param get_parents: Optional function for getting the parents of a
+            commit. Bitmaps are only used if this is not specified.
+        :return: Iterator over (sha, path) pairs; path is None if a bitmap
+            was used.
+        """
+        if self.use_bitmaps and get_parents is None:
+            missing = self._find_missing_objects_bitmap(
+                haves, wants, get_tagged)
+            if missing is not None:
+                if progress is not None:
+                    progress(("counting objects: %d, done.\n" %
+                              len(missing)).encode('ascii'))
+                return ((sha, None) for sha in missing)
+        return super(PackBasedObjectStore, self).find_missing_objects(
+            haves, wants, progress, get_tagged, get_parents=get_parents)
+
+    def _find_missing_objects_bitmap(self, haves, wants, get_tagged):
+        """Find the missing objects using a pack bitmap.
+
+        :return: List of SHAs of the missing objects, or None if no pack
+            bitmap covers the objects reachable from haves and wants
+        """
+        haves = list(haves)
+        wants = list(wants)
+        for pack in self.packs:
+            bitmap = pack.bitmap
+            if bitmap is None:
+                continue
+            # Haves that are missing from this store altogether are ignored,
+            # but haves stored elsewhere may share objects with this pack.
+            if any(have not in pack and have in self for have in haves):
+                continue
+            try:
+                return bitmap.missing_objects(
+                    [have for have in haves if have in pack], wants,
+                    pack.__getitem__, get_tagged and get_tagged() or {})
+            except KeyError:
+                continue
+        return None
+
     def add_objects(self, objects):
         """Add a set of objects to this object store.
 
-        :param objects: Iterable over objects, should support __len__.
+        :param objects: Iterable over (object, path) tuples. If it doesn't
+            support __len__, the objects are counted while they are written.
         :return: Pack object of the objects written.
         """
-        if len(objects) == 0:
+        if hasattr(objects, '__len__') and len(objects) == 0:
             # Don't bother writing an empty pack file
             return
         f, commit, abort = self.add_pack()
         try:
-            write_pack_objects(f, objects)
+            entries, pack_sha = write_pack_objects(f, objects, seekable=True)
         except:
             abort()
             raise
-        else:
-            return commit()
+        if not entries:
+            abort()
+            return None
+        return commit()
 
 
 class DiskObjectStore(PackBasedObjectStore):
     """Git-style object store that exists on disk."""
 
-    def __init__(self, path):
+    def __init__(self, path, object_cache_size=None, index_threads=None,
+                 use_mmap=False):
         """Open an object store.
 
         :param path: Path of the object store.
+        :param object_cache_size: Optional maximum size (in bytes of raw
+            object data) of the cache of parsed objects.
+        :param index_threads: Number of threads to resolve deltas with when
+            indexing packs that are added to the store; None for one.
+        :param use_mmap: Whether to read pack data from memory-mapped
+            windows; applies to packs opened after it is set.
         """
-        super(DiskObjectStore, self).__init__()
+        super(DiskObjectStore, self).__init__(object_cache_size)
+        self.index_threads = index_threads
+        self.use_mmap = use_mmap
         self.path = path
         self.pack_dir = os.path.join(self.path, PACKDIR)
         self._pack_cache_time = 0
         self._pack_cache = {}
         self._alternates = None
+        self._commit_graph = None
+        self._commit_graph_loaded = False
 
     def __repr__(self):
         return "<%s(%r)>" % (self.__class__.__name__, self.path)
 
+    def close(self):
+        super(DiskObjectStore, self).close()
+        if self._commit_graph is not None:
+            self._commit_graph.close()
+        self._commit_graph = None
+        self._commit_graph_loaded = False
+
+    @property
+    def commit_graph(self):
+        """The commit graph of this store, or None if it does not have one."""
+        if not self._commit_graph_loaded:
+            try:
+                self._commit_graph = load_commit_graph(
+                    os.path.join(self.path, INFODIR, COMMIT_GRAPH_FILENAME))
+            except (OSError, IOError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            self._commit_graph_loaded = True
+        return self._commit_graph
+
+    def write_commit_graph(self, heads, changed_paths=False):
+        """Write a commit graph covering the ancestry of a set of commits.
+
+        :param heads: Iterable over SHA1s of the commits to start from
+        :param changed_paths: Whether to include changed-path Bloom filters.
+            Filters in the existing commit graph are reused.
+        :return: SHA1 of the written commit graph
+        """
+        commits = {}
+        todo = list(heads)
+        while todo:
+            sha = todo.pop()
+            if sha in commits:
+                continue
+            commit = self._get_commit(sha)
+            commits[sha] = commit
+            todo.extend(commit.parents)
+        if changed_paths:
+            bloom_filters = {}
+            for sha, commit in commits.items():
+                bloom_filter = self.get_bloom_filter(sha)
+                if (bloom_filter is None or
+                        bloom_filter.num_hashes != BLOOM_NUM_HASHES):
+                    bloom_filter = BloomFilter.from_paths(
+                        commit_changed_paths(self, commit))
+                bloom_filters[sha] = bloom_filter
+        else:
+            bloom_filters = None
+        try:
+            os.mkdir(os.path.join(self.path, INFODIR))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        if self._commit_graph is not None:
+            self._commit_graph.close()
+        self._commit_graph = None
+        self._commit_graph_loaded = False
+        path = os.path.join(self.path, INFODIR, COMMIT_GRAPH_FILENAME)
+        with GitFile(path, 'wb') as f:
+            return write_commit_graph(f, commits.values(), bloom_filters)
+
     @property
     def alternates(self):
         if self._alternates is not None:
             return self._alternates
         self._alternates = []
         for path in self._read_alternate_paths():
-            self._alternates.append(DiskObjectStore(path))
+            self._alternates.append(
+                DiskObjectStore(path, use_mmap=self.use_mmap))
         return self._alternates
 
     def _read_alternate_paths(self):
@@ -463,7 +1100,8 @@ class DiskObjectStore(PackBasedObjectStore):
 
         if not os.path.isabs(path):
             path = os.path.join(self.path, path)
-        self.alternates.append(DiskObjectStore(path))
+        self.alternates.append(DiskObjectStore(path, use_mmap=self.use_mmap))
+        self._objects_added()
 
     def _update_pack_cache(self):
         try:
@@ -483,12 +1121,65 @@ class DiskObjectStore(PackBasedObjectStore):
                 pack_files.add(name[:-len(".pack")])
 
         # Open newly appeared pack files
+        new_packs = []
         for f in pack_files:
             if f not in self._pack_cache:
-                self._pack_cache[f] = Pack(os.path.join(self.pack_dir, f))
+                pack = self._pack_cache[f] = self._open_pack(
+                    os.path.join(self.pack_dir, f))
+                new_packs.append(pack)
+        if new_packs:
+            self._objects_added(new_packs)
         # Remove disappeared pack files
         for f in set(self._pack_cache) - pack_files:
             self._pack_cache.pop(f).close()
+        self._load_multi_pack_index()
+
+    def _open_pack(self, basename):
+        return Pack(basename, use_mmap=self.use_mmap)
+
+    def _load_multi_pack_index(self):
+        if self._midx is not None:
+            self._midx.close()
+        self._midx = None
+        self._midx_packs = ()
+        try:
+            self._midx = load_multi_pack_index(
+                os.path.join(self.pack_dir, MIDX_FILENAME))
+        except (OSError, IOError) as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        self._midx_packs = [self._pack_cache.get(name[:-len(".idx")])
+                            for name in self._midx.pack_names]
+
+    def write_multi_pack_index(self):
+        """Write a multi-pack index covering all packs in this store.
+
+        :return: SHA1 of the written multi-pack index
+        """
+        return self._write_multi_pack_index(self.packs)
+
+    def _write_multi_pack_index(self, pack_list):
+        packs = []
+        try:
+            for pack in pack_list:
+                name = os.path.basename(pack._basename)
+                # Keep every index open while they are all in use, even if
+                # there are more than the file pool allows.
+                packs.append((pack, os.stat(pack._basename + ".pack").st_mtime,
+                              name + ".idx", pack._acquire('index')))
+            # Prefer the most recent pack for objects that are in several
+            # packs
+            packs.sort(key=lambda entry: entry[1], reverse=True)
+            with GitFile(os.path.join(self.pack_dir, MIDX_FILENAME),
+                         'wb') as f:
+                sha = write_multi_pack_index(
+                    f, [(name, index) for (pack, mtime, name, index) in packs])
+        finally:
+            for pack, mtime, name, index in packs:
+                pack._release(index)
+        self._load_multi_pack_index()
+        return sha
 
     def _pack_cache_stale(self):
         try:
@@ -518,6 +1209,16 @@ class DiskObjectStore(PackBasedObjectStore):
                 return None
             raise
 
+    def _get_loose_object_info(self, sha):
+        path = self._get_shafile_path(sha)
+        try:
+            with GitFile(path, 'rb') as f:
+                return ShaFile.read_header(f)
+        except (OSError, IOError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
     def _remove_loose_object(self, sha):
         os.remove(self._get_shafile_path(sha))
 
@@ -527,6 +1228,18 @@ class DiskObjectStore(PackBasedObjectStore):
         suffix = suffix.decode('ascii')
         return os.path.join(self.pack_dir, "pack-" + suffix)
 
+    def _write_pack_index(self, basename, entries, pack_checksum):
+        """Write the index and reverse index of a pack.
+
+        :param basename: Base name of the pack
+        :param entries: Sorted list of (sha, offset, crc32) tuples
+        :param pack_checksum: Checksum of the pack data
+        """
+        with GitFile(basename + ".rev", "wb") as f:
+            write_pack_rev(f, entries, pack_checksum)
+        with GitFile(basename + ".idx", "wb") as f:
+            write_pack_index_v2(f, entries, pack_checksum)
+
     def _complete_thin_pack(self, f, path, copier, indexer):
         """Move a specific file containing a pack into the pack directory.
 
@@ -540,9 +1253,40 @@ class DiskObjectStore(PackBasedObjectStore):
         """
         entries = list(indexer)
 
+        if not indexer.ext_refs():
+            # The pack is complete already, and the copier has verified its
+            # checksum; there is no need to read it again.
+            pack_sha = copier.sha.digest()
+        else:
+            pack_sha = self._add_ext_refs(f, entries, indexer.ext_refs())
+        f.close()
+
+        # Move the pack in.
+        entries.sort()
+        pack_base_name = self._get_pack_basepath(entries)
+        os.rename(path, pack_base_name + '.pack')
+
+        # Write the index.
+        self._write_pack_index(pack_base_name, entries, pack_sha)
+
+        # Add the pack to the store and return it.
+        final_pack = self._open_pack(pack_base_name)
+        final_pack.check_length_and_checksum()
+        self._add_known_pack(pack_base_name, final_pack)
+        return final_pack
+
+    def _add_ext_refs(self, f, entries, ext_refs):
+        """Add the external bases of the deltas in a thin pack to it.
+
+        :param f: Open file object for the pack
+        :param entries: List of index entries for the pack, which is extended
+            with the entries for the added objects
+        :param ext_refs: Binary SHA1s of the objects to add
+        :return: New checksum of the pack
+        """
         # Update the header with the new number of objects.
         f.seek(0)
-        write_pack_header(f, len(entries) + len(indexer.ext_refs()))
+        write_pack_header(f, len(entries) + len(ext_refs))
 
         # Must flush before reading (http://bugs.python.org/issue3207)
         f.flush()
@@ -554,7 +1298,7 @@ class DiskObjectStore(PackBasedObjectStore):
         f.seek(0, os.SEEK_CUR)
 
         # Complete the pack.
-        for ext_sha in indexer.ext_refs():
+        for ext_sha in ext_refs:
             assert len(ext_sha) == 20
             type_num, data = self.get_raw(ext_sha)
             offset = f.tell()
@@ -562,26 +1306,7 @@ class DiskObjectStore(PackBasedObjectStore):
             entries.append((ext_sha, offset, crc32))
         pack_sha = new_sha.digest()
         f.write(pack_sha)
-        f.close()
-
-        # Move the pack in.
-        entries.sort()
-        pack_base_name = self._get_pack_basepath(entries)
-        os.rename(path, pack_base_name + '.pack')
-
-        # Write the index.
-        index_file = GitFile(pack_base_name + '.idx', 'wb')
-        try:
-            write_pack_index_v2(index_file, entries, pack_sha)
-            index_file.close()
-        finally:
-            index_file.abort()
-
-        # Add the pack to the store and return it.
-        final_pack = Pack(pack_base_name)
-        final_pack.check_length_and_checksum()
-        self._add_known_pack(pack_base_name, final_pack)
-        return final_pack
+        return pack_sha
 
     def add_thin_pack(self, read_all, read_some):
         """Add a new thin pack to this object store.
@@ -599,7 +1324,8 @@ class DiskObjectStore(PackBasedObjectStore):
         """
         fd, path = tempfile.mkstemp(dir=self.path, prefix='tmp_pack_')
         with os.fdopen(fd, 'w+b') as f:
-            indexer = PackIndexer(f, resolve_ext_ref=self.get_raw)
+            indexer = PackIndexer(f, resolve_ext_ref=self.get_raw,
+                                  threads=self.index_threads)
             copier = PackStreamCopier(read_all, read_some, f,
                                       delta_iter=indexer)
             copier.verify()
@@ -614,24 +1340,23 @@ class DiskObjectStore(PackBasedObjectStore):
         :param path: Path to the pack file.
         """
         with PackData(path) as p:
-            entries = p.sorted_entries()
+            entries = p.sorted_entries(threads=self.index_threads)
             basename = self._get_pack_basepath(entries)
-            with GitFile(basename+".idx", "wb") as f:
-                write_pack_index_v2(f, entries, p.get_stored_checksum())
+            self._write_pack_index(basename, entries, p.get_stored_checksum())
         os.rename(path, basename + ".pack")
-        final_pack = Pack(basename)
+        final_pack = self._open_pack(basename)
         self._add_known_pack(basename, final_pack)
         return final_pack
 
     def add_pack(self):
         """Add a new pack to this object store.
 
-        :return: Fileobject to write to, a commit function to
-            call when the pack is finished and an abort
+        :return: Fileobject to write to, which can also be read and seeked,
+            a commit function to call when the pack is finished and an abort
             function.
         """
         fd, path = tempfile.mkstemp(dir=self.pack_dir, suffix=".pack")
-        f = os.fdopen(fd, 'wb')
+        f = os.fdopen(fd, 'w+b')
         def commit():
             os.fsync(fd)
             f.close()
@@ -661,6 +1386,214 @@ class DiskObjectStore(PackBasedObjectStore):
             return # Already there, no need to write again
         with GitFile(path, 'wb') as f:
             f.write(obj.as_legacy_object())
+        self._objects_added()
+
+    def repack(self, geometric_factor=None, reachable=None, expire=None,
+               bitmap_commits=None):
+        """Consolidate packs and loose objects into a single new pack.
+
+        Packed objects are copied verbatim, and deltas are reused if their
+        base ends up in the same pack. Packs with a .keep file are left
+        alone, and the objects in them are not copied.
+
+        :param geometric_factor: If set, only merge as many packs as needed
+            for the remaining packs to form a geometric progression of
+            object counts with this factor, like git repack --geometric.
+            Otherwise all packs are merged.
+        :param reachable: Optional iterable of (sha, path) tuples of the
+            reachable objects, in the order in which they were found (see
+            find_missing_objects). Unreachable objects are dropped if they
+            are older than expire; more recent ones are kept as loose
+            objects. Can not be combined with geometric_factor.
+        :param expire: Time in seconds since the epoch before which
+            unreachable objects expire; None to drop them all
+        :param bitmap_commits: Optional iterable of hex SHA1s of commits to
+            write reachability bitmaps for, like git repack -b. Only used
+            for a full repack, and only if everything reachable from these
+            commits ends up in the new pack.
+        :return: The new Pack, or None if there was nothing to repack
+        """
+        if geometric_factor is not None and reachable is not None:
+            raise ValueError(
+                "unreachable objects can only be pruned by a full repack")
+        packs = []
+        kept = []
+        for pack in self.packs:
+            if os.path.exists(pack._basename + ".keep"):
+                kept.append(pack)
+            else:
+                packs.append(pack)
+        if geometric_factor is not None:
+            packs = _split_pack_geometry(packs, geometric_factor)
+        loose = []
+        loose_in_kept = []
+        for sha in self._iter_loose_objects():
+            if any(sha in pack for pack in kept):
+                loose_in_kept.append(sha)
+            else:
+                loose.append(sha)
+        if reachable is None and not loose and len(packs) <= 1:
+            return None
+
+        # Keep the order of the objects in the old packs, most recent packs
+        # first.
+        packs.sort(key=lambda pack: os.stat(pack._data_path).st_mtime,
+                   reverse=True)
+        candidates = []
+        seen = set()
+        for pack in packs:
+            for sha, offset, crc32 in sorted(pack.index.iterentries(),
+                                             key=lambda entry: entry[1]):
+                sha = sha_to_hex(sha)
+                if sha not in seen and not any(sha in kept_pack
+                                               for kept_pack in kept):
+                    seen.add(sha)
+                    candidates.append(sha)
+        for sha in loose:
+            if sha not in seen:
+                seen.add(sha)
+                candidates.append(sha)
+
+        unreachable = set()
+        if reachable is None:
+            objects = [(sha, None) for sha in candidates]
+        else:
+            objects = []
+            for sha, path in reachable:
+                if sha in seen:
+                    seen.remove(sha)
+                    objects.append((sha, path))
+            unreachable = seen
+            self._expire_unreachable(unreachable, packs, set(loose), expire)
+
+        new_basename = None
+        if objects:
+            objects = order_pack_objects(
+                objects, lambda sha: self.get_object_info(sha)[0])
+            new_basename = self._write_repacked_pack(
+                [sha for (sha, path) in objects])
+            if bitmap_commits is not None and geometric_factor is None:
+                self._write_pack_bitmap(new_basename, bitmap_commits)
+        new_pack = self._replace_packs(new_basename, packs)
+        for sha in loose + loose_in_kept:
+            if sha not in unreachable:
+                self._remove_loose_object(sha)
+        return new_pack
+
+    def _expire_unreachable(self, unreachable, packs, loose, expire):
+        """Drop expired unreachable objects, and loosen the others.
+
+        :param unreachable: Set of SHA1s of the unreachable objects
+        :param packs: Packs that are being repacked
+        :param loose: Set of SHA1s of the loose objects
+        :param expire: Time before which unreachable objects expire, or None
+        """
+        for sha in unreachable:
+            if sha in loose:
+                mtime = os.stat(self._get_shafile_path(sha)).st_mtime
+                if expire is None or mtime < expire:
+                    self._remove_loose_object(sha)
+                continue
+            mtime = max(os.stat(pack._data_path).st_mtime
+                        for pack in packs if sha in pack)
+            if expire is not None and mtime >= expire:
+                # Keep the object around as a loose object, with the age of
+                # its pack so that it still expires in time.
+                self.add_object(self[sha])
+                os.utime(self._get_shafile_path(sha), (mtime, mtime))
+
+    def _write_repacked_pack(self, shas):
+        """Write a new pack with the given objects, reusing packed objects.
+
+        :param shas: SHA1s of the objects to write, in write order
+        :return: Base name of the new pack
+        """
+        fd, path = tempfile.mkstemp(dir=self.pack_dir, suffix=".pack")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                entries, pack_sha = write_pack_data(
+                    f, len(shas), generate_pack_records(self, shas))
+                f.flush()
+                os.fsync(f.fileno())
+            entries = sorted((sha, offset, crc32) for (sha, (offset, crc32))
+                             in entries.items())
+            basename = self._get_pack_basepath(entries)
+            if os.path.exists(basename + ".pack"):
+                # Exactly these objects are in a pack already.
+                os.remove(path)
+                return basename
+            self._write_pack_index(basename, entries, pack_sha)
+            os.rename(path, basename + ".pack")
+        except:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return basename
+
+    def _write_pack_bitmap(self, basename, commits):
+        """Write a reachability bitmap for a pack.
+
+        :param basename: Base name of the pack
+        :param commits: Hex SHA1s of the commits to store bitmaps for
+        :return: Whether the bitmap was written; it isn't if not everything
+            reachable from commits is in the pack
+        """
+        with Pack(basename) as pack:
+            # The bitmap refers to the index, which must stay open until
+            # the bitmap is written.
+            index = pack._acquire('index')
+            try:
+                try:
+                    bitmap = build_pack_bitmap(pack, commits)
+                except KeyError:
+                    return False
+                with GitFile(basename + ".bitmap", 'wb') as f:
+                    write_pack_bitmap(f, bitmap)
+            finally:
+                pack._release(index)
+        return True
+
+    def _replace_packs(self, new_basename, old_packs):
+        """Replace packs with a new pack, in the pack cache and on disk.
+
+        The pack cache is swapped in one go, and the old packs are only
+        removed once the new pack and multi-pack index are in place.
+
+        :param new_basename: Base name of the new pack, or None
+        :param old_packs: Packs to remove
+        :return: The new Pack, or None
+        """
+        cache = dict(self._pack_cache)
+        new_pack = None
+        if new_basename is not None:
+            name = os.path.basename(new_basename)
+            new_pack = cache.get(name)
+            if new_pack is None:
+                new_pack = cache[name] = self._open_pack(new_basename)
+                # The new pack has the loose objects that were repacked.
+                self._objects_added([new_pack])
+        removed = []
+        for pack in old_packs:
+            if pack is new_pack or pack._basename == new_basename:
+                continue
+            for key, value in list(cache.items()):
+                if value is pack:
+                    del cache[key]
+            removed.append(pack)
+        self._pack_cache = cache
+        if os.path.exists(os.path.join(self.pack_dir, MIDX_FILENAME)):
+            # Don't go through self.packs: the old pack files are still
+            # there, so rescanning the pack directory would pick them up.
+            self._write_multi_pack_index(list(cache.values()))
+        for pack in removed:
+            pack.close()
+            for ext in (".pack", ".idx", ".rev", ".bitmap"):
+                try:
+                    os.remove(pack._basename + ext)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        return new_pack
 
     @classmethod
     def init(cls, path):
@@ -718,6 +1651,15 @@ class MemoryObjectStore(BaseObjectStore):
     def __getitem__(self, name):
         return self._data[self._to_hexsha(name)]
 
+    def get_object_info(self, name):
+        """Find the type and size of an object.
+
+        :param name: sha for the object.
+        :return: tuple with numeric type and length of the object contents.
+        """
+        obj = self[self._to_hexsha(name)]
+        return obj.type_num, obj.raw_length()
+
     def __delitem__(self, name):
         """Delete an object from this store, for testing only."""
         del self._data[self._to_hexsha(name)]
@@ -914,6 +1856,52 @@ def _collect_filetree_revs(obj_store, tree_sha, kset):
                 _collect_filetree_revs(obj_store, sha, kset)
 
 
+def _split_pack_geometry(packs, factor):
+    """Find the packs to merge for a geometric repack.
+
+    Like git repack --geometric, the packs are ordered by their number of
+    objects, and the smallest ones are merged until every pack has at least
+    factor times as many objects as the next smaller one, counting the
+    merged pack.
+
+    :param packs: List of packs
+    :param factor: Geometric factor
+    :return: List of the packs to merge
+    """
+    packs = sorted(packs, key=len)
+    split = 0
+    for i in range(len(packs) - 1, 0, -1):
+        if len(packs[i]) < factor * len(packs[i - 1]):
+            # packs[i] is too small compared to packs[i - 1], so both have
+            # to be merged.
+            split = i + 1
+            break
+    total = sum(len(pack) for pack in packs[:split])
+    while split < len(packs) and len(packs[split]) < factor * total:
+        total += len(packs[split])
+        split += 1
+    return packs[:split]
+
+
+def _initial_objects_to_send(obj_store, commits, others):
+    """Create the initial stack of objects to send for MissingObjectFinder.
+
+    Commits are popped newest first, and the trees and blobs of each commit
+    are found before the next commit is popped, so objects are found in
+    roughly the order in which git finds them.
+
+    :param obj_store: Object store to get commit times from
+    :param commits: Set of SHA1s of the commits to send
+    :param others: Set of SHA1s of the other objects to send
+    :return: List of (sha, name, leaf) tuples
+    """
+    todo = [(sha, None, False) for sha in sorted(others)]
+    commits = sorted(
+        commits, key=lambda sha: (obj_store.get_commit_time(sha), sha))
+    todo.extend((sha, None, False) for sha in commits)
+    return todo
+
+
 def _split_commits_and_tags(obj_store, lst, ignore_unknown=False):
     """Split object id list into three lists with commit, tag, and other SHAs.
 
@@ -931,6 +1919,8 @@ def _split_commits_and_tags(obj_store, lst, ignore_unknown=False):
     commits = set()
     tags = set()
     others = set()
+    if ignore_unknown:
+        lst = obj_store.contains_many(lst)
     for e in lst:
         try:
             o = obj_store[e]
@@ -968,7 +1958,7 @@ class MissingObjectFinder(object):
     """
 
     def __init__(self, object_store, haves, wants, progress=None,
-                 get_tagged=None, get_parents=lambda commit: commit.parents):
+                 get_tagged=None, get_parents=None):
         self.object_store = object_store
         self._get_parents = get_parents
         # process Commits and Tags differently
@@ -1006,10 +1996,9 @@ class MissingObjectFinder(object):
         missing_others = want_others.difference(have_others)
         # in fact, what we 'want' is commits, tags, and others
         # we've found missing
-        wants = missing_commits.union(missing_tags)
-        wants = wants.union(missing_others)
-
-        self.objects_to_send = set([(w, None, False) for w in wants])
+        self.objects_to_send = _initial_objects_to_send(
+            object_store, missing_commits,
+            missing_tags.union(missing_others))
 
         if progress is None:
             self.progress = lambda x: None
@@ -1018,8 +2007,10 @@ class MissingObjectFinder(object):
         self._tagged = get_tagged and get_tagged() or {}
 
     def add_todo(self, entries):
-        self.objects_to_send.update([e for e in entries
-                                     if not e[0] in self.sha_done])
+        # objects_to_send is a stack; push the entries in reverse, so that
+        # they are popped in order.
+        self.objects_to_send.extend(reversed([e for e in entries
+                                              if not e[0] in self.sha_done]))
 
     def next(self):
         while True:
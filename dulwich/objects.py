@@ -391,6 +391,46 @@ class ShaFile(object):
         except (IndexError, ValueError):
             raise ObjectFormatException("invalid object header")
 
+    @classmethod
+    def read_header(cls, f):
+        """Read the type and size of a SHA file on disk.
+
+        Only as much of the file is read and decompressed as is needed for
+        the header.
+
+        :param f: File-like object to read from
+        :return: Tuple with numeric type and length of the object contents
+        :raise ObjectFormatException: if the header is invalid
+        """
+        bufsize = 64
+        data = f.read(bufsize)
+        try:
+            if cls._is_legacy_object(data):
+                decomp = zlib.decompressobj()
+                header = decomp.decompress(data)
+                while b'\0' not in header:
+                    data = f.read(bufsize)
+                    if not data:
+                        raise ValueError
+                    header += decomp.decompress(data)
+                type_name, size = header[:header.index(b'\0')].split(b' ', 1)
+                obj_class = object_class(type_name)
+                size = int(size)
+            else:
+                byte = ord(data[0:1])
+                obj_class = object_class((byte >> 4) & 7)
+                size = byte & 0x0f
+                used = 1
+                while byte & 0x80:
+                    byte = ord(data[used:used+1])
+                    size += (byte & 0x7f) << ((used - 1) * 7 + 4)
+                    used += 1
+        except (IndexError, TypeError, ValueError, zlib.error):
+            raise ObjectFormatException("invalid object header")
+        if not obj_class:
+            raise ObjectFormatException("Not a known type")
+        return obj_class.type_num, size
+
     @staticmethod
     def from_raw_string(type_num, string, sha=None):
         """Creates an object of the indicated type from the raw string given.
@@ -30,14 +30,20 @@ match for the object name. You then use the pointer got from this as
 a pointer in to the corresponding packfile.
 """
 
+from array import array
 from collections import defaultdict
 
 import binascii
+import errno
 from io import BytesIO, UnsupportedOperation
 from collections import (
     deque,
     )
-import difflib
+from contextlib import contextmanager
+try:
+    from collections import OrderedDict
+except ImportError:
+    from dulwich._compat import OrderedDict
 import struct
 
 from itertools import chain
@@ -50,6 +56,9 @@ except ImportError:
 
 import os
 import sys
+import tempfile
+import threading
+import weakref
 
 try:
     import mmap
@@ -62,9 +71,15 @@ else:
 if sys.platform == 'Plan9':
     has_mmap = False
 
+if sys.version_info[0] == 2:
+    def _buffer(obj, offset, size):
+        return buffer(obj, offset, size)
+else:
+    def _buffer(obj, offset, size):
+        return memoryview(obj)[offset:offset+size]
+
 from hashlib import sha1
 from os import (
-    SEEK_CUR,
     SEEK_END,
     )
 from struct import unpack_from
@@ -76,10 +91,15 @@ from dulwich.errors import (
     )
 from dulwich.file import GitFile
 from dulwich.lru_cache import (
+    LRUCache,
     LRUSizeCache,
     )
 from dulwich.objects import (
+    Blob,
+    Commit,
     ShaFile,
+    Tag,
+    Tree,
     hex_to_sha,
     sha_to_hex,
     object_header,
@@ -94,6 +114,43 @@ DELTA_TYPES = (OFS_DELTA, REF_DELTA)
 
 DEFAULT_PACK_DELTA_WINDOW_SIZE = 10
 
+# Default maximum length of the delta chains made by deltify_pack_objects,
+# like git's pack.depth.
+DEFAULT_PACK_DELTA_MAX_DEPTH = 50
+
+# Default zlib compression level for pack objects, like git's
+# pack.compression. -1 is the zlib default.
+DEFAULT_PACK_COMPRESSION_LEVEL = -1
+
+# Number of objects per thread that are compressed ahead of the one being
+# written by write_pack_data.
+_COMPRESS_OBJECTS_IN_FLIGHT = 4
+
+# Amount of pack data that write_pack_data keeps in memory when it has to
+# spool a pack whose number of objects isn't known in advance, before the
+# spool spills to a temporary file.
+DEFAULT_PACK_SPOOL_SIZE = 16 * 1024 * 1024
+
+# Size of the header at the start of a pack file.
+PACK_HEADER_SIZE = 12
+
+# Defaults for memory-mapped pack access, like git's core.packedGitWindowSize
+# and core.packedGitLimit.
+DEFAULT_PACKED_GIT_WINDOW_SIZE = 32 * 1024 * 1024
+DEFAULT_PACKED_GIT_LIMIT = 256 * 1024 * 1024
+
+# Default maximum size of the resolved delta bases kept around for a pack,
+# like git's core.deltaBaseCacheLimit.
+DEFAULT_DELTA_BASE_CACHE_LIMIT = 20 * 1024 * 1024
+
+# Default maximum number of pack data and index files that are kept open by
+# all packs in the process together.
+DEFAULT_MAX_OPEN_PACK_FILES = 256
+
+# Signature and version of pack reverse index (.rev) files.
+RIDX_SIGNATURE = b'RIDX'
+RIDX_VERSION = 1
+
 
 def take_msb_bytes(read, crc32=None):
     """Read bytes marked with most significant bit.
@@ -264,14 +321,24 @@ def iter_sha1(iter):
     return sha.hexdigest().encode('ascii')
 
 
-def load_pack_index(path):
+def load_pack_index(path, shared_maps=None):
     """Load an index file by path.
 
+    Only the header and fan-out table are read; the rest of the file is
+    mapped the first time it is needed.
+
     :param filename: Path to the index file
+    :param shared_maps: Optional `SharedIndexMaps` to share the map of the
+        file with other indexes opened on it
     :return: A PackIndex loaded from the given path
     """
-    with GitFile(path, 'rb') as f:
-        return load_pack_index_file(path, f)
+    f = GitFile(path, 'rb')
+    try:
+        cls = _pack_index_class(f.read(8))
+        return cls(path, file=f, shared_maps=shared_maps)
+    except:
+        f.close()
+        raise
 
 
 def _load_file_contents(f, size=None):
@@ -304,15 +371,73 @@ def load_pack_index_file(path, f):
     :return: A PackIndex loaded from the given file
     """
     contents, size = _load_file_contents(f)
-    if contents[:4] == b'\377tOc':
-        version = struct.unpack(b'>L', contents[4:8])[0]
+    cls = _pack_index_class(contents[:8])
+    return cls(path, file=f, contents=contents, size=size)
+
+
+def _pack_index_class(header):
+    """Determine the pack index class from the first 8 bytes of a file."""
+    if header[:4] == b'\377tOc':
+        version = struct.unpack(b'>L', header[4:8])[0]
         if version == 2:
-            return PackIndex2(path, file=f, contents=contents,
-                size=size)
+            return PackIndex2
         else:
             raise KeyError('Unknown pack index format %d' % version)
     else:
-        return PackIndex1(path, file=f, contents=contents, size=size)
+        return PackIndex1
+
+
+class _SharedIndexMap(object):
+    """The contents of a pack index file, as shared between indexes."""
+
+    def __init__(self, contents, size):
+        self.contents = contents
+        self.size = size
+
+
+class SharedIndexMaps(object):
+    """Maps of pack index files, shared by the indexes opened on them.
+
+    Index files are never modified once written, so every index opened on
+    the same file (e.g. by the repository objects a server creates for each
+    request) can use a single map of it. A map is released once the last
+    index using it is closed or garbage collected.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._maps = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self._maps)
+
+    def get(self, f):
+        """Get the shared map for an open index file.
+
+        :param f: File-like object for the index file
+        :return: A `_SharedIndexMap`, or None if the file can not be shared
+        """
+        try:
+            st = os.fstat(f.fileno())
+        except (UnsupportedOperation, AttributeError):
+            return None
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        with self._lock:
+            shared = self._maps.get(key)
+            if shared is None:
+                shared = _SharedIndexMap(*_load_file_contents(f, st.st_size))
+                self._maps[key] = shared
+        return shared
+
+
+def _bit_length(n):
+    """Return the number of bits needed to represent a non-negative integer.
+
+    Equivalent to n.bit_length(), which is not available on Python 2.6.
+    """
+    if not n:
+        return 0
+    return len(bin(n)) - 2
 
 
 def bisect_find_sha(start, end, sha, unpack_name):
@@ -398,6 +523,60 @@ class PackIndex(object):
         """
         raise NotImplementedError(self._object_index)
 
+    def object_indexes(self, shas):
+        """Return the offsets of several objects in the packfile at once.
+
+        :param shas: Iterable of binary or hex SHA1s
+        :return: Dictionary mapping the SHA1s of the objects that are in the
+            index, as they were passed in, to their offsets
+        """
+        ret = {}
+        for sha in shas:
+            try:
+                ret[sha] = self.object_index(sha)
+            except KeyError:
+                pass
+        return ret
+
+    def contains_many(self, shas):
+        """Check which of several objects are in the index.
+
+        :param shas: Iterable of binary or hex SHA1s
+        :return: Set of the SHA1s that are in the index, as they were passed in
+        """
+        return set(self.object_indexes(shas))
+
+    def object_crc32(self, sha):
+        """Return the CRC32 stored for an object.
+
+        :return: CRC32 checksum of the packed object, or None if the index
+            does not store checksums.
+        :raise KeyError: if the object is not in the index
+        """
+        if len(sha) == 40:
+            sha = hex_to_sha(sha)
+        return self._object_crc32(sha)
+
+    def _object_crc32(self, sha):
+        """See object_crc32.
+
+        :param sha: A *binary* SHA string. (20 characters long)_
+        """
+        raise NotImplementedError(self._object_crc32)
+
+    # Lazily built map from pack offset to binary SHA.
+    _offset_map = None
+
+    def object_sha1(self, offset):
+        """Return the binary SHA1 of the object at an offset in the pack.
+
+        :raise KeyError: if there is no object at offset
+        """
+        if self._offset_map is None:
+            self._offset_map = dict(
+                (offset, name) for (name, offset, crc32) in self.iterentries())
+        return self._offset_map[offset]
+
     def objects_sha1(self):
         """Return the hex SHA1 over all the shas of all objects in this pack.
 
@@ -421,7 +600,7 @@ class MemoryPackIndex(PackIndex):
         """
         self._by_sha = {}
         for name, idx, crc32 in entries:
-            self._by_sha[name] = idx
+            self._by_sha[name] = (idx, crc32)
         self._entries = entries
         self._pack_checksum = pack_checksum
 
@@ -434,6 +613,15 @@ class MemoryPackIndex(PackIndex):
     def _object_index(self, sha):
         return self._by_sha[sha][0]
 
+    def _unpack_name(self, i):
+        return self._entries[i][0]
+
+    def _unpack_offset(self, i):
+        return self._entries[i][1]
+
+    def _object_crc32(self, sha):
+        return self._by_sha[sha][1]
+
     def _itersha(self):
         return iter(self._by_sha)
 
@@ -452,11 +640,16 @@ class FilePackIndex(PackIndex):
     the start and end offset and then bisect in to find if the value is present.
     """
 
-    def __init__(self, filename, file=None, contents=None, size=None):
+    def __init__(self, filename, file=None, contents=None, size=None,
+                 shared_maps=None):
         """Create a pack index object.
 
         Provide it with the name of the index file to consider, and it will map
         it whenever required.
+
+        When no contents are given, only the header and fan-out table are read
+        up front; the name, offset and CRC32 tables are mapped on first use,
+        optionally through shared_maps.
         """
         self._filename = filename
         # Take the size now, so it can be checked each time we map the file to
@@ -465,10 +658,56 @@ class FilePackIndex(PackIndex):
             self._file = GitFile(filename, 'rb')
         else:
             self._file = file
-        if contents is None:
-            self._contents, self._size = _load_file_contents(self._file, size)
-        else:
-            self._contents, self._size = (contents, size)
+        self._size = size
+        self._shared_maps = shared_maps
+        self._shared_map = None
+        # Guards the file until it is mapped; indexes are shared between
+        # threads, e.g. by the object store of a server.
+        self._lock = threading.Lock()
+        if contents is not None:
+            self._contents = contents
+
+    def __getattr__(self, name):
+        # Map the file the first time its contents are needed; from then on
+        # _contents is a plain attribute.
+        if name != '_contents':
+            raise AttributeError(name)
+        with self._lock:
+            contents = self.__dict__.get('_contents')
+            if contents is not None:
+                # Mapped by another thread in the meantime
+                return contents
+            shared = None
+            if self._shared_maps is not None:
+                shared = self._shared_maps.get(self._file)
+            if shared is not None:
+                self._shared_map = shared
+                contents, self._size = shared.contents, shared.size
+            else:
+                self._file.seek(0)
+                contents, self._size = _load_file_contents(
+                    self._file, self._size)
+            self._file.close()
+            self._contents = contents
+            return contents
+
+    def _read_header(self, size):
+        """Read the start of the index file, without mapping the rest."""
+        with self._lock:
+            contents = self.__dict__.get('_contents')
+            if contents is not None:
+                return contents[:size]
+            self._file.seek(0)
+            return self._file.read(size)
+
+    def _read_trailer(self):
+        """Read the pack and index checksums at the end of the index file."""
+        with self._lock:
+            contents = self.__dict__.get('_contents')
+            if contents is not None:
+                return bytes(contents[-40:])
+            self._file.seek(-40, os.SEEK_END)
+            return self._file.read(40)
 
     def __eq__(self, other):
         # Quick optimization:
@@ -479,9 +718,14 @@ class FilePackIndex(PackIndex):
         return super(FilePackIndex, self).__eq__(other)
 
     def close(self):
-        self._file.close()
-        if getattr(self._contents, "close", None) is not None:
-            self._contents.close()
+        with self._lock:
+            self._file.close()
+            contents = self.__dict__.pop('_contents', None)
+        if self._shared_map is not None:
+            # Other indexes may still be using the map.
+            self._shared_map = None
+        elif getattr(contents, "close", None) is not None:
+            contents.close()
 
     def __len__(self):
         """Return the number of entries in this pack index."""
@@ -520,12 +764,10 @@ class FilePackIndex(PackIndex):
         for i in range(len(self)):
             yield self._unpack_entry(i)
 
-    def _read_fan_out_table(self, start_offset):
-        ret = []
-        for i in range(0x100):
-            fanout_entry = self._contents[start_offset+i*4:start_offset+(i+1)*4]
-            ret.append(struct.unpack('>L', fanout_entry)[0])
-        return ret
+    def _read_fan_out_table(self, start_offset, header=None):
+        if header is None:
+            header = self._read_header(start_offset + 0x100 * 4)
+        return list(struct.unpack_from('>256L', header, start_offset))
 
     def check(self):
         """Check that the stored checksum matches the actual checksum."""
@@ -546,19 +788,20 @@ class FilePackIndex(PackIndex):
 
         :return: 20-byte binary digest
         """
-        return bytes(self._contents[-40:-20])
+        return self._read_trailer()[:20]
 
     def get_stored_checksum(self):
         """Return the SHA1 checksum stored for this index.
 
         :return: 20-byte binary digest
         """
-        return bytes(self._contents[-20:])
+        return self._read_trailer()[20:]
 
-    def _object_index(self, sha):
-        """See object_index.
+    def _object_position(self, sha):
+        """Find the position of an object in the index.
 
         :param sha: A *binary* SHA string. (20 characters long)_
+        :raise KeyError: if the object is not in the index
         """
         assert len(sha) == 20
         idx = ord(sha[:1])
@@ -567,17 +810,103 @@ class FilePackIndex(PackIndex):
         else:
             start = self._fan_out_table[idx-1]
         end = self._fan_out_table[idx]
+        if start == end:
+            # No names with this first byte; don't touch the name table.
+            raise KeyError(sha)
         i = bisect_find_sha(start, end, sha, self._unpack_name)
         if i is None:
             raise KeyError(sha)
-        return self._unpack_offset(i)
+        return i
+
+    def _object_index(self, sha):
+        """See object_index.
+
+        :param sha: A *binary* SHA string. (20 characters long)_
+        """
+        return self._unpack_offset(self._object_position(sha))
+
+    def _object_positions(self, shas):
+        """Find the positions of several objects in the index.
+
+        The SHAs are sorted and looked up one fan-out group at a time. If a
+        group has many SHAs to look up, all of its names are read at once;
+        otherwise each SHA is searched for from where the previous one was
+        found.
+
+        :param shas: Iterable of binary or hex SHA1s
+        :return: Iterator over tuples with the SHA1 as it was passed in and
+            the position of the object, for the objects that are in the index
+        """
+        queries = sorted(
+            (hex_to_sha(sha) if len(sha) == 40 else sha, sha) for sha in shas)
+        fan_out_table = self._fan_out_table
+        i = 0
+        while i < len(queries):
+            group = ord(queries[i][0][:1])
+            j = i + 1
+            while j < len(queries) and ord(queries[j][0][:1]) == group:
+                j += 1
+            if group == 0:
+                start = 0
+            else:
+                start = fan_out_table[group-1]
+            end = fan_out_table[group]
+            size = end - start
+            if size == 0:
+                pass
+            elif (j - i) * _bit_length(size) * 3 >= size:
+                positions = dict(zip(self._unpack_names(start, end),
+                                     range(start, end)))
+                for sha, key in queries[i:j]:
+                    position = positions.get(sha)
+                    if position is not None:
+                        yield key, position
+            else:
+                for sha, key in queries[i:j]:
+                    position = bisect_find_sha(
+                        start, end - 1, sha, self._unpack_name)
+                    if position is not None:
+                        yield key, position
+                        start = min(position + 1, end - 1)
+            i = j
+
+    def _unpack_names(self, start, end):
+        """Unpack the names from position start up to end."""
+        return [self._unpack_name(i) for i in range(start, end)]
+
+    def object_indexes(self, shas):
+        """Return the offsets of several objects in the packfile at once.
+
+        :param shas: Iterable of binary or hex SHA1s
+        :return: Dictionary mapping the SHA1s of the objects that are in the
+            index, as they were passed in, to their offsets
+        """
+        return dict((key, self._unpack_offset(position))
+                    for (key, position) in self._object_positions(shas))
+
+    def contains_many(self, shas):
+        """Check which of several objects are in the index.
+
+        :param shas: Iterable of binary or hex SHA1s
+        :return: Set of the SHA1s that are in the index, as they were passed in
+        """
+        return set(key for (key, position) in self._object_positions(shas))
+
+    def _object_crc32(self, sha):
+        """See object_crc32.
+
+        :param sha: A *binary* SHA string. (20 characters long)_
+        """
+        return self._unpack_crc32_checksum(self._object_position(sha))
 
 
 class PackIndex1(FilePackIndex):
     """Version 1 Pack Index file."""
 
-    def __init__(self, filename, file=None, contents=None, size=None):
-        super(PackIndex1, self).__init__(filename, file, contents, size)
+    def __init__(self, filename, file=None, contents=None, size=None,
+                 shared_maps=None):
+        super(PackIndex1, self).__init__(filename, file, contents, size,
+                                         shared_maps)
         self.version = 1
         self._fan_out_table = self._read_fan_out_table(0)
 
@@ -602,14 +931,17 @@ class PackIndex1(FilePackIndex):
 class PackIndex2(FilePackIndex):
     """Version 2 Pack Index file."""
 
-    def __init__(self, filename, file=None, contents=None, size=None):
-        super(PackIndex2, self).__init__(filename, file, contents, size)
-        if self._contents[:4] != b'\377tOc':
+    def __init__(self, filename, file=None, contents=None, size=None,
+                 shared_maps=None):
+        super(PackIndex2, self).__init__(filename, file, contents, size,
+                                         shared_maps)
+        header = self._read_header(8 + 0x100 * 4)
+        if header[:4] != b'\377tOc':
             raise AssertionError('Not a v2 pack index file')
-        (self.version, ) = unpack_from(b'>L', self._contents, 4)
+        (self.version, ) = unpack_from(b'>L', header, 4)
         if self.version != 2:
             raise AssertionError('Version was %d' % self.version)
-        self._fan_out_table = self._read_fan_out_table(8)
+        self._fan_out_table = self._read_fan_out_table(8, header)
         self._name_table_offset = 8 + 0x100 * 4
         self._crc32_table_offset = self._name_table_offset + 20 * len(self)
         self._pack_offset_table_offset = (self._crc32_table_offset +
@@ -625,6 +957,11 @@ class PackIndex2(FilePackIndex):
         offset = self._name_table_offset + i * 20
         return self._contents[offset:offset+20]
 
+    def _unpack_names(self, start, end):
+        names = self._contents[self._name_table_offset + start * 20:
+                               self._name_table_offset + end * 20]
+        return [names[i:i+20] for i in range(0, len(names), 20)]
+
     def _unpack_offset(self, i):
         offset = self._pack_offset_table_offset + i * 4
         offset = unpack_from('>L', self._contents, offset)[0]
@@ -638,6 +975,124 @@ class PackIndex2(FilePackIndex):
                           self._crc32_table_offset + i * 4)[0]
 
 
+class PackReverseIndex(object):
+    """Reverse index of a pack, listing its objects in pack order.
+
+    For each object, in order of offset, this has the position of its entry
+    in the pack index, so that objects can be found by offset.
+    """
+
+    def __init__(self, index, positions):
+        """Create a new PackReverseIndex.
+
+        :param index: PackIndex of the pack
+        :param positions: array with the positions in the index of the
+            objects, in pack order
+        """
+        self.index = index
+        self._positions = positions
+
+    @classmethod
+    def from_index(cls, index):
+        """Create a reverse index from a pack index, by sorting it."""
+        return cls(index, array('I', sorted(range(len(index)),
+                                            key=index._unpack_offset)))
+
+    def __len__(self):
+        return len(self._positions)
+
+    def offset(self, i):
+        """Return the offset of the i-th object in pack order."""
+        return self.index._unpack_offset(self._positions[i])
+
+    def sha(self, i):
+        """Return the binary SHA1 of the i-th object in pack order."""
+        return self.index._unpack_name(self._positions[i])
+
+    def index_position(self, i):
+        """Return the position in the index of the i-th object in pack order.
+        """
+        return self._positions[i]
+
+    def pack_position(self, offset):
+        """Find the position in pack order of the object at an offset.
+
+        :raise KeyError: if no object starts at offset
+        """
+        start = 0
+        end = len(self._positions) - 1
+        while start <= end:
+            i = (start + end) // 2
+            found = self.offset(i)
+            if found < offset:
+                start = i + 1
+            elif found > offset:
+                end = i - 1
+            else:
+                return i
+        raise KeyError(offset)
+
+
+def write_pack_rev(f, entries, pack_checksum):
+    """Write a pack reverse index file.
+
+    :param f: File-like object to write to
+    :param entries: List of tuples with object name (sha), offset_in_pack, and
+        crc32_checksum, sorted by name as in the pack index
+    :param pack_checksum: Checksum of the pack file.
+    :return: The SHA of the reverse index file written
+    """
+    f = SHA1Writer(f)
+    f.write(RIDX_SIGNATURE)
+    # Version and hash function (1 for SHA1)
+    f.write(struct.pack(b'>LL', RIDX_VERSION, 1))
+    for i in sorted(range(len(entries)), key=lambda i: entries[i][1]):
+        f.write(struct.pack(b'>L', i))
+    assert len(pack_checksum) == 20
+    f.write(pack_checksum)
+    return f.write_sha()
+
+
+def read_pack_rev(f, index):
+    """Read a pack reverse index from a file-like object.
+
+    :param f: File-like object to read from
+    :param index: PackIndex of the pack the reverse index is for
+    :return: A PackReverseIndex
+    """
+    contents = f.read()
+    if contents[:4] != RIDX_SIGNATURE:
+        raise AssertionError('Not a pack reverse index file')
+    version, hash_id = struct.unpack_from(b'>LL', contents, 4)
+    if version != RIDX_VERSION:
+        raise AssertionError('Version was %d' % version)
+    if hash_id != 1:
+        raise AssertionError('Unsupported hash function %d' % hash_id)
+    end = 12 + 4 * len(index)
+    if len(contents) != end + 40:
+        raise AssertionError('Reverse index has wrong size %d' % len(contents))
+    pack_checksum = contents[end:end+20]
+    if pack_checksum != index.get_pack_checksum():
+        raise ChecksumMismatch(sha_to_hex(index.get_pack_checksum()),
+                               sha_to_hex(pack_checksum))
+    positions = array('I', contents[12:end])
+    assert positions.itemsize == 4
+    if sys.byteorder == 'little':
+        positions.byteswap()
+    return PackReverseIndex(index, positions)
+
+
+def load_pack_rev(path, index):
+    """Load a pack reverse index by path.
+
+    :param path: Path to the reverse index file
+    :param index: PackIndex of the pack the reverse index is for
+    :return: A PackReverseIndex
+    """
+    with GitFile(path, 'rb') as f:
+        return read_pack_rev(f, index)
+
+
 def read_pack_header(read):
     """Read the header of a pack file.
 
@@ -664,6 +1119,75 @@ def chunks_length(chunks):
         return sum(imap(len, chunks))
 
 
+def _unpack_object_header(read_all, crc32=None):
+    """Read the header of a packed object.
+
+    :return: Tuple with type number, size, delta base (offset or binary SHA1
+        for deltas, None otherwise) and the updated CRC32
+    """
+    bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
+    type_num = (bytes[0] >> 4) & 0x07
+    size = bytes[0] & 0x0f
+    for i, byte in enumerate(bytes[1:]):
+        size += (byte & 0x7f) << ((i * 7) + 4)
+
+    if type_num == OFS_DELTA:
+        bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
+        if bytes[-1] & 0x80:
+            raise AssertionError
+        delta_base_offset = bytes[0] & 0x7f
+        for byte in bytes[1:]:
+            delta_base_offset += 1
+            delta_base_offset <<= 7
+            delta_base_offset += (byte & 0x7f)
+        delta_base = delta_base_offset
+    elif type_num == REF_DELTA:
+        delta_base = read_all(20)
+        if crc32 is not None:
+            crc32 = binascii.crc32(delta_base, crc32)
+    else:
+        delta_base = None
+    return type_num, size, delta_base, crc32
+
+
+# Amount of compressed data to read at a time when looking for the sizes in
+# a delta header.
+_DELTA_HEADER_READ_SIZE = 64
+
+# Maximum length of the two sizes at the start of a delta.
+_MAX_DELTA_HEADER_LENGTH = 20
+
+
+def unpack_object_header(read_all, read_some=None):
+    """Read the header of a packed object, without inflating its contents.
+
+    For deltas, the size of the resulting object is read from the delta
+    header, which only requires inflating the first few bytes of the delta.
+
+    :param read_all: Read function that blocks until the number of requested
+        bytes are read.
+    :param read_some: Read function that returns at least one byte, but may not
+        return the number of bytes requested.
+    :return: Tuple with type number, size and delta base (offset or binary
+        SHA1 for deltas, None otherwise). For deltas, the size is that of the
+        object after applying the delta.
+    """
+    if read_some is None:
+        read_some = read_all
+    type_num, size, delta_base, _ = _unpack_object_header(read_all)
+    if type_num in DELTA_TYPES:
+        decomp = zlib.decompressobj()
+        delta = b''
+        while len(delta) < _MAX_DELTA_HEADER_LENGTH and not decomp.unused_data:
+            data = read_some(_DELTA_HEADER_READ_SIZE)
+            if not data:
+                break
+            delta += decomp.decompress(data)
+        src_size, index = _get_delta_header_size(delta, 0)
+        size, index = _get_delta_header_size(delta, index)
+    return type_num, size, delta_base
+
+
 def unpack_object(read_all, read_some=None, compute_crc32=False,
                   include_comp=False, zlib_bufsize=_ZLIB_BUFSIZE):
     """Unpack a Git object.
@@ -695,38 +1219,18 @@ def unpack_object(read_all, read_some=None, compute_crc32=False,
     else:
         crc32 = None
 
-    bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
-    type_num = (bytes[0] >> 4) & 0x07
-    size = bytes[0] & 0x0f
-    for i, byte in enumerate(bytes[1:]):
-        size += (byte & 0x7f) << ((i * 7) + 4)
-
-    raw_base = len(bytes)
-    if type_num == OFS_DELTA:
-        bytes, crc32 = take_msb_bytes(read_all, crc32=crc32)
-        raw_base += len(bytes)
-        if bytes[-1] & 0x80:
-            raise AssertionError
-        delta_base_offset = bytes[0] & 0x7f
-        for byte in bytes[1:]:
-            delta_base_offset += 1
-            delta_base_offset <<= 7
-            delta_base_offset += (byte & 0x7f)
-        delta_base = delta_base_offset
-    elif type_num == REF_DELTA:
-        delta_base = read_all(20)
-        if compute_crc32:
-            crc32 = binascii.crc32(delta_base, crc32)
-        raw_base += 20
-    else:
-        delta_base = None
-
+    type_num, size, delta_base, crc32 = _unpack_object_header(
+        read_all, crc32=crc32)
     unpacked = UnpackedObject(type_num, delta_base, size, crc32)
     unused = read_zlib_chunks(read_some, unpacked, buffer_size=zlib_bufsize,
                               include_comp=include_comp)
     return unpacked, unused
 
 
+# Maximum size of the delta bases kept around by Pack.iter_raw_at
+_BATCH_BASE_CACHE_SIZE = 16 * 1024 * 1024
+
+
 def _compute_object_size(value):
     """Compute the size of a unresolved object for use with LRUSizeCache."""
     (num, obj) = value
@@ -903,7 +1407,9 @@ class PackStreamCopier(PackStreamReader):
         throw.
         """
         if self._delta_iter:
-            for unpacked in self.read_objects():
+            compute_crc32 = (self._delta_iter._resolve_while_recording and
+                             self._delta_iter._compute_crc32)
+            for unpacked in self.read_objects(compute_crc32=compute_crc32):
                 self._delta_iter.record(unpacked)
         else:
             for _ in self.read_objects():
@@ -949,6 +1455,217 @@ def compute_file_sha(f, start_ofs=0, end_ofs=0, buffer_size=1<<16):
     return sha
 
 
+class PackWindows(object):
+    """Sliding memory-mapped windows over a pack file.
+
+    Rather than mapping a whole (possibly multi-GB) pack at once, the file is
+    mapped in aligned windows of window_size bytes, on demand. At most
+    window_limit bytes worth of windows are kept mapped; the least recently
+    used windows are unmapped first.
+    """
+
+    def __init__(self, fileno, size, window_size=None, window_limit=None):
+        """Create a new set of pack windows.
+
+        :param fileno: File descriptor of the pack file
+        :param size: Size of the pack file
+        :param window_size: Size of a single window; rounded up to the mmap
+            allocation granularity. None for the default.
+        :param window_limit: Maximum number of bytes to keep mapped at once.
+            None for the default.
+        """
+        if window_size is None:
+            window_size = DEFAULT_PACKED_GIT_WINDOW_SIZE
+        if window_limit is None:
+            window_limit = DEFAULT_PACKED_GIT_LIMIT
+        granularity = mmap.ALLOCATIONGRANULARITY
+        window_size = max(granularity,
+                          (window_size + granularity - 1) // granularity *
+                          granularity)
+        self._fileno = fileno
+        self._size = size
+        self._window_size = window_size
+        max_windows = max(1, window_limit // window_size)
+        self._windows = LRUCache(max_windows, after_cleanup_count=max_windows)
+
+    def __len__(self):
+        return self._size
+
+    def _window(self, offset):
+        """Return the (start, buffer) of the window containing offset."""
+        start = offset - (offset % self._window_size)
+        window = self._windows.get(start)
+        if window is None:
+            length = min(self._window_size, self._size - start)
+            window = mmap.mmap(self._fileno, length, access=mmap.ACCESS_READ,
+                               offset=start)
+            self._windows[start] = window
+        return start, window
+
+    def slice(self, offset, size):
+        """Return a zero-copy buffer of up to size bytes at offset.
+
+        The result is never longer than the remainder of the window containing
+        offset, so it may be shorter than requested.
+        """
+        if offset >= self._size:
+            return b''
+        start, window = self._window(offset)
+        begin = offset - start
+        return _buffer(window, begin, min(size, len(window) - begin))
+
+    def read(self, offset, size):
+        """Read size bytes at offset, crossing window boundaries if needed."""
+        chunks = []
+        while size > 0:
+            chunk = self.slice(offset, size)
+            if not chunk:
+                break
+            chunks.append(bytes(chunk))
+            offset += len(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def cursor(self, offset):
+        """Return a PackWindowCursor positioned at offset."""
+        return PackWindowCursor(self, offset)
+
+    def close(self):
+        # Windows are unmapped once the last buffer into them goes away.
+        self._windows.clear()
+
+
+class PackWindowCursor(object):
+    """Sequential reader over PackWindows, usable with unpack_object."""
+
+    def __init__(self, windows, offset):
+        self._windows = windows
+        self.offset = offset
+
+    def read(self, size):
+        """Read exactly size bytes (unless at end of file), as a copy."""
+        data = self._windows.read(self.offset, size)
+        self.offset += len(data)
+        return data
+
+    def read_some(self, size):
+        """Read up to size bytes without copying them out of the window."""
+        data = self._windows.slice(self.offset, size)
+        self.offset += len(data)
+        return data
+
+
+class DeltaBaseCache(object):
+    """Cache of resolved delta bases in a pack, keyed by offset.
+
+    The cache is limited by the total size of the cached objects. When it is
+    full, the least recently used bases that were themselves deltas are
+    evicted first, so that the roots of delta chains, which are the most
+    expensive to get back to and are shared by the most objects, are kept
+    the longest.
+    """
+
+    def __init__(self, max_size=None):
+        """Create a new DeltaBaseCache.
+
+        :param max_size: Maximum total size of the cached objects, in bytes.
+            None for the default.
+        """
+        self._roots = OrderedDict()
+        self._others = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.set_max_size(max_size)
+
+    def set_max_size(self, max_size):
+        """Change the maximum size of the cache, evicting bases if necessary.
+
+        :param max_size: Maximum total size of the cached objects, in bytes.
+            None for the default.
+        """
+        if max_size is None:
+            max_size = DEFAULT_DELTA_BASE_CACHE_LIMIT
+        self._max_size = max_size
+        self._shrink()
+
+    def __len__(self):
+        return len(self._roots) + len(self._others)
+
+    def __contains__(self, offset):
+        return offset in self._roots or offset in self._others
+
+    def __getitem__(self, offset):
+        for entries in (self._others, self._roots):
+            try:
+                entry = entries.pop(offset)
+            except KeyError:
+                continue
+            entries[offset] = entry
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        raise KeyError(offset)
+
+    def add(self, offset, type_num, chunks, root=False):
+        """Add a resolved object to the cache.
+
+        :param offset: Offset of the object in the pack
+        :param type_num: Type of the resolved object
+        :param chunks: Contents of the resolved object, as a list of chunks
+        :param root: Whether the object is the (non-delta) root of a delta
+            chain. Ignored if the object is already cached.
+        """
+        if offset in self._roots:
+            entries = self._roots
+        elif offset in self._others:
+            entries = self._others
+        elif root:
+            entries = self._roots
+        else:
+            entries = self._others
+        old = entries.pop(offset, None)
+        if old is not None:
+            self._size -= old[1]
+        size = chunks_length(chunks)
+        if size > self._max_size:
+            return
+        entries[offset] = ((type_num, chunks), size)
+        self._size += size
+        self._shrink(offset)
+
+    def _shrink(self, keep=None):
+        while self._size > self._max_size:
+            if self._others and not (
+                    len(self._others) == 1 and keep in self._others):
+                entries = self._others
+            elif self._roots:
+                entries = self._roots
+            else:
+                entries = self._others
+            _, (_, size) = entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+
+    def clear(self):
+        """Remove all bases from the cache."""
+        self._roots.clear()
+        self._others.clear()
+        self._size = 0
+
+    def stats(self):
+        """Return statistics about the use of this cache.
+
+        :return: Dictionary with the number of hits, misses and evictions,
+            the number of cached objects and their total size, and the
+            maximum size.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'count': len(self),
+                'size': self._size, 'max_size': self._max_size}
+
+
 class PackData(object):
     """The data contained in a packfile.
 
@@ -976,14 +1693,24 @@ class PackData(object):
     position.  It will all just throw a zlib or KeyError.
     """
 
-    def __init__(self, filename, file=None, size=None):
+    # PackWindows when the pack is memory-mapped, None otherwise.
+    _windows = None
+
+    def __init__(self, filename, file=None, size=None, use_mmap=False,
+                 window_size=None, window_limit=None,
+                 delta_base_cache_limit=None):
         """Create a PackData object representing the pack in the given filename.
 
         The file must exist and stay readable until the object is disposed of. It
         must also stay the same size. It will be mapped whenever needed.
 
-        Currently there is a restriction on the size of the pack as the python
-        mmap implementation is flawed.
+        :param use_mmap: Whether to read objects from memory-mapped windows
+            rather than through the file object. Ignored if the file can not
+            be mapped.
+        :param window_size: Size of the mapped windows, see PackWindows
+        :param window_limit: Maximum number of bytes to keep mapped
+        :param delta_base_cache_limit: Maximum size of the resolved delta
+            bases to keep cached, see DeltaBaseCache
         """
         self._filename = filename
         self._size = size
@@ -993,9 +1720,21 @@ class PackData(object):
         else:
             self._file = file
         (version, self._num_objects) = read_pack_header(self._file.read)
-        self._offset_cache = LRUSizeCache(1024*1024*20,
-            compute_size=_compute_object_size)
+        self._offset_cache = DeltaBaseCache(delta_base_cache_limit)
         self.pack = None
+        if use_mmap and has_mmap:
+            self._windows = self._map_windows(window_size, window_limit)
+
+    def _map_windows(self, window_size, window_limit):
+        try:
+            fd = self._file.fileno()
+        except (UnsupportedOperation, AttributeError):
+            return None
+        size = os.fstat(fd).st_size
+        if size < self._header_size:
+            return None
+        return PackWindows(fd, size, window_size=window_size,
+                           window_limit=window_limit)
 
     @property
     def filename(self):
@@ -1010,7 +1749,25 @@ class PackData(object):
         return cls(filename=path)
 
     def close(self):
+        if self._windows is not None:
+            self._windows.close()
         self._file.close()
+        self._offset_cache.clear()
+
+    def set_delta_base_cache_limit(self, max_size):
+        """Change the maximum size of the delta base cache.
+
+        :param max_size: Maximum size of the resolved delta bases to keep
+            cached, in bytes. None for the default.
+        """
+        self._offset_cache.set_max_size(max_size)
+
+    def delta_base_cache_stats(self):
+        """Return statistics about the use of the delta base cache.
+
+        :return: Dictionary, see DeltaBaseCache.stats
+        """
+        return self._offset_cache.stats()
 
     def __enter__(self):
         return self
@@ -1056,9 +1813,12 @@ class PackData(object):
             raise KeyError(sha)
         return offset, type, obj
 
-    def resolve_object(self, offset, type, obj, get_ref=None):
+    def resolve_object(self, offset, type, obj, get_ref=None, base_cache=None):
         """Resolve an object, possibly resolving deltas when necessary.
 
+        :param base_cache: Optional dict-like object mapping offsets to
+            resolved (type, chunks) tuples. Delta bases are looked up in it,
+            and the objects resolved along the way are added to it.
         :return: Tuple with object type and contents.
         """
         # Walk down the delta chain, building a stack of deltas to reach
@@ -1081,7 +1841,10 @@ class PackData(object):
                     isinstance(delta_offset, int)
                     or isinstance(base_offset, long))
                 base_offset = base_offset - delta_offset
-                base_type, base_obj = self.get_object_at(base_offset)
+                if base_cache is not None and base_offset in base_cache:
+                    base_type, base_obj = base_cache[base_offset]
+                else:
+                    base_type, base_obj = self.get_object_at(base_offset)
                 assert isinstance(base_type, int)
             elif base_type == REF_DELTA:
                 (basename, delta) = base_obj
@@ -1093,107 +1856,131 @@ class PackData(object):
         # Now grab the base object (mustn't be a delta) and apply the
         # deltas all the way up the stack.
         chunks = base_obj
+        if base_offset is not None and delta_stack:
+            self._offset_cache.add(base_offset, base_type, chunks, root=True)
+        if base_cache is not None and base_offset is not None:
+            base_cache[base_offset] = base_type, chunks
         for prev_offset, delta_type, delta in reversed(delta_stack):
             chunks = apply_delta(chunks, delta)
-            # TODO(dborowitz): This can result in poor performance if
-            # large base objects are separated from deltas in the pack.
-            # We should reorganize so that we apply deltas to all
-            # objects in a chain one after the other to optimize cache
-            # performance.
             if prev_offset is not None:
-                self._offset_cache[prev_offset] = base_type, chunks
+                self._offset_cache.add(prev_offset, base_type, chunks)
+                if base_cache is not None:
+                    base_cache[prev_offset] = base_type, chunks
         return base_type, chunks
 
+    def _unpack_at(self, offset, **kwargs):
+        """Unpack the object at the given offset.
+
+        Reads from the mapped windows if the pack is memory-mapped, and from
+        the file otherwise. Keyword arguments are passed on to unpack_object.
+
+        :return: Tuple with the UnpackedObject and the offset of the next
+            object in the pack.
+        """
+        if self._windows is not None:
+            cursor = self._windows.cursor(offset)
+            unpacked, unused = unpack_object(
+              cursor.read, read_some=cursor.read_some, **kwargs)
+            end = cursor.offset
+        else:
+            self._file.seek(offset)
+            unpacked, unused = unpack_object(self._file.read, **kwargs)
+            end = self._file.tell()
+        return unpacked, end - len(unused)  # Back up over unused data.
+
     def iterobjects(self, progress=None, compute_crc32=True):
-        self._file.seek(self._header_size)
+        offset = self._header_size
         for i in range(1, self._num_objects + 1):
-            offset = self._file.tell()
-            unpacked, unused = unpack_object(
-              self._file.read, compute_crc32=compute_crc32)
+            unpacked, next_offset = self._unpack_at(
+              offset, compute_crc32=compute_crc32)
             if progress is not None:
                 progress(i, self._num_objects)
             yield (offset, unpacked.pack_type_num, unpacked._obj(),
                    unpacked.crc32)
-            self._file.seek(-len(unused), SEEK_CUR)  # Back up over unused data.
+            offset = next_offset
 
-    def _iter_unpacked(self):
+    def _iter_unpacked(self, compute_crc32=False):
         # TODO(dborowitz): Merge this with iterobjects, if we can change its
         # return type.
-        self._file.seek(self._header_size)
-
         if self._num_objects is None:
             return
 
+        offset = self._header_size
         for _ in range(self._num_objects):
-            offset = self._file.tell()
-            unpacked, unused = unpack_object(
-              self._file.read, compute_crc32=False)
+            unpacked, next_offset = self._unpack_at(
+              offset, compute_crc32=compute_crc32)
             unpacked.offset = offset
             yield unpacked
-            self._file.seek(-len(unused), SEEK_CUR)  # Back up over unused data.
+            offset = next_offset
 
-    def iterentries(self, progress=None):
+    def iterentries(self, progress=None, threads=None):
         """Yield entries summarizing the contents of this pack.
 
         :param progress: Progress function, called with current and total
             object count.
+        :param threads: Number of threads to resolve deltas with, see
+            DeltaChainIterator
         :return: iterator of tuples with (sha, offset, crc32)
         """
         num_objects = self._num_objects
         resolve_ext_ref = (
             self.pack.resolve_ext_ref if self.pack is not None else None)
         indexer = PackIndexer.for_pack_data(
-            self, resolve_ext_ref=resolve_ext_ref)
+            self, resolve_ext_ref=resolve_ext_ref, threads=threads)
         for i, result in enumerate(indexer):
             if progress is not None:
                 progress(i, num_objects)
             yield result
 
-    def sorted_entries(self, progress=None):
+    def sorted_entries(self, progress=None, threads=None):
         """Return entries in this pack, sorted by SHA.
 
         :param progress: Progress function, called with current and total
             object count
+        :param threads: Number of threads to resolve deltas with
         :return: List of tuples with (sha, offset, crc32)
         """
-        ret = list(self.iterentries(progress=progress))
+        ret = list(self.iterentries(progress=progress, threads=threads))
         ret.sort()
         return ret
 
-    def create_index_v1(self, filename, progress=None):
+    def create_index_v1(self, filename, progress=None, threads=None):
         """Create a version 1 file for this data file.
 
         :param filename: Index filename.
         :param progress: Progress report function
+        :param threads: Number of threads to resolve deltas with
         :return: Checksum of index file
         """
-        entries = self.sorted_entries(progress=progress)
+        entries = self.sorted_entries(progress=progress, threads=threads)
         with GitFile(filename, 'wb') as f:
             return write_pack_index_v1(f, entries, self.calculate_checksum())
 
-    def create_index_v2(self, filename, progress=None):
+    def create_index_v2(self, filename, progress=None, threads=None):
         """Create a version 2 index file for this data file.
 
         :param filename: Index filename.
         :param progress: Progress report function
+        :param threads: Number of threads to resolve deltas with
         :return: Checksum of index file
         """
-        entries = self.sorted_entries(progress=progress)
+        entries = self.sorted_entries(progress=progress, threads=threads)
         with GitFile(filename, 'wb') as f:
             return write_pack_index_v2(f, entries, self.calculate_checksum())
 
     def create_index(self, filename, progress=None,
-                     version=2):
+                     version=2, threads=None):
         """Create an  index file for this data file.
 
         :param filename: Index filename.
         :param progress: Progress report function
+        :param threads: Number of threads to resolve deltas with
         :return: Checksum of index file
         """
         if version == 1:
-            return self.create_index_v1(filename, progress)
+            return self.create_index_v1(filename, progress, threads=threads)
         elif version == 2:
-            return self.create_index_v2(filename, progress)
+            return self.create_index_v2(filename, progress, threads=threads)
         else:
             raise ValueError('unknown index format %d' % version)
 
@@ -1209,6 +1996,22 @@ class PackData(object):
         if actual != stored:
             raise ChecksumMismatch(stored, actual)
 
+    def get_unpacked_object_at(self, offset, include_comp=False):
+        """Get the UnpackedObject at an offset, without resolving deltas.
+
+        :param offset: Offset of the object in the pack
+        :param include_comp: If True, include compressed data in the result.
+        :return: UnpackedObject with its offset and CRC32 set
+        """
+        assert offset >= self._header_size
+        unpacked, _ = self._unpack_at(
+            offset, compute_crc32=True, include_comp=include_comp)
+        if include_comp and self._windows is not None:
+            # Don't keep the mapped windows alive.
+            unpacked.comp_chunks = [bytes(c) for c in unpacked.comp_chunks]
+        unpacked.offset = offset
+        return unpacked
+
     def get_object_at(self, offset):
         """Given an offset in to the packfile return the object that is there.
 
@@ -1221,10 +2024,67 @@ class PackData(object):
         except KeyError:
             pass
         assert offset >= self._header_size
-        self._file.seek(offset)
-        unpacked, _ = unpack_object(self._file.read)
+        unpacked, _ = self._unpack_at(offset)
         return (unpacked.pack_type_num, unpacked._obj())
 
+    def _unpack_header_at(self, offset):
+        assert offset >= self._header_size
+        if self._windows is not None:
+            cursor = self._windows.cursor(offset)
+            return unpack_object_header(cursor.read, cursor.read_some)
+        self._file.seek(offset)
+        return unpack_object_header(self._file.read)
+
+    def get_object_info_at(self, offset):
+        """Find the type and size of the object at an offset.
+
+        Only the object headers are read; deltas are not resolved and no
+        delta bases are inflated.
+
+        :param offset: Offset of the object in the pack data
+        :return: Tuple with type number and size of the resolved object
+        """
+        size = None
+        while True:
+            if offset in self._offset_cache:
+                type_num, chunks = self._offset_cache[offset]
+                if size is None:
+                    size = chunks_length(chunks)
+                return type_num, size
+            type_num, obj_size, delta_base = self._unpack_header_at(offset)
+            if size is None:
+                size = obj_size
+            if type_num == OFS_DELTA:
+                offset -= delta_base
+            elif type_num == REF_DELTA:
+                if self.pack is None:
+                    raise KeyError(delta_base)
+                try:
+                    offset = self.pack.index.object_index(delta_base)
+                except KeyError:
+                    if self.pack.resolve_ext_ref is None:
+                        raise
+                    return self.pack.resolve_ext_ref(delta_base)[0], size
+            else:
+                return type_num, size
+
+
+class _BufferReader(object):
+    """Reads from a buffer, keeping the position in the reader itself.
+
+    Several readers can share a buffer (e.g. a memory map of a pack) between
+    threads, as they never seek it.
+    """
+
+    def __init__(self, buf, offset):
+        self._buf = buf
+        self.offset = offset
+
+    def read(self, size):
+        data = self._buf[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
 
 class DeltaChainIterator(object):
     """Abstract iterator over pack data based on delta chains.
@@ -1245,31 +2105,72 @@ class DeltaChainIterator(object):
     * decomp_chunks
     * decomp_len
     * crc32          (if _compute_crc32 is True)
+
+    With more than one thread, the chains starting at different full objects
+    are followed in parallel, reading from a single memory map of the pack.
+    Results are then yielded in no particular order.
+
+    If _resolve_while_recording is True, objects are resolved as they are
+    recorded whenever their delta base is still in memory, so that most of
+    the pack doesn't have to be read again. Only the results of those
+    objects are kept until the iterator is consumed, so this is only
+    suitable for small results.
     """
 
     _compute_crc32 = False
     _include_comp = False
+    _resolve_while_recording = False
+
+    def __init__(self, file_obj, resolve_ext_ref=None, threads=None):
+        """Create a new DeltaChainIterator.
 
-    def __init__(self, file_obj, resolve_ext_ref=None):
+        :param file_obj: File object for the pack data
+        :param resolve_ext_ref: Optional function to look up objects that
+            are not in the pack, returning (type_num, chunks)
+        :param threads: Number of threads to follow delta chains with; None
+            or 1 to follow them serially. Ignored if the pack can not be
+            memory-mapped.
+        """
         self._file = file_obj
+        self._windows = None
+        self._mapped = None
+        self._threads = threads
         self._resolve_ext_ref = resolve_ext_ref
         self._pending_ofs = defaultdict(list)
         self._pending_ref = defaultdict(list)
         self._full_ofs = []
         self._shas = {}
         self._ext_refs = []
+        if self._resolve_while_recording:
+            self._recent = DeltaBaseCache()
+        else:
+            self._recent = None
+        # Results, offsets by SHA and (type_num, base offset) by offset of
+        # the objects that were resolved while recording.
+        self._recorded_results = []
+        self._recorded_offsets = {}
+        self._recorded_chains = {}
 
     @classmethod
-    def for_pack_data(cls, pack_data, resolve_ext_ref=None):
-        walker = cls(None, resolve_ext_ref=resolve_ext_ref)
+    def for_pack_data(cls, pack_data, resolve_ext_ref=None, threads=None):
+        walker = cls(None, resolve_ext_ref=resolve_ext_ref, threads=threads)
         walker.set_pack_data(pack_data)
-        for unpacked in pack_data._iter_unpacked():
+        compute_crc32 = cls._resolve_while_recording and cls._compute_crc32
+        for unpacked in pack_data._iter_unpacked(compute_crc32=compute_crc32):
             walker.record(unpacked)
         return walker
 
     def record(self, unpacked):
+        """Record an object in the pack.
+
+        :param unpacked: UnpackedObject with its offset set. If objects are
+            resolved while recording, decomp_chunks (and crc32, if this
+            iterator computes CRC32s) should be set as well.
+        """
         type_num = unpacked.pack_type_num
         offset = unpacked.offset
+        if self._recent is not None and self._record_resolved(unpacked):
+            return
         if type_num == OFS_DELTA:
             base_offset = offset - unpacked.delta_base
             self._pending_ofs[base_offset].append(offset)
@@ -1278,15 +2179,142 @@ class DeltaChainIterator(object):
         else:
             self._full_ofs.append((offset, type_num))
 
+    def _record_resolved(self, unpacked):
+        """Try to resolve an object while recording it.
+
+        :return: Whether the object could be resolved
+        """
+        type_num = unpacked.pack_type_num
+        if type_num == OFS_DELTA:
+            base_offset = unpacked.offset - unpacked.delta_base
+        elif type_num == REF_DELTA:
+            base_offset = self._recorded_offsets.get(unpacked.delta_base)
+        else:
+            base_offset = None
+        if base_offset is None:
+            if type_num in DELTA_TYPES:
+                return False
+            obj_chunks = unpacked.decomp_chunks
+        else:
+            try:
+                type_num, base_chunks = self._recent[base_offset]
+            except KeyError:
+                return False
+            obj_chunks = apply_delta(base_chunks, unpacked.decomp_chunks)
+        unpacked.obj_type_num = type_num
+        unpacked.obj_chunks = obj_chunks
+        self._recorded_results.append(self._result(unpacked))
+        self._recent.add(unpacked.offset, type_num, obj_chunks,
+                         root=base_offset is None)
+        self._recorded_offsets[unpacked.sha()] = unpacked.offset
+        self._recorded_chains[unpacked.offset] = (type_num, base_offset)
+        return True
+
+    def _recorded_object(self, offset):
+        """Get the contents of an object that was resolved while recording.
+
+        The object (and any of its bases) is read again if it is no longer in
+        memory.
+
+        :return: Tuple with type number and chunks
+        """
+        chain = []
+        while offset not in self._recent:
+            chain.append(offset)
+            base_offset = self._recorded_chains[offset][1]
+            if base_offset is None:
+                break
+            offset = base_offset
+        else:
+            type_num, chunks = self._recent[offset]
+        if chain and self._recorded_chains[chain[-1]][1] is None:
+            unpacked = self._unpack_object_at(chain.pop())
+            type_num, chunks = unpacked.pack_type_num, unpacked.decomp_chunks
+            self._recent.add(unpacked.offset, type_num, chunks, root=True)
+        for offset in reversed(chain):
+            unpacked = self._unpack_object_at(offset)
+            chunks = apply_delta(chunks, unpacked.decomp_chunks)
+            self._recent.add(offset, type_num, chunks)
+        return type_num, chunks
+
+    def _walk_recorded_chains(self):
+        results, self._recorded_results = self._recorded_results, []
+        for result in results:
+            yield result
+        # Follow the chains of objects that couldn't be resolved while
+        # recording, but have a base that could.
+        for base_offset in [o for o in self._pending_ofs
+                            if o in self._recorded_chains]:
+            pending = self._pending_ofs.pop(base_offset, [])
+            type_num, chunks = self._recorded_object(base_offset)
+            for new_offset in pending:
+                for result in self._follow_chain(new_offset, type_num, chunks):
+                    yield result
+        for base_sha in [s for s in self._pending_ref
+                         if s in self._recorded_offsets]:
+            pending = self._pending_ref.pop(base_sha, [])
+            type_num, chunks = self._recorded_object(
+                self._recorded_offsets[base_sha])
+            for new_offset in pending:
+                for result in self._follow_chain(new_offset, type_num, chunks):
+                    yield result
+
     def set_pack_data(self, pack_data):
         self._file = pack_data._file
+        self._windows = pack_data._windows
 
-    def _walk_all_chains(self):
+    def _map_file(self):
+        if not has_mmap:
+            return None
+        try:
+            fd = self._file.fileno()
+        except (UnsupportedOperation, AttributeError):
+            return None
+        # The pack may just have been written through the file object.
+        self._file.flush()
+        size = os.fstat(fd).st_size
+        if not size:
+            return None
+        return mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+
+    def _walk_full_chains(self):
         for offset, type_num in self._full_ofs:
             for result in self._follow_chain(offset, type_num, None):
                 yield result
-        for result in self._walk_ref_chains():
-            yield result
+
+    def _walk_full_chains_parallel(self):
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(self._threads)
+        try:
+            follow = lambda entry: list(
+                self._follow_chain(entry[0], entry[1], None))
+            # Hand out several chains at a time; most of them are short.
+            chunksize = max(1, len(self._full_ofs) // (self._threads * 16))
+            for results in pool.imap_unordered(follow, self._full_ofs,
+                                               chunksize):
+                for result in results:
+                    yield result
+        finally:
+            pool.terminate()
+
+    def _walk_all_chains(self):
+        if self._threads is not None and self._threads > 1:
+            self._mapped = self._map_file()
+        try:
+            for result in self._walk_recorded_chains():
+                yield result
+            if self._mapped is not None:
+                full_chains = self._walk_full_chains_parallel()
+            else:
+                full_chains = self._walk_full_chains()
+            for result in full_chains:
+                yield result
+            for result in self._walk_ref_chains():
+                yield result
+        finally:
+            if self._mapped is not None:
+                self._mapped.close()
+                self._mapped = None
         assert not self._pending_ofs
 
     def _ensure_no_pending(self):
@@ -1319,12 +2347,32 @@ class DeltaChainIterator(object):
     def _result(self, unpacked):
         return unpacked
 
-    def _resolve_object(self, offset, obj_type_num, base_chunks):
-        self._file.seek(offset)
-        unpacked, _ = unpack_object(
-          self._file.read, include_comp=self._include_comp,
-          compute_crc32=self._compute_crc32)
+    def _unpack_object_at(self, offset):
+        if self._mapped is not None:
+            reader = _BufferReader(self._mapped, offset)
+            unpacked, _ = unpack_object(
+              reader.read, include_comp=self._include_comp,
+              compute_crc32=self._compute_crc32)
+        elif self._windows is not None:
+            cursor = self._windows.cursor(offset)
+            unpacked, _ = unpack_object(
+              cursor.read, read_some=cursor.read_some,
+              include_comp=self._include_comp,
+              compute_crc32=self._compute_crc32)
+            if self._include_comp:
+                # Don't keep the mapped windows alive.
+                unpacked.comp_chunks = [
+                    bytes(c) for c in unpacked.comp_chunks]
+        else:
+            self._file.seek(offset)
+            unpacked, _ = unpack_object(
+              self._file.read, include_comp=self._include_comp,
+              compute_crc32=self._compute_crc32)
         unpacked.offset = offset
+        return unpacked
+
+    def _resolve_object(self, offset, obj_type_num, base_chunks):
+        unpacked = self._unpack_object_at(offset)
         if base_chunks is None:
             assert unpacked.pack_type_num == obj_type_num
         else:
@@ -1359,6 +2407,7 @@ class PackIndexer(DeltaChainIterator):
     """Delta chain iterator that yields index entries."""
 
     _compute_crc32 = True
+    _resolve_while_recording = True
 
     def _result(self, unpacked):
         return unpacked.sha(), unpacked.offset, unpacked.crc32
@@ -1427,6 +2476,22 @@ class SHA1Writer(object):
         return self.f.tell()
 
 
+class _OffsetWriter(object):
+    """Wrapper around a file-like object that keeps track of the offset in a
+    pack that the written data ends up at."""
+
+    def __init__(self, f, offset):
+        self.f = f
+        self.length = offset
+
+    def write(self, data):
+        self.f.write(data)
+        self.length += len(data)
+
+    def offset(self):
+        return self.length
+
+
 def pack_object_header(type_num, delta_base, size):
     """Create a pack object header for the given object info.
 
@@ -1457,12 +2522,15 @@ def pack_object_header(type_num, delta_base, size):
     return bytearray(header)
 
 
-def write_pack_object(f, type, object, sha=None):
+def write_pack_object(f, type, object, sha=None,
+                      compression_level=DEFAULT_PACK_COMPRESSION_LEVEL):
     """Write pack object to a file.
 
     :param f: File to write to
     :param type: Numeric type of the object
     :param object: Object to write
+    :param compression_level: zlib compression level, like git's
+        pack.compression; -1 for the zlib default
     :return: Tuple with offset at which the object was written, and crc32
     """
     if type in DELTA_TYPES:
@@ -1470,9 +2538,17 @@ def write_pack_object(f, type, object, sha=None):
     else:
         delta_base = None
     header = bytes(pack_object_header(type, delta_base, len(object)))
-    comp_data = zlib.compress(object)
+    return _write_pack_entry(
+        f, header, [zlib.compress(object, compression_level)], sha=sha)
+
+
+def _write_pack_entry(f, header, comp_chunks, sha=None):
+    """Write a pack object header and its compressed data.
+
+    :return: CRC32 of the written entry
+    """
     crc32 = 0
-    for data in (header, comp_data):
+    for data in chain([header], comp_chunks):
         f.write(data)
         if sha is not None:
             sha.update(data)
@@ -1480,19 +2556,45 @@ def write_pack_object(f, type, object, sha=None):
     return crc32 & 0xffffffff
 
 
-def write_pack(filename, objects, deltify=None, delta_window_size=None):
+def write_unpacked_object(f, type_num, delta_base, unpacked, sha=None):
+    """Write an object that is already compressed to a file.
+
+    :param f: File to write to
+    :param type_num: Numeric pack type of the object to write
+    :param delta_base: Delta base offset or ref, or None for whole objects
+    :param unpacked: UnpackedObject with comp_chunks and decomp_len set
+    :return: CRC32 of the written entry
+    """
+    header = bytes(pack_object_header(type_num, delta_base,
+                                      unpacked.decomp_len))
+    return _write_pack_entry(f, header, unpacked.comp_chunks, sha=sha)
+
+
+def write_pack(filename, objects, deltify=None, delta_window_size=None,
+               threads=None, deterministic=False,
+               compression_level=DEFAULT_PACK_COMPRESSION_LEVEL,
+               max_depth=None):
     """Write a new pack data file.
 
     :param filename: Path to the new pack file (without .pack extension)
-    :param objects: Iterable of (object, path) tuples to write.
-        Should provide __len__
+    :param objects: Iterable of (object, path) tuples to write. If it doesn't
+        provide __len__, the objects are spooled while they are counted.
     :param window_size: Delta window size
     :param deltify: Whether to deltify pack objects
+    :param threads: Number of worker processes to search for deltas with,
+        and of threads to compress objects with
+    :param deterministic: Whether the output should not depend on the order
+        in which threads finish
+    :param compression_level: zlib compression level, like git's
+        pack.compression; -1 for the zlib default
+    :param max_depth: Maximum length of delta chains; None for default
     :return: Tuple with checksum of pack file and index file
     """
     with GitFile(filename + '.pack', 'wb') as f:
         entries, data_sum = write_pack_objects(f, objects,
-            delta_window_size=delta_window_size, deltify=deltify)
+            delta_window_size=delta_window_size, deltify=deltify,
+            threads=threads, deterministic=deterministic,
+            compression_level=compression_level, max_depth=max_depth)
     entries = [(k, v[0], v[1]) for (k, v) in entries.items()]
     entries.sort()
     with GitFile(filename + '.idx', 'wb') as f:
@@ -1506,89 +2608,597 @@ def write_pack_header(f, num_objects):
     f.write(struct.pack(b'>L', num_objects))  # Number of objects in pack
 
 
-def deltify_pack_objects(objects, window_size=None):
+def _deltify_sorted(magic, window_size, max_depth):
+    """Search for deltas in a list sorted by the magic Linus heuristic.
+
+    :param magic: List of (type_num, path, is not base, negative length,
+        binary SHA1, raw data) tuples
+    :param window_size: Window size
+    :param max_depth: Maximum length of delta chains
+    :return: Iterator over type_num, object id, delta_base, content
+    """
+    # Window of (type_num, SHA1, delta index, depth) tuples; the index for
+    # each base is built once and reused for every target in the window.
+    # Objects at the maximum depth can't be used as bases, and have no index.
+    possible_bases = deque()
+
+    for type_num, path, not_base, neg_length, sha, raw in magic:
+        if not not_base:
+            # The receiver has this object already, so it is only used as a
+            # delta base.
+            possible_bases.appendleft((type_num, sha, DeltaIndex(raw), 0))
+            while len(possible_bases) > window_size:
+                possible_bases.pop()
+            continue
+        winner = raw
+        winner_base = None
+        winner_depth = 0
+        for base_type_num, base_sha, base_index, base_depth in possible_bases:
+            if base_type_num != type_num or base_index is None:
+                continue
+            # Like git's try_delta, only take deltas of at most half the size
+            # of the object, which lets create_delta give up on unrelated
+            # bases early, and skip bases that are far too small. Tiny
+            # objects, which git doesn't deltify at all, take any delta
+            # smaller than themselves.
+            max_size = len(winner) - 1
+            if winner_base is None and len(raw) // 2 - 20 > 0:
+                max_size = len(raw) // 2 - 20
+            if len(base_index) < len(raw) // 32:
+                continue
+            delta = base_index.create_delta(raw, max_size=max_size)
+            if delta is not None and len(delta) < len(winner):
+                winner_base = base_sha
+                winner = delta
+                winner_depth = base_depth + 1
+        yield type_num, sha, winner_base, winner
+        if winner_depth < max_depth:
+            index = DeltaIndex(raw)
+        else:
+            index = None
+        possible_bases.appendleft((type_num, sha, index, winner_depth))
+        while len(possible_bases) > window_size:
+            possible_bases.pop()
+
+
+def _split_magic(magic, num_segments):
+    """Split a sorted object list into segments for parallel delta search.
+
+    Like git, segment boundaries are moved forward to the next change of type
+    or path, so objects that are likely to delta well against each other end
+    up in the same segment.
+
+    :param magic: List sorted by the magic Linus heuristic
+    :param num_segments: Desired number of segments
+    :return: Iterator over lists of entries from magic
+    """
+    segment_size = max(1, -(-len(magic) // num_segments))
+    start = 0
+    while start < len(magic):
+        end = min(start + segment_size, len(magic))
+        while end < len(magic) and magic[end][:2] == magic[end-1][:2]:
+            end += 1
+        yield magic[start:end]
+        start = end
+
+
+def _deltify_segment(args):
+    """Search for deltas in a segment, in a worker process.
+
+    :param args: Tuple with the arguments for _deltify_sorted
+    :return: List of the results of _deltify_sorted
+    """
+    return list(_deltify_sorted(*args))
+
+
+def _process_pool(processes):
+    """Create a pool of worker processes, if possible.
+
+    The workers are forked, so they don't need to import __main__, as
+    spawned workers would. Pools can't be created from daemonic processes
+    (e.g. multiprocessing workers), or where processes can't be forked.
+
+    :param processes: Number of worker processes
+    :return: A multiprocessing Pool, or None
+    """
+    import multiprocessing
+    if multiprocessing.current_process().daemon:
+        return None
+    try:
+        get_context = multiprocessing.get_context
+    except AttributeError:
+        # Python 2 forks on every platform except Windows.
+        if sys.platform == 'win32':
+            return None
+        pool_class = multiprocessing.Pool
+    else:
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return None
+        pool_class = get_context('fork').Pool
+    try:
+        return pool_class(processes)
+    except (OSError, ImportError):
+        # E.g. no working sem_open on this platform
+        return None
+
+
+def deltify_pack_objects(objects, window_size=None, threads=None,
+                         deterministic=False, max_depth=None, bases=None):
     """Generate deltas for pack objects.
 
     :param objects: An iterable of (object, path) tuples to deltify.
     :param window_size: Window size; None for default
+    :param threads: Number of worker processes to search for deltas with,
+        like git's pack.threads; None or 1 to search serially. Like git, the
+        sorted object list is split into segments that are searched
+        independently, so deltas are never made across segment boundaries.
+        Where no worker processes can be created (see _process_pool), the
+        whole list is searched serially instead.
+    :param deterministic: When searching in parallel, yield the results of
+        the segments in order rather than as soon as they are available.
+    :param max_depth: Maximum length of the delta chains, like git's
+        pack.depth; None for default
+    :param bases: Optional iterable of (object, path) tuples for objects that
+        the receiver already has. They are preferred as delta bases, but not
+        yielded themselves, so the deltas may refer to objects outside the
+        pack (a thin pack).
     :return: Iterator over type_num, object id, delta_base, content
         delta_base is None for full text entries
     """
     if window_size is None:
         window_size = DEFAULT_PACK_DELTA_WINDOW_SIZE
+    if max_depth is None:
+        max_depth = DEFAULT_PACK_DELTA_MAX_DEPTH
     # Build a list of objects ordered by the magic Linus heuristic
-    # This helps us find good objects to diff against us
+    # This helps us find good objects to diff against us. Like git, bases
+    # come before the other objects with the same type and path, so they end
+    # up in the window of those objects.
+    # The entries only hold strings, so they can be sent to worker
+    # processes.
     magic = []
     for obj, path in objects:
-        magic.append((obj.type_num, path, -obj.raw_length(), obj))
-    magic.sort()
-
-    possible_bases = deque()
+        magic.append((obj.type_num, path or b'', True, -obj.raw_length(),
+                      obj.sha().digest(), obj.as_raw_string()))
+    for obj, path in bases or []:
+        magic.append((obj.type_num, path or b'', False, -obj.raw_length(),
+                      obj.sha().digest(), obj.as_raw_string()))
+    # Break ties on the object id, so the order doesn't depend on memory
+    # addresses.
+    magic.sort(key=lambda entry: entry[:5])
+
+    pool = None
+    if threads is not None and threads > 1:
+        pool = _process_pool(threads)
+    if pool is None:
+        for result in _deltify_sorted(magic, window_size, max_depth):
+            yield result
+        return
 
-    for type_num, path, neg_length, o in magic:
-        raw = o.as_raw_string()
-        winner = raw
-        winner_base = None
-        for base in possible_bases:
-            if base.type_num != type_num:
-                continue
-            delta = create_delta(base.as_raw_string(), raw)
-            if len(delta) < len(winner):
-                winner_base = base.sha().digest()
-                winner = delta
-        yield type_num, o.sha().digest(), winner_base, winner
-        possible_bases.appendleft(o)
-        while len(possible_bases) > window_size:
-            possible_bases.pop()
+    try:
+        # Use several segments per process so that slow segments don't
+        # leave the other processes idle.
+        segments = ((segment, window_size, max_depth)
+                    for segment in _split_magic(magic, threads * 4))
+        if deterministic:
+            results = pool.imap(_deltify_segment, segments)
+        else:
+            results = pool.imap_unordered(_deltify_segment, segments)
+        for segment_results in results:
+            for result in segment_results:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
 
 
-def write_pack_objects(f, objects, delta_window_size=None, deltify=False):
+def write_pack_objects(f, objects, delta_window_size=None, deltify=False,
+                       threads=None, deterministic=False,
+                       compression_level=DEFAULT_PACK_COMPRESSION_LEVEL,
+                       seekable=False, spool_size=DEFAULT_PACK_SPOOL_SIZE,
+                       max_depth=None, ofs_delta=True, bases=None):
     """Write a new pack data file.
 
     :param f: File to write to
-    :param objects: Iterable of (object, path) tuples to write.
-        Should provide __len__
+    :param objects: Iterable of (object, path) tuples to write. If it doesn't
+        provide __len__, the objects are counted while they are written; see
+        write_pack_data.
     :param window_size: Sliding window size for searching for deltas;
                         Set to None for default window size.
-    :param deltify: Whether to deltify objects
+    :param deltify: Whether to deltify objects. Deltified objects are
+        written in the order of order_pack_objects, with delta bases before
+        their deltas; otherwise objects are written in the order they are
+        given in.
+    :param threads: Number of worker processes to search for deltas with,
+        and of threads to compress objects with
+    :param deterministic: Whether the output should not depend on the order
+        in which threads finish
+    :param compression_level: zlib compression level, like git's
+        pack.compression; -1 for the zlib default
+    :param seekable: Whether f also supports seek() and read()
+    :param spool_size: Amount of data to spool in memory when the number of
+        objects isn't known and f isn't seekable
+    :param max_depth: Maximum length of delta chains; None for default
+    :param ofs_delta: Whether deltas against objects earlier in the pack may
+        be written as OFS_DELTA, rather than always as REF_DELTA
+    :param bases: Optional iterable of (object, path) tuples for objects that
+        the receiver already has, to use as delta bases without writing them;
+        only used when deltifying, and makes the pack thin
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
+    if hasattr(objects, '__len__'):
+        num_objects = len(objects)
+    else:
+        num_objects = None
     if deltify:
-        pack_contents = deltify_pack_objects(objects, delta_window_size)
+        # The delta search needs all objects in memory anyway, so write them
+        # in the order of order_pack_objects rather than in the order in
+        # which they were searched.
+        objects = list(objects)
+        num_objects = len(objects)
+        type_nums = dict(
+            (o.sha().digest(), o.type_num) for (o, path) in objects)
+        write_order = order_pack_objects(
+            [(o.sha().digest(), path) for (o, path) in objects],
+            type_nums.__getitem__)
+        positions = dict(
+            (sha, i) for (i, (sha, path)) in enumerate(write_order))
+        records = sorted(
+            deltify_pack_objects(
+                objects, delta_window_size, threads=threads,
+                deterministic=deterministic, max_depth=max_depth,
+                bases=bases),
+            key=lambda record: positions[record[1]])
+        pack_contents = _bases_first(records)
     else:
         pack_contents = (
             (o.type_num, o.sha().digest(), None, o.as_raw_string())
             for (o, path) in objects)
 
-    return write_pack_data(f, len(objects), pack_contents)
+    return write_pack_data(f, num_objects, pack_contents, threads=threads,
+                           compression_level=compression_level,
+                           seekable=seekable, spool_size=spool_size,
+                           ofs_delta=ofs_delta)
+
+
+# Position of each object type in the write order of packs, like git's.
+_TYPE_WRITE_ORDER = {
+    Commit.type_num: 0,
+    Tag.type_num: 1,
+    Tree.type_num: 2,
+    Blob.type_num: 3,
+    }
+
 
+def order_pack_objects(objects, get_type_num):
+    """Order objects for writing them to a pack, like git's write order.
 
-def write_pack_data(f, num_records, records):
+    Commits come first, then tags, trees and blobs. Commits and tags keep the
+    order in which they are given, which should be the order in which they
+    were found while traversing history, newest first. Trees and blobs are
+    grouped by path, with the groups in the order in which their paths were
+    first seen, so that objects which are usually read together end up
+    close together in the pack.
+
+    :param objects: Iterable of (sha, path) tuples
+    :param get_type_num: Function that returns the type number of an object
+        given its SHA
+    :return: List of (sha, path) tuples, in write order
+    """
+    groups = {}
+    keys = []
+    for sha, path in objects:
+        rank = _TYPE_WRITE_ORDER.get(get_type_num(sha), len(_TYPE_WRITE_ORDER))
+        if rank < _TYPE_WRITE_ORDER[Tree.type_num]:
+            key = (rank, None)
+        else:
+            key = (rank, path)
+        try:
+            groups[key].append((sha, path))
+        except KeyError:
+            groups[key] = [(sha, path)]
+            keys.append(key)
+    # The sort is stable, so groups of the same type keep their order.
+    keys.sort(key=lambda key: key[0])
+    return [entry for key in keys for entry in groups[key]]
+
+
+def _bases_first(records):
+    """Reorder deltified records so that delta bases precede their deltas.
+
+    :param records: List of (type_num, object id, delta_base, content)
+    :return: Iterator over the same records
+    """
+    by_id = dict((record[1], record) for record in records)
+    done = set()
+    for record in records:
+        family = []
+        while record is not None and record[1] not in done:
+            done.add(record[1])
+            family.append(record)
+            record = by_id.get(record[2])
+        for record in reversed(family):
+            yield record
+
+
+def _get_reusable_object(container, sha, available):
+    """Retrieve a packed object that can be copied into a new pack verbatim.
+
+    :param container: Object store or Pack to retrieve the object from
+    :param sha: Hex SHA1 of the object
+    :param available: Set of hex SHA1s that deltas can refer to
+    :return: UnpackedObject with comp_chunks set, or None
+    """
+    try:
+        unpacked = container.get_unpacked_object(sha, include_comp=True)
+    except (KeyError, ChecksumMismatch):
+        return None
+    if (unpacked.pack_type_num in DELTA_TYPES and
+            sha_to_hex(unpacked.delta_base) not in available):
+        return None
+    return unpacked
+
+
+def _reuse_packed_objects(container, object_ids, available, sending, done):
+    """Retrieve the packed objects that can be copied into a new pack.
+
+    Reused deltas are preceded by their bases, if those are being sent.
+
+    :param container: Object store or Pack to retrieve objects from
+    :param object_ids: Iterable of hex SHA1s of the objects to write
+    :param available: Set of hex SHA1s that deltas can refer to
+    :param sending: Set of hex SHA1s of all objects that are being sent
+    :param done: Set of hex SHA1s of the objects that were handled already,
+        which is updated
+    :return: Iterator over (hex SHA1, UnpackedObject or None) tuples
+    """
+    for sha in object_ids:
+        family = []
+        while sha not in done:
+            done.add(sha)
+            unpacked = _get_reusable_object(container, sha, available)
+            family.append((sha, unpacked))
+            if (unpacked is None or
+                    unpacked.pack_type_num not in DELTA_TYPES):
+                break
+            sha = sha_to_hex(unpacked.delta_base)
+            if sha not in sending:
+                break
+        for entry in reversed(family):
+            yield entry
+
+
+def generate_pack_records(container, object_ids):
+    """Generate records for write_pack_data, reusing packed objects.
+
+    Objects that are stored in a pack are copied verbatim, without inflating
+    and recompressing them. Deltas are reused as well, as long as their base
+    is also being sent, and their base is then written first. Everything else
+    is written as a full object.
+
+    :param container: Object store or Pack to retrieve objects from
+    :param object_ids: Sequence of hex SHA1s of the objects to write, in the
+        order to write them in (see order_pack_objects)
+    :return: Iterator over records for write_pack_data
+    """
+    sending = set(object_ids)
+    for sha, unpacked in _reuse_packed_objects(
+            container, object_ids, sending, sending, set()):
+        if unpacked is not None:
+            yield unpacked
+        else:
+            type_num, raw = container.get_raw(sha)
+            yield type_num, hex_to_sha(sha), None, raw
+
+
+def generate_thin_pack_records(container, objects, thin_bases,
+                               window_size=None, max_depth=None):
+    """Generate records for a thin pack, for write_pack_data.
+
+    Like generate_pack_records, packed objects are copied verbatim, but
+    packed deltas are also reused if their base is one of thin_bases. The
+    objects that can't be copied are deltified against each other and
+    against the objects in thin_bases with the same path, which are not
+    written themselves, and are written after the copied objects.
+
+    :param container: Object store or Pack to retrieve objects from
+    :param objects: Sequence of (hex SHA1, path) tuples of the objects to
+        write, in the order to write them in (see order_pack_objects)
+    :param thin_bases: Iterable of (hex SHA1, path) tuples of objects that
+        the receiver already has. At most window_size of them are used for
+        each path.
+    :param window_size: Delta window size; None for default
+    :param max_depth: Maximum length of delta chains; None for default
+    :return: Iterator over records for write_pack_data
+    """
+    sending = set(sha for (sha, path) in objects)
+    thin_bases = list(thin_bases)
+    available = set(sending)
+    available.update(sha for (sha, path) in thin_bases)
+    paths = dict(objects)
+    to_deltify = []
+    for sha, unpacked in _reuse_packed_objects(
+            container, [sha for (sha, path) in objects], available, sending,
+            set()):
+        if unpacked is not None:
+            yield unpacked
+        else:
+            to_deltify.append((container[sha], paths[sha]))
+    if not to_deltify:
+        return
+    # Only retrieve the bases that are likely to be useful: those with the
+    # path of an object to deltify, and no more of them for each path than
+    # fit in the delta window.
+    if window_size is None:
+        window_size = DEFAULT_PACK_DELTA_WINDOW_SIZE
+    wanted_paths = set(path for (obj, path) in to_deltify)
+    path_counts = defaultdict(int)
+    bases = []
+    for sha, path in thin_bases:
+        if path in wanted_paths and path_counts[path] < window_size:
+            path_counts[path] += 1
+            bases.append((container[sha], path))
+    positions = dict((obj.sha().digest(), i)
+                     for (i, (obj, path)) in enumerate(to_deltify))
+    records = sorted(
+        deltify_pack_objects(to_deltify, window_size, max_depth=max_depth,
+                             bases=bases),
+        key=lambda record: positions[record[1]])
+    for record in _bases_first(records):
+        yield record
+
+
+def _compress_pack_records(records, threads, compression_level):
+    """Compress pack records on a pool of threads.
+
+    A bounded number of records is compressed ahead of the one that is being
+    consumed, so that memory use doesn't depend on the number of records.
+
+    :return: Iterator over (record, comp_chunks) tuples, in the order of
+        records. comp_chunks is None for UnpackedObjects.
+    """
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(threads)
+    pending = deque()
+
+    def finish():
+        record, result = pending.popleft()
+        if result is None:
+            return record, None
+        return record, [result.get()]
+
+    try:
+        for record in records:
+            if isinstance(record, UnpackedObject):
+                result = None
+            else:
+                result = pool.apply_async(
+                    zlib.compress, (record[3], compression_level))
+            pending.append((record, result))
+            if len(pending) >= threads * _COMPRESS_OBJECTS_IN_FLIGHT:
+                yield finish()
+        while pending:
+            yield finish()
+    finally:
+        pool.terminate()
+
+
+def write_pack_data(f, num_records, records, threads=None,
+                    compression_level=DEFAULT_PACK_COMPRESSION_LEVEL,
+                    seekable=False, spool_size=DEFAULT_PACK_SPOOL_SIZE,
+                    ofs_delta=True):
     """Write a new pack data file.
 
+    Deltas whose base is written earlier in the pack are written as
+    OFS_DELTA, unless ofs_delta is False; other deltas as REF_DELTA.
+
+    The number of records has to be written in the pack header, before any of
+    the records. If it isn't known in advance, the records are counted while
+    they are written: into f itself if it is seekable, after which the header
+    is patched and the pack checksum computed by reading f back, and
+    otherwise into a spool that is kept in memory up to spool_size bytes and
+    on disk beyond that, and copied to f afterwards. Either way, memory use
+    doesn't depend on the size of the pack.
+
     :param f: File to write to
-    :param num_records: Number of records
-    :param records: Iterator over type_num, object_id, delta_base, raw
+    :param num_records: Number of records, or None if it isn't known
+    :param records: Iterator over type_num, object_id, delta_base, raw.
+        Records may also be UnpackedObjects (with comp_chunks set), which are
+        copied without recompressing them.
+    :param threads: Number of threads to compress objects with; None or 1 to
+        compress them while writing. The output does not depend on the
+        number of threads.
+    :param compression_level: zlib compression level, like git's
+        pack.compression; -1 for the zlib default
+    :param seekable: Whether f also supports seek() and read(); it should be
+        positioned at its end
+    :param spool_size: Amount of data to spool in memory when num_records is
+        None and f isn't seekable
+    :param ofs_delta: Whether OFS_DELTA may be used, e.g. whether the client
+        supports the ofs-delta capability
     :return: Dict mapping id -> (offset, crc32 checksum), pack checksum
     """
-    # Write the pack
+    if threads is not None and threads > 1:
+        records = _compress_pack_records(records, threads, compression_level)
+    else:
+        records = ((record, None) for record in records)
+    if num_records is not None:
+        f = SHA1Writer(f)
+        write_pack_header(f, num_records)
+        entries, count = _write_pack_records(f, records, compression_level,
+                                             ofs_delta)
+        return entries, f.write_sha()
+    if seekable:
+        start = f.tell()
+        write_pack_header(f, 0)
+        entries, count = _write_pack_records(
+            _OffsetWriter(f, PACK_HEADER_SIZE), records, compression_level,
+            ofs_delta)
+        f.seek(start)
+        write_pack_header(f, count)
+        # Must flush before reading (http://bugs.python.org/issue3207)
+        f.flush()
+        pack_sha = compute_file_sha(f, start_ofs=start).digest()
+        # Must reposition before writing (http://bugs.python.org/issue3207)
+        f.seek(0, SEEK_END)
+        f.write(pack_sha)
+        return entries, pack_sha
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    try:
+        entries, count = _write_pack_records(
+            _OffsetWriter(spool, PACK_HEADER_SIZE), records,
+            compression_level, ofs_delta)
+        f = SHA1Writer(f)
+        # Count the records rather than the entries: an object that occurs
+        # more than once is written more than once.
+        write_pack_header(f, count)
+        spool.seek(0)
+        for data in iter(lambda: spool.read(1 << 16), b''):
+            f.write(data)
+        return entries, f.write_sha()
+    finally:
+        spool.close()
+
+
+def _write_pack_records(f, records, compression_level, ofs_delta):
+    """Write the records of a pack, after its header.
+
+    :param f: File to write to, with an offset() method that returns the
+        offset in the pack of the next write
+    :param records: Iterator over (record, comp_chunks) tuples
+    :param compression_level: zlib compression level for records that are
+        not compressed yet
+    :param ofs_delta: Whether OFS_DELTA may be used
+    :return: Tuple with a dict mapping id -> (offset, crc32 checksum), and
+        the number of records written
+    """
     entries = {}
-    f = SHA1Writer(f)
-    write_pack_header(f, num_records)
-    for type_num, object_id, delta_base, raw in records:
+    count = 0
+    for record, comp_chunks in records:
         offset = f.offset()
+        if isinstance(record, UnpackedObject):
+            object_id = record.sha()
+            type_num = record.pack_type_num
+            delta_base = record.delta_base
+        else:
+            type_num, object_id, delta_base, raw = record
         if delta_base is not None:
-            try:
+            if ofs_delta and delta_base in entries:
                 base_offset, base_crc32 = entries[delta_base]
-            except KeyError:
-                type_num = REF_DELTA
-                raw = (delta_base, raw)
-            else:
                 type_num = OFS_DELTA
-                raw = (offset - base_offset, raw)
-        crc32 = write_pack_object(f, type_num, raw)
+                delta_base = offset - base_offset
+            else:
+                type_num = REF_DELTA
+        if isinstance(record, UnpackedObject):
+            # Copy the compressed data verbatim.
+            crc32 = write_unpacked_object(f, type_num, delta_base, record)
+        else:
+            if comp_chunks is None:
+                comp_chunks = [zlib.compress(raw, compression_level)]
+            header = bytes(pack_object_header(type_num, delta_base, len(raw)))
+            crc32 = _write_pack_entry(f, header, comp_chunks)
         entries[object_id] = (offset, crc32)
-    return entries, f.write_sha()
+        count += 1
+    return entries, count
 
 
 def write_pack_index_v1(f, entries, pack_checksum):
@@ -1648,47 +3258,195 @@ def _encode_copy_operation(start, length):
     return bytearray([op] + scratch)
 
 
+# Size of the blocks the base buffer is indexed by, like git's RABIN_WINDOW.
+_DELTA_BLOCK_SIZE = 16
+
+# Maximum number of base offsets remembered for a single block, like git's
+# HASH_LIMIT. Keeps highly repetitive bases from degrading matching.
+_DELTA_HASH_LIMIT = 64
+
+# Maximum number of literal bytes in a single insert operation.
+_MAX_INSERT_LEN = 0x7f
+
+
+def _encode_insert_operations(out_buf, data):
+    """Append insert operations for the literal data to out_buf."""
+    for i in range(0, len(data), _MAX_INSERT_LEN):
+        chunk = data[i:i+_MAX_INSERT_LEN]
+        out_buf.append(len(chunk))
+        out_buf += chunk
+
+
+def _match_length(base_buf, base_start, target_buf, target_start, limit):
+    """Find the length of the common run of two buffers, up to limit.
+
+    Bisects on slice comparisons, so the bytes are compared in C.
+    """
+    lo = 0
+    hi = min(limit, len(base_buf) - base_start, len(target_buf) - target_start)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if (base_buf[base_start:base_start+mid] ==
+                target_buf[target_start:target_start+mid]):
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+class DeltaIndex(object):
+    """Index over a delta base buffer, modelled on git's diff-delta.
+
+    The base is cut into fixed-size blocks which are hashed into a lookup
+    table. A target is then scanned with a sliding window of the same size;
+    every window that hits the table is extended into the longest matching run
+    of the base and emitted as a copy operation. Everything else is emitted as
+    literal inserts.
+
+    An index can be reused to create deltas against the same base for any
+    number of targets.
+    """
+
+    def __init__(self, base_buf):
+        """Create a new DeltaIndex.
+
+        :param base_buf: Base buffer
+        """
+        assert isinstance(base_buf, bytes)
+        self.base_buf = base_buf
+        # Tiny bases are indexed as a single block, so they can still be
+        # used as a whole.
+        self._block_size = max(1, min(_DELTA_BLOCK_SIZE, len(base_buf)))
+        self._blocks = {}
+        for offset in range(0, len(base_buf) - self._block_size + 1,
+                            self._block_size):
+            block = base_buf[offset:offset+self._block_size]
+            offsets = self._blocks.setdefault(block, [])
+            if len(offsets) < _DELTA_HASH_LIMIT:
+                offsets.append(offset)
+
+    def __len__(self):
+        """Return the size of the base buffer."""
+        return len(self.base_buf)
+
+    def _find_match(self, target_buf, target_start):
+        """Find the longest copy from the base for a target offset.
+
+        :return: Tuple with base offset and length of the match, or None if
+            the block at target_start does not occur in the base.
+        """
+        offsets = self._blocks.get(
+            target_buf[target_start:target_start+self._block_size])
+        if not offsets:
+            return None
+        best_offset = None
+        best_length = 0
+        for offset in offsets:
+            length = _match_length(self.base_buf, offset, target_buf,
+                                   target_start, _MAX_COPY_LEN)
+            if length > best_length:
+                best_offset, best_length = offset, length
+                if length == _MAX_COPY_LEN:
+                    break
+        return best_offset, best_length
+
+    @staticmethod
+    def _insert_limit(out_buf, insert_start, max_size):
+        """Find how far literal data from insert_start can go within max_size.
+
+        :return: Target offset beyond which the delta is certainly too large
+        """
+        if max_size is None:
+            return sys.maxsize
+        room = max_size - len(out_buf)
+        # Every _MAX_INSERT_LEN bytes of literal data take an opcode byte.
+        return insert_start + room - (room + _MAX_INSERT_LEN) // (
+            _MAX_INSERT_LEN + 1)
+
+    def create_delta(self, target_buf, max_size=None):
+        """Create a delta that transforms the base buffer into target_buf.
+
+        :param target_buf: Target buffer
+        :param max_size: Optional maximum size for the delta; if the delta
+            would be larger, None is returned instead.
+        :return: Delta as a byte string, or None
+        """
+        assert isinstance(target_buf, bytes)
+        base_buf = self.base_buf
+        out_buf = bytearray()
+        # write delta header
+        out_buf += _delta_encode_size(len(base_buf))
+        out_buf += _delta_encode_size(len(target_buf))
+        # write out delta opcodes
+        if 0 < len(target_buf) < self._block_size:
+            # Too short to hit the index; copy it whole if the base has it.
+            copy_start = base_buf.find(target_buf)
+            if copy_start != -1:
+                out_buf += _encode_copy_operation(copy_start, len(target_buf))
+                if max_size is not None and len(out_buf) > max_size:
+                    return None
+                return bytes(out_buf)
+        insert_start = 0
+        insert_limit = self._insert_limit(out_buf, insert_start, max_size)
+        i = 0
+        blocks = self._blocks
+        block_size = self._block_size
+        last = len(target_buf) - block_size
+        while i <= last:
+            if target_buf[i:i+block_size] not in blocks:
+                i += 1
+                if i > insert_limit:
+                    # Like git, give up as soon as the pending literal data
+                    # can no longer fit, rather than scanning the rest.
+                    return None
+                continue
+            copy_start, copy_len = self._find_match(target_buf, i)
+            # Grow the match backwards over pending literal data.
+            while (i > insert_start and copy_start > 0 and
+                   base_buf[copy_start-1:copy_start] ==
+                   target_buf[i-1:i] and copy_len < _MAX_COPY_LEN):
+                copy_start -= 1
+                copy_len += 1
+                i -= 1
+            _encode_insert_operations(out_buf, target_buf[insert_start:i])
+            out_buf += _encode_copy_operation(copy_start, copy_len)
+            i += copy_len
+            insert_start = i
+            if max_size is not None and len(out_buf) > max_size:
+                return None
+            insert_limit = self._insert_limit(out_buf, insert_start, max_size)
+        _encode_insert_operations(out_buf, target_buf[insert_start:])
+        if max_size is not None and len(out_buf) > max_size:
+            return None
+        return bytes(out_buf)
+
+
 def create_delta(base_buf, target_buf):
-    """Use python difflib to work out how to transform base_buf to target_buf.
+    """Work out how to transform base_buf to target_buf.
 
     :param base_buf: Base buffer
     :param target_buf: Target buffer
     """
     assert isinstance(base_buf, bytes)
     assert isinstance(target_buf, bytes)
-    out_buf = bytearray()
-    # write delta header
-    out_buf += _delta_encode_size(len(base_buf))
-    out_buf += _delta_encode_size(len(target_buf))
-    # write out delta opcodes
-    seq = difflib.SequenceMatcher(a=base_buf, b=target_buf)
-    for opcode, i1, i2, j1, j2 in seq.get_opcodes():
-        # Git patch opcodes don't care about deletes!
-        #if opcode == 'replace' or opcode == 'delete':
-        #    pass
-        if opcode == 'equal':
-            # If they are equal, unpacker will use data from base_buf
-            # Write out an opcode that says what range to use
-            copy_start = i1
-            copy_len = i2 - i1
-            while copy_len > 0:
-                to_copy = min(copy_len, _MAX_COPY_LEN)
-                out_buf += _encode_copy_operation(copy_start, to_copy)
-                copy_start += to_copy
-                copy_len -= to_copy
-        if opcode == 'replace' or opcode == 'insert':
-            # If we are replacing a range or adding one, then we just
-            # output it to the stream (prefixed by its size)
-            s = j2 - j1
-            o = j1
-            while s > 127:
-                out_buf.append(127)
-                out_buf += bytearray(target_buf[o:o+127])
-                s -= 127
-                o += 127
-            out_buf.append(s)
-            out_buf += bytearray(target_buf[o:o+s])
-    return bytes(out_buf)
+    return DeltaIndex(base_buf).create_delta(target_buf)
+
+
+def _get_delta_header_size(delta, index):
+    """Decode one of the sizes at the start of a delta.
+
+    :return: Tuple with the size and the index just after it
+    """
+    size = 0
+    i = 0
+    while delta:
+        cmd = ord(delta[index:index+1])
+        index += 1
+        size |= (cmd & ~0x80) << i
+        i += 7
+        if not cmd & 0x80:
+            break
+    return size, index
 
 
 def apply_delta(src_buf, delta):
@@ -1704,19 +3462,8 @@ def apply_delta(src_buf, delta):
     out = []
     index = 0
     delta_length = len(delta)
-    def get_delta_header_size(delta, index):
-        size = 0
-        i = 0
-        while delta:
-            cmd = ord(delta[index:index+1])
-            index += 1
-            size |= (cmd & ~0x80) << i
-            i += 7
-            if not cmd & 0x80:
-                break
-        return size, index
-    src_size, index = get_delta_header_size(delta, index)
-    dest_size, index = get_delta_header_size(delta, index)
+    src_size, index = _get_delta_header_size(delta, index)
+    dest_size, index = _get_delta_header_size(delta, index)
     assert src_size == len(src_buf), '%d vs %d' % (src_size, len(src_buf))
     while index < delta_length:
         cmd = ord(delta[index:index+1])
@@ -1794,18 +3541,134 @@ def write_pack_index_v2(f, entries, pack_checksum):
     return f.write_sha()
 
 
+class PackFilePool(object):
+    """Bounded pool of the pack data and index files opened by packs.
+
+    When more files are open than the pool allows, the least recently used
+    one is dropped from its Pack, which opens it again the next time it is
+    needed. A dropped file is closed right away, or, if it is in use (see
+    Pack._acquire), once it is released.
+    """
+
+    def __init__(self, max_open_files=DEFAULT_MAX_OPEN_PACK_FILES):
+        self._lock = threading.Lock()
+        self._files = LRUCache(max_open_files, max_open_files)
+        # Keys of the files of packs that were garbage collected without
+        # being closed. Weak reference callbacks add them at any time, so
+        # they are only removed from _files while holding the lock.
+        self._collected = []
+        self.opens = 0
+        self.evictions = 0
+        self.reuses = 0
+
+    def _remove_collected(self):
+        while self._collected:
+            key = self._collected.pop()
+            ref = self._files.get(key)
+            if ref is not None and ref() is None:
+                self._files.remove(key, cleanup=False)
+
+    def resize(self, max_open_files):
+        """Change the maximum number of open files."""
+        with self._lock:
+            self._remove_collected()
+            self._files.resize(max_open_files, max_open_files)
+
+    def opened(self, pack, kind):
+        """Record that a pack opened one of its files.
+
+        :param pack: The Pack
+        :param kind: 'data' or 'index'
+        """
+        key = (id(pack), kind)
+        ref = weakref.ref(pack, lambda ref: self._collected.append(key))
+        with self._lock:
+            self._remove_collected()
+            self.opens += 1
+            self._files.add(key, ref, self._evict)
+
+    def used(self, pack, kind):
+        """Record that an open file of a pack is used again."""
+        with self._lock:
+            self._remove_collected()
+            try:
+                self._files[(id(pack), kind)]
+            except KeyError:
+                return
+            self.reuses += 1
+
+    def discard(self, pack):
+        """Forget about the files of a pack that is being closed."""
+        with self._lock:
+            for kind in ('data', 'index'):
+                self._files.remove((id(pack), kind), cleanup=False)
+
+    def _evict(self, key, ref):
+        pack = ref()
+        if pack is not None and pack._drop_file(key[1]):
+            self.evictions += 1
+
+    def stats(self):
+        """Return statistics for this pool.
+
+        :return: Dictionary with the number of files opened, evicted and
+            reused so far, and the number of files that are currently open
+        """
+        with self._lock:
+            self._remove_collected()
+            return {
+                'opens': self.opens,
+                'evictions': self.evictions,
+                'reuses': self.reuses,
+                'open': len(self._files),
+                'max_open': self._files.cache_size(),
+                }
+
+
+# The pool that the files of all Pack objects are in, unless they are
+# created from objects.
+pack_file_pool = PackFilePool()
+
+# The SharedIndexMaps that Pack objects map their index files through by
+# default; None to give every index its own map.
+pack_index_maps = None
+
+
 class Pack(object):
     """A Git pack object."""
 
-    def __init__(self, basename, resolve_ext_ref=None):
+    def __init__(self, basename, resolve_ext_ref=None, use_mmap=False,
+                 delta_base_cache_limit=None, file_pool=None,
+                 shared_index_maps=None):
         self._basename = basename
         self._data = None
         self._idx = None
+        # Number of users of the pack data and index, by id (see _acquire),
+        # and the files that were dropped while in use, by the id of the
+        # pack data or index they go with.
+        self._users_lock = threading.Lock()
+        self._users = {}
+        self._retired = {}
         self._idx_path = self._basename + '.idx'
         self._data_path = self._basename + '.pack'
-        self._data_load = lambda: PackData(self._data_path)
-        self._idx_load = lambda: load_pack_index(self._idx_path)
+        self._data_load = lambda: PackData(
+            self._data_path, use_mmap=use_mmap,
+            delta_base_cache_limit=delta_base_cache_limit)
+        if shared_index_maps is None:
+            shared_index_maps = pack_index_maps
+        self._idx_load = lambda: load_pack_index(
+            self._idx_path, shared_maps=shared_index_maps)
+        self._bitmap = None
+        self._bitmap_loaded = False
+        self._bitmap_path = self._basename + '.bitmap'
+        self._bitmap_load = self._load_bitmap
+        self._rev = None
+        self._rev_path = self._basename + '.rev'
+        self._rev_load = self._load_reverse_index
         self.resolve_ext_ref = resolve_ext_ref
+        if file_pool is None:
+            file_pool = pack_file_pool
+        self._file_pool = file_pool
 
     @classmethod
     def from_lazy_objects(self, data_fn, idx_fn):
@@ -1814,6 +3677,9 @@ class Pack(object):
         ret = Pack('')
         ret._data_load = data_fn
         ret._idx_load = idx_fn
+        ret._bitmap_load = lambda: None
+        ret._rev_load = lambda: PackReverseIndex.from_index(ret.index)
+        ret._file_pool = None
         return ret
 
     @classmethod
@@ -1822,20 +3688,29 @@ class Pack(object):
         ret = Pack('')
         ret._data_load = lambda: data
         ret._idx_load = lambda: idx
+        ret._bitmap_load = lambda: None
+        ret._rev_load = lambda: PackReverseIndex.from_index(ret.index)
+        ret._file_pool = None
         return ret
 
     def name(self):
         """The SHA over the SHAs of the objects in this pack."""
-        return self.index.objects_sha1()
+        with self._using('index') as index:
+            return index.objects_sha1()
 
     @property
     def data(self):
         """The pack data object being used."""
-        if self._data is None:
-            self._data = self._data_load()
-            self._data.pack = self
+        data = self._data
+        if data is None:
+            data = self._data = self._data_load()
+            data.pack = self
             self.check_length_and_checksum()
-        return self._data
+            if self._file_pool is not None:
+                self._file_pool.opened(self, 'data')
+        elif self._file_pool is not None:
+            self._file_pool.used(self, 'data')
+        return data
 
     @property
     def index(self):
@@ -1843,15 +3718,133 @@ class Pack(object):
 
         :note: This may be an in-memory index
         """
-        if self._idx is None:
-            self._idx = self._idx_load()
-        return self._idx
+        idx = self._idx
+        if idx is None:
+            idx = self._idx = self._idx_load()
+            if self._file_pool is not None:
+                self._file_pool.opened(self, 'index')
+        elif self._file_pool is not None:
+            self._file_pool.used(self, 'index')
+        return idx
+
+    def _acquire(self, kind):
+        """Get the pack data or index, and keep it open until it is released.
+
+        If the file pool drops it in the meantime, it is only closed once
+        every user has released it.
+
+        :param kind: 'data' or 'index'
+        :return: The PackData or PackIndex; pass it to _release when done
+        """
+        while True:
+            if kind == 'data':
+                f = self.data
+            else:
+                f = self.index
+            with self._users_lock:
+                if f is (self._data if kind == 'data' else self._idx):
+                    self._users[id(f)] = self._users.get(id(f), 0) + 1
+                    return f
+            # Dropped by another thread before it could be acquired
+
+    def _release(self, f):
+        """Release pack data or an index returned by _acquire."""
+        with self._users_lock:
+            users = self._users.pop(id(f)) - 1
+            if users:
+                self._users[id(f)] = users
+                return
+            retired = self._retired.pop(id(f), [])
+        for dropped in retired:
+            dropped.close()
+
+    @contextmanager
+    def _using(self, kind):
+        f = self._acquire(kind)
+        try:
+            yield f
+        finally:
+            self._release(f)
+
+    def _drop_file(self, kind):
+        """Drop the pack data or index, to be loaded again when needed.
+
+        The dropped file is closed, once it is no longer in use.
+
+        :param kind: 'data' or 'index'
+        :return: Whether anything was dropped
+        """
+        with self._users_lock:
+            if kind == 'data':
+                dropped, self._data = self._data, None
+                files = [dropped]
+            else:
+                dropped, self._idx = self._idx, None
+                # The bitmap and reverse index hold on to the index.
+                files = [dropped, self._bitmap]
+                self._bitmap = None
+                self._bitmap_loaded = False
+                self._rev = None
+            if dropped is None:
+                return False
+            files = [f for f in files if f is not None]
+            if id(dropped) in self._users:
+                self._retired[id(dropped)] = files
+                return True
+        for f in files:
+            f.close()
+        return True
+
+    def _load_bitmap(self):
+        from dulwich.bitmap import load_pack_bitmap
+        try:
+            return load_pack_bitmap(self._bitmap_path, self.index)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def _load_reverse_index(self):
+        try:
+            return load_pack_rev(self._rev_path, self.index)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return PackReverseIndex.from_index(self.index)
+            raise
+
+    @property
+    def reverse_index(self):
+        """The reverse index of this pack.
+
+        This is read from the .rev file if there is one, and built from the
+        index otherwise.
+        """
+        if self._rev is None:
+            self._rev = self._rev_load()
+        return self._rev
+
+    @property
+    def bitmap(self):
+        """The reachability bitmap for this pack, or None if it has none."""
+        if not self._bitmap_loaded:
+            self._bitmap = self._bitmap_load()
+            self._bitmap_loaded = True
+        return self._bitmap
 
     def close(self):
+        if self._file_pool is not None:
+            self._file_pool.discard(self)
         if self._data is not None:
             self._data.close()
         if self._idx is not None:
             self._idx.close()
+        if self._bitmap is not None:
+            self._bitmap.close()
+        with self._users_lock:
+            retired, self._retired = self._retired, {}
+        for files in retired.values():
+            for f in files:
+                f.close()
 
     def __enter__(self):
         return self
@@ -1871,7 +3864,9 @@ class Pack(object):
 
     def __iter__(self):
         """Iterate over all the sha1s of the objects in this pack."""
-        return iter(self.index)
+        with self._using('index') as index:
+            for sha in index:
+                yield sha
 
     def check_length_and_checksum(self):
         """Sanity check the length and checksum of the pack index and data."""
@@ -1887,38 +3882,151 @@ class Pack(object):
 
         :raise ChecksumMismatch: if a checksum for the index or data is wrong
         """
-        self.index.check()
-        self.data.check()
+        with self._using('index') as index:
+            index.check()
+        with self._using('data') as data:
+            data.check()
         for obj in self.iterobjects():
             obj.check()
         # TODO: object connectivity checks
 
     def get_stored_checksum(self):
-        return self.data.get_stored_checksum()
+        with self._using('data') as data:
+            return data.get_stored_checksum()
 
     def __contains__(self, sha1):
         """Check whether this pack contains a particular SHA1."""
-        try:
-            self.index.object_index(sha1)
-            return True
-        except KeyError:
-            return False
+        with self._using('index') as index:
+            try:
+                index.object_index(sha1)
+                return True
+            except KeyError:
+                return False
 
     def get_raw(self, sha1):
-        offset = self.index.object_index(sha1)
-        obj_type, obj = self.data.get_object_at(offset)
-        type_num, chunks = self.data.resolve_object(offset, obj_type, obj)
+        with self._using('index') as index:
+            offset = index.object_index(sha1)
+        return self.get_raw_at(offset)
+
+    def get_raw_at(self, offset):
+        """Retrieve the type and contents of the object at an offset.
+
+        :param offset: Offset of the object in the pack data
+        :return: Tuple with type number and contents
+        """
+        # Resolving external delta bases may use other packs, which can make
+        # the file pool drop the pack data.
+        with self._using('data') as data:
+            obj_type, obj = data.get_object_at(offset)
+            type_num, chunks = data.resolve_object(offset, obj_type, obj)
         return type_num, b''.join(chunks)
 
+    def get_object_info(self, sha1):
+        """Find the type and size of an object, without inflating it.
+
+        :param sha1: SHA1 of the object
+        :return: Tuple with type number and size
+        :raise KeyError: if the object is not in this pack
+        """
+        with self._using('index') as index:
+            offset = index.object_index(sha1)
+        with self._using('data') as data:
+            return data.get_object_info_at(offset)
+
+    def offset_to_sha(self, offset):
+        """Find the object at an offset in the pack.
+
+        :param offset: Offset of the object in the pack data
+        :return: Binary SHA1 of the object
+        :raise KeyError: if no object starts at offset
+        """
+        with self._using('index'):
+            rev = self.reverse_index
+            return rev.sha(rev.pack_position(offset))
+
+    def compressed_size(self, sha1):
+        """Find the size an object takes up in the pack.
+
+        :param sha1: SHA1 of the object
+        :return: Size of the object in the pack data, including its header
+        :raise KeyError: if the object is not in this pack
+        """
+        with self._using('index') as index:
+            offset = index.object_index(sha1)
+            rev = self.reverse_index
+            i = rev.pack_position(offset)
+            if i + 1 < len(rev):
+                return rev.offset(i + 1) - offset
+        # The pack ends with the checksum of the pack.
+        with self._using('data') as data:
+            return data._get_size() - 20 - offset
+
+    def iter_raw_at(self, offsets):
+        """Retrieve the type and contents of the objects at a set of offsets.
+
+        The objects are read in offset order, and delta bases are shared
+        between them, so that the pack is read sequentially and bases used
+        by several of the objects are only resolved once.
+
+        :param offsets: Iterable over offsets of objects in the pack data
+        :return: Iterator over (offset, type_num, contents) tuples, in offset
+            order
+        """
+        base_cache = LRUSizeCache(_BATCH_BASE_CACHE_SIZE,
+                                  compute_size=_compute_object_size)
+        with self._using('data') as data:
+            for offset in sorted(set(offsets)):
+                if offset in base_cache:
+                    type_num, chunks = base_cache[offset]
+                else:
+                    obj_type, obj = data.get_object_at(offset)
+                    type_num, chunks = data.resolve_object(
+                        offset, obj_type, obj, base_cache=base_cache)
+                yield offset, type_num, b''.join(chunks)
+
     def __getitem__(self, sha1):
         """Retrieve the specified SHA1."""
         type, uncomp = self.get_raw(sha1)
         return ShaFile.from_raw_string(type, uncomp, sha=sha1)
 
+    def get_unpacked_object(self, sha1, include_comp=False):
+        """Get the UnpackedObject for an object, as it is stored in this pack.
+
+        Deltas are not resolved; OFS_DELTA entries are converted to
+        REF_DELTA entries, so they can be used outside of this pack.
+
+        :param sha1: SHA1 of the object
+        :param include_comp: If True, include compressed data in the result.
+        :return: UnpackedObject
+        :raise KeyError: if the object is not in this pack
+        :raise ChecksumMismatch: if the packed object does not match the CRC32
+            stored in the index
+        """
+        if len(sha1) == 40:
+            sha1 = hex_to_sha(sha1)
+        with self._using('index') as index:
+            offset = index.object_index(sha1)
+            expected_crc32 = index.object_crc32(sha1)
+        with self._using('data') as data:
+            unpacked = data.get_unpacked_object_at(
+                offset, include_comp=include_comp)
+        if expected_crc32 is not None and expected_crc32 != unpacked.crc32:
+            raise ChecksumMismatch(
+                '%08x' % expected_crc32, '%08x' % unpacked.crc32,
+                'CRC32 of %s' % sha_to_hex(sha1).decode('ascii'))
+        if unpacked.pack_type_num == OFS_DELTA:
+            unpacked.delta_base = self.offset_to_sha(
+                offset - unpacked.delta_base)
+            unpacked.pack_type_num = REF_DELTA
+        unpacked._sha = sha1
+        return unpacked
+
     def iterobjects(self):
         """Iterate over the objects in this pack."""
-        return iter(PackInflater.for_pack_data(
-            self.data, resolve_ext_ref=self.resolve_ext_ref))
+        with self._using('data') as data:
+            for obj in PackInflater.for_pack_data(
+                    data, resolve_ext_ref=self.resolve_ext_ref):
+                yield obj
 
     def pack_tuples(self):
         """Provide an iterable for use with write_pack_objects.
@@ -28,12 +28,15 @@ Currently implemented:
  * daemon
  * diff-tree
  * fetch
+ * gc
  * init
  * ls-remote
+ * multi-pack-index{_write}
  * pull
  * push
  * rm
  * receive-pack
+ * repack
  * reset
  * rev-list
  * tag{_create,_delete,_list}
@@ -67,6 +70,7 @@ from dulwich.errors import (
     )
 from dulwich.index import get_unstaged_changes
 from dulwich.objects import (
+    Commit,
     Tag,
     parse_timezone,
     )
@@ -138,6 +142,77 @@ def update_server_info(repo="."):
         server_update_server_info(r)
 
 
+def multi_pack_index_write(repo="."):
+    """Write or refresh the multi-pack index of a repository.
+
+    :param repo: path to the repository
+    """
+    with open_repo_closing(repo) as r:
+        r.object_store.write_multi_pack_index()
+
+
+def _bitmap_commits(r):
+    """Find the commits to write pack bitmaps for: those refs point at."""
+    commits = set()
+    for ref in r.get_refs():
+        sha = r.get_peeled(ref)
+        if sha in r.object_store and isinstance(r[sha], Commit):
+            commits.add(sha)
+    return commits
+
+
+def repack(repo=".", geometric=None, write_bitmaps=False):
+    """Repack the objects in a repository.
+
+    :param repo: path to the repository
+    :param geometric: Optional geometric factor; if set, only merge the
+        packs needed to keep a geometric progression of pack sizes
+    :param write_bitmaps: Whether to write reachability bitmaps for the
+        commits refs point at; ignored with geometric
+    :return: The new pack, or None if there was nothing to repack
+    """
+    with open_repo_closing(repo) as r:
+        bitmap_commits = None
+        if write_bitmaps:
+            bitmap_commits = _bitmap_commits(r)
+        return r.object_store.repack(geometric_factor=geometric,
+                                     bitmap_commits=bitmap_commits)
+
+
+def gc(repo=".", prune=True, grace_period=14 * 24 * 60 * 60,
+       write_bitmaps=False):
+    """Pack all reachable objects of a repository into a single pack.
+
+    :param repo: path to the repository
+    :param prune: Whether to remove unreachable objects
+    :param grace_period: Number of seconds unreachable objects are kept
+        around for (as loose objects), for the benefit of concurrent writers
+    :param write_bitmaps: Whether to write reachability bitmaps for the
+        commits refs point at
+    :return: The new pack, or None if there was nothing to repack
+    """
+    with open_repo_closing(repo) as r:
+        bitmap_commits = None
+        if write_bitmaps:
+            bitmap_commits = _bitmap_commits(r)
+        if not prune:
+            return r.object_store.repack(bitmap_commits=bitmap_commits)
+        wants = [sha for sha in r.get_refs().values()
+                 if sha in r.object_store]
+
+        def get_parents(commit):
+            # Honour grafts and shallow commits, whose parents are missing.
+            return r.get_parents(commit.id, commit)
+        reachable = list(r.object_store.find_missing_objects(
+            [], wants, get_parents=get_parents))
+        if r.has_index():
+            reachable.extend(
+                (sha, path) for (path, sha, mode) in r.open_index().iterblobs())
+        return r.object_store.repack(
+            reachable=reachable, expire=time.time() - grace_period,
+            bitmap_commits=bitmap_commits)
+
+
 def symbolic_ref(repo, ref_name, force=False):
     """Set git symbolic ref into HEAD.
 
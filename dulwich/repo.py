@@ -274,6 +274,13 @@ class BaseRepo(object):
             haves = []  # TODO: filter the haves commits from iter_shas.
                         # the specific commits aren't missing.
 
+        if not shallows and not self._graftpoints:
+            # Let the object store use its own (possibly faster) means of
+            # traversing the commit graph.
+            return self.object_store.iter_shas(
+                self.object_store.find_missing_objects(
+                    haves, wants, progress, get_tagged))
+
         def get_parents(commit):
             if commit.id in shallows:
                 return []
@@ -350,7 +357,7 @@ class BaseRepo(object):
             return self._graftpoints[sha]
         except KeyError:
             if commit is None:
-                commit = self[sha]
+                return self.object_store.get_parents(sha)
             return commit.parents
 
     def get_config(self):
@@ -432,7 +439,9 @@ class BaseRepo(object):
         if isinstance(include, str):
             include = [include]
 
-        kwargs['get_parents'] = lambda commit: self.get_parents(commit.id, commit)
+        if self._graftpoints:
+            kwargs['get_parents'] = lambda commit: self.get_parents(
+                commit.id, commit)
 
         return Walker(self.object_store, include, *args, **kwargs)
 
@@ -54,6 +54,7 @@ from dulwich.errors import (
     ApplyDeltaError,
     ChecksumMismatch,
     GitProtocolError,
+    NotCommitError,
     NotGitRepository,
     UnexpectedCommandError,
     ObjectFormatException,
@@ -64,7 +65,10 @@ from dulwich.objects import (
     valid_hexsha,
     )
 from dulwich.pack import (
-    write_pack_objects,
+    generate_pack_records,
+    generate_thin_pack_records,
+    order_pack_objects,
+    write_pack_data,
     )
 from dulwich.protocol import (
     BufferedPktLineWriter,
@@ -274,7 +278,7 @@ class UploadPackHandler(Handler):
 
     @classmethod
     def required_capabilities(cls):
-        return (CAPABILITY_SIDE_BAND_64K, CAPABILITY_THIN_PACK, CAPABILITY_OFS_DELTA)
+        return (CAPABILITY_SIDE_BAND_64K, CAPABILITY_THIN_PACK)
 
     def progress(self, message):
         if self.has_capability(CAPABILITY_NO_PROGRESS) or self._processing_have_lines:
@@ -343,7 +347,24 @@ class UploadPackHandler(Handler):
 
         self.progress(b"dul-daemon says what\n")
         self.progress(("counting objects: %d, done.\n" % len(objects_iter)).encode('ascii'))
-        write_pack_objects(ProtocolFile(None, write), objects_iter)
+        # Copy objects that are already packed verbatim, rather than
+        # inflating and recompressing them.
+        object_store = self.repo.object_store
+        objects = order_pack_objects(
+            objects_iter.itershas(),
+            lambda sha: object_store.get_object_info(sha)[0])
+        if self.has_capability(CAPABILITY_THIN_PACK) and graph_walker.common:
+            # Use the objects the client has as delta bases.
+            records = generate_thin_pack_records(
+                object_store, objects,
+                object_store.find_thin_pack_bases(graph_walker.common,
+                                                  objects))
+        else:
+            records = generate_pack_records(
+                object_store, [sha for (sha, path) in objects])
+        write_pack_data(
+            ProtocolFile(None, write), len(objects), records,
+            ofs_delta=self.has_capability(CAPABILITY_OFS_DELTA))
         self.progress(b"how was that, then?\n")
         # we are done
         self.proto.write_pkt_line(None)
@@ -401,7 +422,7 @@ def _find_shallow(store, heads, depth):
     def get_parents(sha):
         result = parents.get(sha, None)
         if not result:
-            result = store[sha].parents
+            result = store.get_parents(sha)
             parents[sha] = result
         return result
 
@@ -425,21 +446,27 @@ def _find_shallow(store, heads, depth):
     return shallow, not_shallow
 
 
-def _want_satisfied(store, haves, want, earliest):
-    o = store[want]
-    pending = collections.deque([o])
+def _want_satisfied(store, haves, want, earliest, min_generation=None):
+    pending = collections.deque([want])
     while pending:
-        commit = pending.popleft()
-        if commit.id in haves:
+        sha = pending.popleft()
+        if sha in haves:
             return True
-        if commit.type_name != b"commit":
+        try:
+            parents = store.get_parents(sha)
+        except NotCommitError:
             # non-commit wants are assumed to be satisfied
             continue
-        for parent in commit.parents:
-            parent_obj = store[parent]
+        for parent in parents:
+            if min_generation is not None:
+                # Commits with a lower generation number than all haves can
+                # not be or reach any of them.
+                generation = store.get_generation(parent)
+                if generation is not None and generation < min_generation:
+                    continue
             # TODO: handle parents with later commit times than children
-            if parent_obj.commit_time >= earliest:
-                pending.append(parent_obj)
+            if store.get_commit_time(parent) >= earliest:
+                pending.append(parent)
     return False
 
 
@@ -454,12 +481,18 @@ def _all_wants_satisfied(store, haves, wants):
     """
     haves = set(haves)
     if haves:
-        earliest = min([store[h].commit_time for h in haves])
+        earliest = min([store.get_commit_time(h) for h in haves])
+        generations = [store.get_generation(h) for h in haves]
+        if None in generations:
+            min_generation = None
+        else:
+            min_generation = min(generations)
     else:
         earliest = 0
+        min_generation = None
     unsatisfied_wants = set()
     for want in wants:
-        if not _want_satisfied(store, haves, want, earliest):
+        if not _want_satisfied(store, haves, want, earliest, min_generation):
             return False
 
     return True
@@ -489,6 +522,9 @@ class ProtocolGraphWalker(object):
         self.shallow = set()
         self.client_shallow = set()
         self.unshallow = set()
+        # Haves of the client that the server has as well, in the order in
+        # which they were acknowledged.
+        self.common = []
         self._cached = False
         self._cache = []
         self._cache_index = 0
@@ -567,6 +603,7 @@ class ProtocolGraphWalker(object):
     def ack(self, have_ref):
         if len(have_ref) != 40:
             raise ValueError("invalid sha %r" % have_ref)
+        self.common.append(have_ref)
         return self._impl.ack(have_ref)
 
     def reset(self):
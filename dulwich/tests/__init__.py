@@ -115,8 +115,11 @@ class BlackboxTestCase(TestCase):
 
 def self_test_suite():
     names = [
+        'bitmap',
         'blackbox',
+        'bloom',
         'client',
+        'commit_graph',
         'config',
         'diff_tree',
         'fastexport',
@@ -126,6 +129,7 @@ def self_test_suite():
         'hooks',
         'index',
         'lru_cache',
+        'midx',
         'objects',
         'objectspec',
         'object_store',
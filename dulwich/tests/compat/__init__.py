@@ -23,7 +23,10 @@ import unittest
 
 def test_suite():
     names = [
+        'bitmap',
         'client',
+        'commit_graph',
+        'midx',
         'pack',
         'repository',
         'server',
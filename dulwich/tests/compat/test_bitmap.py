@@ -0,0 +1,92 @@
+# test_bitmap.py -- Compatibility tests for pack bitmap indexes
+# Copyright (C) 2015 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Compatibility tests for pack bitmap indexes."""
+
+from dulwich.bitmap import (
+    build_pack_bitmap,
+    iter_bits,
+    write_pack_bitmap,
+    )
+from dulwich.file import GitFile
+from dulwich.object_store import (
+    MissingObjectFinder,
+    )
+from dulwich.objects import (
+    sha_to_hex,
+    )
+from dulwich.repo import Repo
+from dulwich.tests.compat.utils import (
+    CompatTestCase,
+    run_git_or_fail,
+    )
+
+
+class PackBitmapTests(CompatTestCase):
+    """Tests for reading and writing bitmaps that git understands."""
+
+    min_git_version = (2, 0, 0)
+
+    def setUp(self):
+        super(PackBitmapTests, self).setUp()
+        self._repo = self.import_repo('server_new.export')
+
+    def _run_git(self, args):
+        return run_git_or_fail(args, cwd=self._repo.path)
+
+    def _open_repo(self):
+        repo = Repo(self._repo.path)
+        self.addCleanup(repo.close)
+        return repo
+
+    def _walk(self, store, haves, wants):
+        finder = MissingObjectFinder(store, haves, wants)
+        return set(sha for (sha, path) in iter(finder.next, None))
+
+    def test_read(self):
+        self._run_git(['repack', '-a', '-d', '-b'])
+        repo = self._open_repo()
+        store = repo.object_store
+        pack, = store.packs
+        bitmap = pack.bitmap
+        self.assertNotEqual(None, bitmap)
+        self.assertTrue(len(bitmap) > 0)
+        for commit in bitmap:
+            self.assertEqual(
+                self._walk(store, [], [sha_to_hex(commit)]),
+                set(sha_to_hex(bitmap.sha_at(pos))
+                    for pos in iter_bits(bitmap.get(commit))))
+        head = repo.head()
+        for haves, wants in [([], [head]), (repo[head].parents, [head])]:
+            self.assertEqual(
+                self._walk(store, haves, wants),
+                set(sha for (sha, path) in
+                    store.find_missing_objects(haves, wants)))
+
+    def test_write(self):
+        self._run_git(['repack', '-a', '-d'])
+        repo = self._open_repo()
+        pack, = repo.object_store.packs
+        heads = [sha for (ref, sha) in repo.get_refs().items()
+                 if ref.startswith(b'refs/heads/')]
+        bitmap = build_pack_bitmap(pack, heads)
+        with GitFile(pack._basename + '.bitmap', 'wb') as f:
+            write_pack_bitmap(f, bitmap)
+        output = self._run_git(['rev-list', '--test-bitmap', 'HEAD'])
+        self.assertIn(b'OK!', output)
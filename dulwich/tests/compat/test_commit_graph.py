@@ -0,0 +1,101 @@
+# test_commit_graph.py -- Compatibility tests for commit-graph files
+# Copyright (C) 2015 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Compatibility tests for commit-graph files."""
+
+from dulwich.bloom import (
+    BloomFilter,
+    commit_changed_paths,
+    )
+from dulwich.objects import (
+    Commit,
+    sha_to_hex,
+    )
+from dulwich.repo import Repo
+from dulwich.tests.compat.utils import (
+    CompatTestCase,
+    run_git_or_fail,
+    )
+
+
+class CommitGraphTests(CompatTestCase):
+    """Tests for reading and writing commit-graph files that git understands."""
+
+    min_git_version = (2, 18, 0)
+
+    def setUp(self):
+        super(CommitGraphTests, self).setUp()
+        self._repo = self.import_repo('server_new.export')
+
+    def _run_git(self, args):
+        return run_git_or_fail(args, cwd=self._repo.path)
+
+    def _open_repo(self):
+        repo = Repo(self._repo.path)
+        self.addCleanup(repo.close)
+        return repo
+
+    def test_read(self):
+        self._run_git(['commit-graph', 'write', '--reachable'])
+        repo = self._open_repo()
+        store = repo.object_store
+        graph = store.commit_graph
+        self.assertNotEqual(None, graph)
+        graph.check()
+        commits = [store[sha] for sha in store
+                   if isinstance(store[sha], Commit)]
+        self.assertEqual(len(commits), len(graph))
+        for commit in commits:
+            self.assertEqual(commit.parents, graph.get_parents(commit.id))
+            self.assertEqual(commit.tree, graph.get_tree(commit.id))
+            self.assertEqual(commit.commit_time,
+                             graph.get_commit_time(commit.id))
+            for parent in commit.parents:
+                self.assertTrue(graph.get_generation(parent) <
+                                graph.get_generation(commit.id))
+        self.assertEqual(
+            self._run_git(['rev-list', 'HEAD']).split(),
+            [entry.commit.id for entry in repo.get_walker()])
+
+    def test_write(self):
+        repo = self._open_repo()
+        heads = [sha for (ref, sha) in repo.get_refs().items()
+                 if ref.startswith(b'refs/heads/')]
+        repo.object_store.write_commit_graph(heads)
+        self._run_git(['commit-graph', 'verify'])
+
+    def test_read_changed_paths(self):
+        self._run_git(['commit-graph', 'write', '--reachable',
+                       '--changed-paths'])
+        repo = self._open_repo()
+        store = repo.object_store
+        for sha in store.commit_graph:
+            commit = store[sha_to_hex(sha)]
+            self.assertEqual(
+                BloomFilter.from_paths(commit_changed_paths(store, commit)),
+                store.get_bloom_filter(commit.id))
+
+    def test_write_changed_paths(self):
+        repo = self._open_repo()
+        repo.object_store.write_commit_graph([repo.head()], changed_paths=True)
+        self._run_git(['commit-graph', 'verify'])
+        for path in [b'foo', b'bar', b'baz', b'missing']:
+            self.assertEqual(
+                self._run_git(['log', '--format=%H', '--', path]).split(),
+                [entry.commit.id for entry in repo.get_walker(paths=[path])])
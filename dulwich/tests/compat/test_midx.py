@@ -0,0 +1,70 @@
+# test_midx.py -- Compatibility tests for multi-pack indexes
+# Copyright (C) 2015 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Compatibility tests for multi-pack indexes."""
+
+from dulwich.objects import (
+    Blob,
+    )
+from dulwich.repo import Repo
+from dulwich.tests.compat.utils import (
+    CompatTestCase,
+    run_git_or_fail,
+    )
+from dulwich.tests.utils import (
+    make_object,
+    )
+
+
+class MultiPackIndexTests(CompatTestCase):
+    """Tests for reading and writing multi-pack indexes that git understands."""
+
+    min_git_version = (2, 21, 0)
+
+    def setUp(self):
+        super(MultiPackIndexTests, self).setUp()
+        self._repo = self.import_repo('server_new.export')
+        self._run_git(['repack', '-a', '-d'])
+        self._blob = make_object(Blob, data=b'yummy data')
+        self._repo.object_store.add_objects([(self._blob, None)])
+
+    def _run_git(self, args):
+        return run_git_or_fail(args, cwd=self._repo.path)
+
+    def _open_repo(self):
+        repo = Repo(self._repo.path)
+        self.addCleanup(repo.close)
+        return repo
+
+    def test_read(self):
+        self._run_git(['multi-pack-index', 'write'])
+        repo = self._open_repo()
+        store = repo.object_store
+        self.assertEqual(2, len(store.packs))
+        self.assertEqual(2, len(store._midx.pack_names))
+        for sha in store:
+            self.assertTrue(store.contains_packed(sha))
+            self.assertEqual(sha, store[sha].id)
+
+    def test_write(self):
+        repo = self._open_repo()
+        repo.object_store.write_multi_pack_index()
+        self._run_git(['multi-pack-index', 'verify'])
+        output = self._run_git(['cat-file', '-p', self._blob.id])
+        self.assertEqual(b'yummy data', output)
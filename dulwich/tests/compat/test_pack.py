@@ -31,10 +31,9 @@ from dulwich.pack import (
     )
 from dulwich.objects import (
     Blob,
+    sha_to_hex,
     )
-from dulwich.tests import (
-    SkipTest,
-    )
+from dulwich.repo import Repo
 from dulwich.tests.test_pack import (
     a_sha,
     pack1_sha,
@@ -123,22 +122,16 @@ class TestPack(PackTests):
         # (new_blob_2), so let's verify that actually happens:
         self.assertIn(b'chain length = 2', output)
 
-    # This test is SUPER slow: over 80 seconds on a 2012-era
-    # laptop. This is because SequenceMatcher is worst-case quadratic
-    # on the input size. It's impractical to produce deltas for
-    # objects this large, but it's still worth doing the right thing
-    # when it happens.
     def test_delta_large_object(self):
         # This tests an object set that will have a copy operation
         # 2**25 in size. This is a copy large enough that it requires
         # two copy operations in git's binary delta format.
-        raise SkipTest('skipping slow, large test')
         with self.get_pack(pack1_sha) as orig_pack:
             orig_blob = orig_pack[a_sha]
             new_blob = Blob()
-            new_blob.data = 'big blob' + ('x' * 2 ** 25)
+            new_blob.data = b'big blob' + (b'x' * 2 ** 25)
             new_blob_2 = Blob()
-            new_blob_2.data = new_blob.data + 'y'
+            new_blob_2.data = new_blob.data + b'y'
             all_to_pack = list(orig_pack.pack_tuples()) + [(new_blob, None),
                                                            (new_blob_2, None)]
         pack_path = os.path.join(self._tempdir, "pack_with_deltas")
@@ -153,3 +146,21 @@ class TestPack(PackTests):
         self.assertEqual(
             4, got_non_delta,
             'Expected 4 non-delta objects, got %d' % got_non_delta)
+
+    def test_reverse_index(self):
+        require_git_version((2, 31, 0))
+        repo = Repo.init(os.path.join(self._tempdir, 'repo'), mkdir=True)
+        self.addCleanup(repo.close)
+        with self.get_pack(pack1_sha) as orig_pack:
+            pack = repo.object_store.add_objects(orig_pack.pack_tuples())
+        # git refuses to build the reverse index itself with this set
+        env = dict(os.environ, GIT_TEST_REV_INDEX_DIE_IN_MEMORY='1')
+        output = run_git_or_fail(
+            ['-c', 'pack.readReverseIndex=true', 'cat-file',
+             '--batch-all-objects', '--batch-check=%(objectname) '
+             '%(objectsize:disk)'], cwd=repo.path, env=env)
+        self.assertEqual(
+            sorted((sha_to_hex(sha), pack.compressed_size(sha))
+                   for (sha, offset, crc32) in pack.index.iterentries()),
+            sorted((line.split()[0], int(line.split()[1]))
+                   for line in output.splitlines()))
@@ -0,0 +1,267 @@
+# test_bitmap.py -- Tests for pack bitmap indexes
+# Copyright (C) 2015 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for pack bitmap indexes."""
+
+from io import BytesIO
+import os
+import shutil
+import tempfile
+
+from dulwich.bitmap import (
+    build_pack_bitmap,
+    iter_bits,
+    load_pack_bitmap,
+    read_ewah,
+    read_pack_bitmap,
+    write_ewah,
+    write_pack_bitmap,
+    )
+from dulwich.errors import (
+    ChecksumMismatch,
+    )
+from dulwich.file import GitFile
+from dulwich.object_store import (
+    DiskObjectStore,
+    MemoryObjectStore,
+    MissingObjectFinder,
+    )
+from dulwich.objects import (
+    Blob,
+    Commit,
+    Tree,
+    )
+from dulwich.pack import (
+    MemoryPackIndex,
+    Pack,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    make_object,
+    make_tag,
+    )
+
+
+class EWAHTests(TestCase):
+
+    def assertRoundtrips(self, bits):
+        f = BytesIO()
+        write_ewah(f, bits)
+        data = f.getvalue()
+        self.assertEqual((bits, len(data)), read_ewah(data))
+        self.assertEqual((bits, len(data) + 3), read_ewah(b'foo' + data, 3))
+
+    def test_empty(self):
+        f = BytesIO()
+        write_ewah(f, 0)
+        self.assertEqual(
+            b'\x00\x00\x00\x00\x00\x00\x00\x01' + b'\x00' * 8 +
+            b'\x00\x00\x00\x00', f.getvalue())
+        self.assertRoundtrips(0)
+
+    def test_literal(self):
+        f = BytesIO()
+        write_ewah(f, 5)
+        self.assertEqual(
+            b'\x00\x00\x00\x03\x00\x00\x00\x02' +
+            b'\x00\x00\x00\x02\x00\x00\x00\x00' +
+            b'\x00\x00\x00\x00\x00\x00\x00\x05' +
+            b'\x00\x00\x00\x00', f.getvalue())
+        self.assertRoundtrips(5)
+
+    def test_runs(self):
+        f = BytesIO()
+        write_ewah(f, ((1 << 640) - 1) << 6400)
+        # A run of clean zero words followed by a run of clean one words
+        self.assertEqual(8 + 2 * 8 + 4, len(f.getvalue()))
+        self.assertRoundtrips(((1 << 640) - 1) << 6400)
+        self.assertRoundtrips((1 << 64 * 3) - 1)
+        self.assertRoundtrips(1 << 100000)
+
+    def test_mixed(self):
+        bits = 0
+        for i in range(0, 5000, 7):
+            bits |= 1 << i
+        bits |= ((1 << 3000) - 1) << 6000
+        self.assertRoundtrips(bits)
+
+    def test_iter_bits(self):
+        self.assertEqual([], list(iter_bits(0)))
+        self.assertEqual([0, 2, 64, 200],
+                         list(iter_bits(1 | 4 | 1 << 64 | 1 << 200)))
+
+
+class PackBitmapTests(TestCase):
+
+    def setUp(self):
+        super(PackBitmapTests, self).setUp()
+        self.store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store_dir)
+        store = DiskObjectStore.init(self.store_dir)
+        source = MemoryObjectStore()
+        self.blob_a = make_object(Blob, data=b'a')
+        self.blob_b = make_object(Blob, data=b'b')
+        self.blob_c = make_object(Blob, data=b'c')
+        self.commits = build_commit_graph(
+            source, [[1], [2, 1], [3, 1], [4, 2, 3]],
+            trees={1: [(b'a', self.blob_a)],
+                   2: [(b'a', self.blob_a), (b'd/b', self.blob_b)],
+                   3: [(b'a', self.blob_c)],
+                   4: [(b'a', self.blob_c), (b'd/b', self.blob_b)]})
+        self.tag = make_tag(self.commits[1])
+        source.add_object(self.tag)
+        store.add_objects([(source[sha], None) for sha in source])
+        store.close()
+        self.source = source
+        pack_dir = os.path.join(self.store_dir, 'pack')
+        self.pack_path = os.path.join(pack_dir, [
+            name[:-len('.pack')] for name in os.listdir(pack_dir)
+            if name.endswith('.pack')][0])
+
+    def cmt(self, n):
+        return self.commits[n - 1]
+
+    def write_bitmap(self, commits):
+        with Pack(self.pack_path) as pack:
+            bitmap = build_pack_bitmap(pack, [c.id for c in commits])
+            with GitFile(self.pack_path + '.bitmap', 'wb') as f:
+                write_pack_bitmap(f, bitmap)
+        return bitmap
+
+    def open_store(self):
+        store = DiskObjectStore(self.store_dir)
+        store.use_bitmaps = True
+        self.addCleanup(store.close)
+        return store
+
+    def expected_missing(self, haves, wants, get_tagged=None):
+        return set(sha for (sha, path) in
+                   iter(MissingObjectFinder(self.source, haves, wants,
+                                            get_tagged=get_tagged).next, None))
+
+    def test_no_bitmap(self):
+        with Pack(self.pack_path) as pack:
+            self.assertEqual(None, pack.bitmap)
+
+    def test_roundtrip(self):
+        written = self.write_bitmap([self.cmt(1), self.cmt(4)])
+        with Pack(self.pack_path) as pack:
+            bitmap = pack.bitmap
+            self.assertEqual(2, len(bitmap))
+            self.assertTrue(self.cmt(4).id in bitmap)
+            self.assertFalse(self.cmt(3).id in bitmap)
+            self.assertEqual(None, bitmap.get(self.cmt(3).id))
+            for c in [self.cmt(1), self.cmt(4)]:
+                self.assertEqual(written.get(c.id), bitmap.get(c.id))
+            for type_num in (Commit.type_num, Tree.type_num, Blob.type_num):
+                self.assertEqual(written.type_bitmap(type_num),
+                                 bitmap.type_bitmap(type_num))
+            commits = set(bitmap.sha_at(pos) for pos in
+                          iter_bits(bitmap.type_bitmap(Commit.type_num)))
+            self.assertEqual(set(c.sha().digest() for c in self.commits),
+                             commits)
+
+    def test_bitmap_contents(self):
+        bitmap = self.write_bitmap([self.cmt(2)])
+        reachable = set(
+            bitmap.sha_at(pos) for pos in iter_bits(bitmap.get(self.cmt(2).id)))
+        self.assertEqual(
+            set(self.source[sha].sha().digest() for sha in
+                self.expected_missing([], [self.cmt(2).id])),
+            reachable)
+
+    def test_checksum_mismatch(self):
+        self.write_bitmap([self.cmt(4)])
+        with open(self.pack_path + '.bitmap', 'rb') as f:
+            data = f.read()
+        index = MemoryPackIndex([], b'\x01' * 20)
+        self.assertRaises(ChecksumMismatch, read_pack_bitmap,
+                          BytesIO(data), index)
+
+    def test_find_missing_objects(self):
+        self.write_bitmap([self.cmt(2), self.cmt(4)])
+        store = self.open_store()
+        for haves, wants in [
+                ([], [self.cmt(4).id]),
+                ([self.cmt(2).id], [self.cmt(4).id]),
+                ([self.cmt(1).id], [self.cmt(3).id, self.cmt(2).id]),
+                ([self.cmt(3).id, b'1' * 40], [self.cmt(4).id]),
+                ([self.cmt(4).id], [self.tag.id])]:
+            missing = list(store.find_missing_objects(haves, wants))
+            self.assertEqual(self.expected_missing(haves, wants),
+                             set(sha for (sha, path) in missing))
+            self.assertEqual(len(missing), len(set(missing)))
+
+    def test_find_missing_objects_tagged(self):
+        self.write_bitmap([self.cmt(4)])
+        store = self.open_store()
+        get_tagged = lambda: {self.cmt(2).id: self.tag.id}
+        self.assertEqual(
+            self.expected_missing([self.cmt(1).id], [self.cmt(4).id],
+                                  get_tagged),
+            set(sha for (sha, path) in store.find_missing_objects(
+                [self.cmt(1).id], [self.cmt(4).id], get_tagged=get_tagged)))
+        self.assertTrue(self.tag.id in set(
+            sha for (sha, path) in store.find_missing_objects(
+                [], [self.cmt(4).id], get_tagged=get_tagged)))
+
+    def test_find_missing_objects_uses_bitmap(self):
+        self.write_bitmap([self.cmt(4)])
+        store = self.open_store()
+        bitmap = list(store.packs)[0].bitmap
+        bitmap.add(self.cmt(4).id, bitmap.get(self.cmt(1).id) or 0)
+        # The (bogus) stored bitmap is used rather than walking the graph
+        self.assertEqual([], list(store.find_missing_objects(
+            [], [self.cmt(4).id])))
+
+    def test_find_missing_objects_without_bitmaps(self):
+        self.write_bitmap([self.cmt(4)])
+        store = self.open_store()
+        store.use_bitmaps = False
+        bitmap = list(store.packs)[0].bitmap
+        bitmap.add(self.cmt(4).id, 0)
+        missing = list(store.find_missing_objects([], [self.cmt(4).id]))
+        self.assertEqual(self.expected_missing([], [self.cmt(4).id]),
+                         set(sha for (sha, path) in missing))
+        self.assertIn((self.blob_b.id, b'b'), missing)
+
+    def test_find_missing_objects_loose(self):
+        self.write_bitmap([self.cmt(4)])
+        store = self.open_store()
+        blob = make_object(Blob, data=b'loose')
+        commit = build_commit_graph(
+            store, [[1]], trees={1: [(b'a', blob)]},
+            attrs={1: {'parents': [self.cmt(4).id]}})[0]
+        self.assertEqual(
+            set([commit.id, commit.tree, blob.id]),
+            set(sha for (sha, path) in store.find_missing_objects(
+                [self.cmt(4).id], [commit.id])))
+        # Haves outside of the bitmapped pack make the bitmap unusable
+        self.assertEqual([], list(store.find_missing_objects(
+            [commit.id], [self.cmt(3).id])))
+
+    def test_load_pack_bitmap(self):
+        self.write_bitmap([self.cmt(3)])
+        with Pack(self.pack_path) as pack:
+            bitmap = load_pack_bitmap(self.pack_path + '.bitmap', pack.index)
+            self.assertEqual([self.cmt(3).sha().digest()], list(bitmap))
+            bitmap.close()
@@ -0,0 +1,127 @@
+# test_bloom.py -- Tests for changed-path Bloom filters
+# Copyright (C) 2015 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for changed-path Bloom filters."""
+
+from dulwich.bloom import (
+    BloomFilter,
+    ObjectBloomFilter,
+    bloom_key,
+    commit_changed_paths,
+    murmur3_seeded,
+    sha_bloom_key,
+    )
+from dulwich.object_store import (
+    MemoryObjectStore,
+    )
+from dulwich.objects import (
+    Blob,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    make_object,
+    )
+
+
+class Murmur3Tests(TestCase):
+
+    def test_unseeded(self):
+        self.assertEqual(0, murmur3_seeded(0, b''))
+        self.assertEqual(0x627b0c2c, murmur3_seeded(0, b'Hello world!'))
+        self.assertEqual(0x2e4ff723, murmur3_seeded(
+            0, b'The quick brown fox jumps over the lazy dog'))
+
+    def test_bloom_key(self):
+        self.assertEqual(
+            (0x5615800c, 0x5b966560, 0x61174ab4, 0x66983008, 0x6c19155c,
+             0x7199fab0, 0x771ae004), bloom_key(b''))
+        self.assertEqual(3, len(bloom_key(b'foo', 3)))
+
+
+class BloomFilterTests(TestCase):
+
+    def test_from_paths(self):
+        paths = set([b'a', b'x', b'x/b'])
+        bloom_filter = BloomFilter.from_paths(paths)
+        self.assertEqual(4, len(bloom_filter.data))
+        for path in paths:
+            self.assertTrue(bloom_filter.contains(path))
+        self.assertFalse(bloom_filter.contains(b'y'))
+        self.assertEqual(bloom_filter, BloomFilter(bloom_filter.data))
+
+    def test_empty(self):
+        bloom_filter = BloomFilter.from_paths(set())
+        self.assertEqual(b'\x00', bloom_filter.data)
+        self.assertFalse(bloom_filter.contains(b'a'))
+
+    def test_too_large(self):
+        bloom_filter = BloomFilter.from_paths(None)
+        self.assertEqual(b'\xff', bloom_filter.data)
+        self.assertTrue(bloom_filter.contains(b'a'))
+
+
+class ObjectBloomFilterTests(TestCase):
+
+    def test_sha_bloom_key(self):
+        self.assertEqual((1, 3, 5), sha_bloom_key(
+            b'\x00\x00\x00\x01\x00\x00\x00\x02' + b'\xff' * 12, 3))
+
+    def test_add(self):
+        blobs = [make_object(Blob, data=("blob %d" % i).encode('ascii'))
+                 for i in range(10)]
+        bloom_filter = ObjectBloomFilter(5)
+        self.assertEqual(0, bloom_filter.count)
+        for blob in blobs[:5]:
+            self.assertFalse(blob.sha().digest() in bloom_filter)
+            bloom_filter.add(blob.sha().digest())
+            self.assertTrue(blob.sha().digest() in bloom_filter)
+        self.assertEqual(5, bloom_filter.count)
+        for blob in blobs[:5]:
+            self.assertTrue(blob.sha().digest() in bloom_filter)
+
+
+class CommitChangedPathsTests(TestCase):
+
+    def setUp(self):
+        super(CommitChangedPathsTests, self).setUp()
+        self.store = MemoryObjectStore()
+
+    def test_changed_paths(self):
+        blob_a = make_object(Blob, data=b'a')
+        blob_b = make_object(Blob, data=b'b')
+        c1, c2 = build_commit_graph(
+            self.store, [[1], [2, 1]],
+            trees={1: [(b'a', blob_a), (b'x/y/b', blob_b)],
+                   2: [(b'a', blob_b), (b'x/y/b', blob_b), (b'x/c', blob_a)]})
+        self.assertEqual(set([b'a', b'x', b'x/y', b'x/y/b']),
+                         commit_changed_paths(self.store, c1))
+        self.assertEqual(set([b'a', b'x', b'x/c']),
+                         commit_changed_paths(self.store, c2))
+
+    def test_too_many_changes(self):
+        blob = make_object(Blob, data=b'a')
+        c1, = build_commit_graph(
+            self.store, [[1]],
+            trees={1: [(('%d' % i).encode('ascii'), blob)
+                       for i in range(5)]})
+        self.assertEqual(5, len(commit_changed_paths(self.store, c1, 5)))
+        self.assertEqual(None, commit_changed_paths(self.store, c1, 4))
@@ -0,0 +1,145 @@
+# test_commit_graph.py -- Tests for commit-graph files
+# Copyright (C) 2015 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for commit-graph files."""
+
+from io import BytesIO
+
+from dulwich.bloom import (
+    BloomFilter,
+    commit_changed_paths,
+    )
+from dulwich.commit_graph import (
+    CommitGraph,
+    compute_generations,
+    write_commit_graph,
+    )
+from dulwich.errors import (
+    ChecksumMismatch,
+    )
+from dulwich.object_store import (
+    MemoryObjectStore,
+    )
+from dulwich.objects import (
+    hex_to_sha,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+from dulwich.tests.utils import (
+    build_commit_graph,
+    )
+
+
+class CommitGraphTests(TestCase):
+
+    def setUp(self):
+        super(CommitGraphTests, self).setUp()
+        self.store = MemoryObjectStore()
+        self.commits = build_commit_graph(
+            self.store, [[1], [2, 1], [3, 1], [4, 1], [5, 2, 3, 4], [6, 5]],
+            attrs={6: {'commit_time': 2 ** 33 + 5}})
+
+    def cmt(self, n):
+        return self.commits[n - 1]
+
+    def write(self, commits):
+        f = BytesIO()
+        sha = write_commit_graph(f, commits)
+        data = f.getvalue()
+        self.assertEqual(sha, data[-20:])
+        return CommitGraph('commit-graph', file=BytesIO(data))
+
+    def test_empty(self):
+        graph = self.write([])
+        self.assertEqual(0, len(graph))
+        self.assertEqual([], list(graph))
+        self.assertFalse(self.cmt(1).id in graph)
+        graph.check()
+
+    def test_roundtrip(self):
+        graph = self.write(self.commits)
+        self.assertEqual(6, len(graph))
+        self.assertEqual(sorted(hex_to_sha(c.id) for c in self.commits),
+                         list(graph))
+        for commit in self.commits:
+            self.assertTrue(commit.id in graph)
+            self.assertEqual(commit.parents, graph.get_parents(commit.id))
+            self.assertEqual(commit.parents,
+                             graph.get_parents(hex_to_sha(commit.id)))
+            self.assertEqual(commit.tree, graph.get_tree(commit.id))
+            self.assertEqual(commit.commit_time,
+                             graph.get_commit_time(commit.id))
+        self.assertEqual([1, 2, 2, 2, 3, 4],
+                         [graph.get_generation(c.id) for c in self.commits])
+        self.assertFalse(b'1' * 40 in graph)
+        self.assertRaises(KeyError, graph.get_parents, b'1' * 40)
+        self.assertEqual(None, graph.get_bloom_filter(self.cmt(1).id))
+        graph.check()
+
+    def test_bloom_filters(self):
+        bloom_filters = dict(
+            (c.id, BloomFilter.from_paths(commit_changed_paths(self.store, c)))
+            for c in self.commits)
+        bloom_filters[self.cmt(3).id] = BloomFilter.from_paths(None)
+        f = BytesIO()
+        write_commit_graph(f, self.commits, bloom_filters)
+        graph = CommitGraph('commit-graph', file=BytesIO(f.getvalue()))
+        for commit in self.commits:
+            self.assertEqual(bloom_filters[commit.id],
+                             graph.get_bloom_filter(commit.id))
+        self.assertRaises(KeyError, graph.get_bloom_filter, b'1' * 40)
+        graph.check()
+
+    def test_missing_parent(self):
+        self.assertRaises(KeyError, write_commit_graph, BytesIO(),
+                          [self.cmt(2)])
+
+    def test_checksum_mismatch(self):
+        f = BytesIO()
+        write_commit_graph(f, self.commits)
+        data = f.getvalue()
+        data = data[:-1] + (b'\x00' if data[-1:] != b'\x00' else b'\x01')
+        graph = CommitGraph('commit-graph', file=BytesIO(data))
+        self.assertRaises(ChecksumMismatch, graph.check)
+
+    def test_split_graph(self):
+        f = BytesIO()
+        write_commit_graph(f, self.commits)
+        data = f.getvalue()
+        data = data[:7] + b'\x01' + data[8:]
+        self.assertRaises(AssertionError, CommitGraph, 'commit-graph',
+                          file=BytesIO(data))
+
+    def test_bad_signature(self):
+        self.assertRaises(AssertionError, CommitGraph, 'commit-graph',
+                          file=BytesIO(b'PACK' + b'\x00' * 40))
+
+
+class ComputeGenerationsTests(TestCase):
+
+    def test_simple(self):
+        self.assertEqual(
+            {b'a': 1, b'b': 2, b'c': 1, b'd': 3},
+            compute_generations({b'a': [], b'b': [b'a'], b'c': [],
+                                 b'd': [b'b', b'c']}))
+
+    def test_long_history(self):
+        parents = dict((i, [i - 1] if i else []) for i in range(5000))
+        self.assertEqual(5000, compute_generations(parents)[4999])
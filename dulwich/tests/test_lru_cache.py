@@ -234,6 +234,28 @@ class TestLRUCache(TestCase):
         self.assertEqual(10, cache.get(1))
         self.assertEqual([1, 2], [n.key for n in cache._walk_lru()])
 
+    def test_remove(self):
+        cleanup_called = []
+        def cleanup_func(key, val):
+            cleanup_called.append((key, val))
+
+        cache = lru_cache.LRUCache(max_cache=5)
+        for i in range(1, 6):
+            cache.add(i, i * 10, cleanup=cleanup_func)
+        cache.remove(3)
+        self.assertEqual([(3, 30)], cleanup_called)
+        self.assertEqual([5, 4, 2, 1], [n.key for n in cache._walk_lru()])
+        # Most recently used
+        cache.remove(5, cleanup=False)
+        self.assertEqual([4, 2, 1], [n.key for n in cache._walk_lru()])
+        # Least recently used
+        cache.remove(1, cleanup=False)
+        self.assertEqual([4, 2], [n.key for n in cache._walk_lru()])
+        cache.remove(6)
+        self.assertEqual([(3, 30)], cleanup_called)
+        cache.add(6, 60)
+        self.assertEqual([6, 4, 2], [n.key for n in cache._walk_lru()])
+
     def test_keys(self):
         cache = lru_cache.LRUCache(max_cache=5, after_cleanup_count=5)
 
@@ -304,6 +326,16 @@ class TestLRUSizeCache(TestCase):
         cache.add('my key', 'my value text')
         self.assertEqual(13, cache._value_size)
 
+    def test_value_size(self):
+        cache = lru_cache.LRUSizeCache(max_size=20)
+        self.assertEqual(0, cache.value_size())
+        self.assertEqual(20, cache.max_size())
+        cache.add('my key', 'my value text')
+        self.assertEqual(13, cache.value_size())
+        cache.resize(max_size=10)
+        self.assertEqual(0, cache.value_size())
+        self.assertEqual(10, cache.max_size())
+
     def test_remove_tracks_size(self):
         cache = lru_cache.LRUSizeCache()
         self.assertEqual(0, cache._value_size)
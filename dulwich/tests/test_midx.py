@@ -0,0 +1,104 @@
+# test_midx.py -- Tests for multi-pack indexes
+# Copyright (C) 2015 Jelmer Vernooij and others.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License or (at your option) any later version of
+# the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""Tests for multi-pack indexes."""
+
+from io import BytesIO
+
+from dulwich.errors import (
+    ChecksumMismatch,
+    )
+from dulwich.midx import (
+    MultiPackIndex,
+    write_multi_pack_index,
+    )
+from dulwich.pack import (
+    MemoryPackIndex,
+    )
+from dulwich.tests import (
+    TestCase,
+    )
+
+
+class MultiPackIndexTests(TestCase):
+
+    def setUp(self):
+        super(MultiPackIndexTests, self).setUp()
+        self.packs = [
+            ('pack-2.idx', MemoryPackIndex([
+                (b'\x00' * 20, 12, 0),
+                (b'\x01' * 20, 2 ** 32 + 5, 0),
+                (b'\xff' * 20, 50, 0)])),
+            ('pack-1.idx', MemoryPackIndex([
+                (b'\x01' * 20, 12, 0),
+                (b'\x80' * 20, 2 ** 31, 0)])),
+            ]
+
+    def write(self, packs):
+        f = BytesIO()
+        sha = write_multi_pack_index(f, packs)
+        data = f.getvalue()
+        self.assertEqual(sha, data[-20:])
+        return MultiPackIndex('multi-pack-index', file=BytesIO(data))
+
+    def test_empty(self):
+        midx = self.write([])
+        self.assertEqual(0, len(midx))
+        self.assertEqual([], midx.pack_names)
+        self.assertFalse(b'\x00' * 20 in midx)
+        midx.check()
+
+    def test_pack_names(self):
+        midx = self.write(self.packs)
+        self.assertEqual(['pack-1.idx', 'pack-2.idx'], midx.pack_names)
+
+    def test_object_location(self):
+        midx = self.write(self.packs)
+        self.assertEqual(4, len(midx))
+        self.assertEqual((1, 12), midx.object_location(b'\x00' * 20))
+        self.assertEqual((1, 50), midx.object_location(b'ff' * 20))
+        # Large offsets
+        self.assertEqual((0, 2 ** 31), midx.object_location(b'\x80' * 20))
+        # Objects in several packs are found in the first pack given
+        self.assertEqual((1, 2 ** 32 + 5), midx.object_location(b'\x01' * 20))
+        self.assertRaises(KeyError, midx.object_location, b'\x02' * 20)
+        self.assertRaises(KeyError, midx.object_location, b'\xfe' * 20)
+        self.assertTrue(b'\xff' * 20 in midx)
+        self.assertFalse(b'\x7f' * 20 in midx)
+
+    def test_iterentries(self):
+        midx = self.write(self.packs)
+        self.assertEqual([b'\x00' * 20, b'\x01' * 20, b'\x80' * 20,
+                          b'\xff' * 20], list(midx))
+        self.assertEqual([(b'\x00' * 20, 1, 12),
+                          (b'\x01' * 20, 1, 2 ** 32 + 5),
+                          (b'\x80' * 20, 0, 2 ** 31),
+                          (b'\xff' * 20, 1, 50)], list(midx.iterentries()))
+
+    def test_check(self):
+        f = BytesIO()
+        write_multi_pack_index(f, self.packs)
+        data = f.getvalue()
+        data = data[:-1] + (b'\x00' if data[-1:] != b'\x00' else b'\x01')
+        midx = MultiPackIndex('multi-pack-index', file=BytesIO(data))
+        self.assertRaises(ChecksumMismatch, midx.check)
+
+    def test_bad_signature(self):
+        self.assertRaises(AssertionError, MultiPackIndex, 'multi-pack-index',
+                          file=BytesIO(b'PACK' + b'\x00' * 40))
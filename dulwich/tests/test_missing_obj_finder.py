@@ -107,6 +107,18 @@ class MOFLinearRepoTest(MissingObjectFinderTest):
     def test_no_changes(self):
         self.assertMissingMatch([self.cmt(3).id], [self.cmt(3).id], [])
 
+    def test_order(self):
+        # Newest commits first, each followed by the objects it introduces
+        missing = list(self.store.find_missing_objects(
+            [self.cmt(1).id], [self.cmt(3).id]))
+        self.assertEqual(
+            [(self.cmt(3).id, None), (self.cmt(3).tree, "")],
+            missing[:2])
+        self.assertEqual(
+            [(self.cmt(2).id, None), (self.cmt(2).tree, ""),
+             (self.missing_1_2[2], b'f2')],
+            missing[4:])
+
 
 class MOFMergeForkRepoTest(MissingObjectFinderTest):
     # 1 --- 2 --- 4 --- 6 --- 7
@@ -29,9 +29,11 @@ from dulwich.index import (
     commit_tree,
     )
 from dulwich.errors import (
+    NotCommitError,
     NotTreeError,
     )
 from dulwich.objects import (
+    hex_to_sha,
     sha_to_hex,
     Blob,
     Tree,
@@ -41,16 +43,22 @@ from dulwich.object_store import (
     DiskObjectStore,
     MemoryObjectStore,
     ObjectStoreGraphWalker,
+    ObjectStoreIterator,
+    _split_pack_geometry,
     tree_lookup_path,
     )
 from dulwich.pack import (
+    OFS_DELTA,
     REF_DELTA,
+    generate_thin_pack_records,
+    write_pack_data,
     write_pack_objects,
     )
 from dulwich.tests import (
     TestCase,
     )
 from dulwich.tests.utils import (
+    build_commit_graph,
     make_object,
     make_tag,
     build_pack,
@@ -102,6 +110,13 @@ class ObjectStoreTests(object):
         r = self.store[testobject.id]
         self.assertEqual(r, testobject)
 
+    def test_add_objects_iterator(self):
+        self.store.add_objects(iter([]))
+        self.assertEqual([], list(self.store))
+        self.store.add_objects(iter([(testobject, "mypath")]))
+        self.assertEqual(set([testobject.id]), set(self.store))
+        self.assertEqual(testobject, self.store[testobject.id])
+
     def test_tree_changes(self):
         blob_a1 = make_object(Blob, data=b'a1')
         blob_a2 = make_object(Blob, data=b'a2')
@@ -180,11 +195,107 @@ class ObjectStoreTests(object):
         for obj in [testobject, tag1, tag2, tag3]:
             self.assertEqual(testobject, self.store.peel_sha(obj.id))
 
+    def test_get_unpacked_object_nonexistant(self):
+        self.assertRaises(KeyError, self.store.get_unpacked_object,
+                          b"a" * 40)
+
+    def test_contains_many(self):
+        self.store.add_object(testobject)
+        self.assertEqual(set([testobject.id]),
+                         self.store.contains_many([testobject.id, b"1" * 40]))
+
     def test_get_raw(self):
         self.store.add_object(testobject)
         self.assertEqual((Blob.type_num, b'yummy data'),
                          self.store.get_raw(testobject.id))
 
+    def test_get_object_info(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        self.store.add_objects([(b1, None)])
+        self.store.add_object(b2)
+        self.assertEqual((Blob.type_num, len(b"yummy data")),
+                         self.store.get_object_info(b1.id))
+        self.assertEqual((Blob.type_num, len(b"more yummy data")),
+                         self.store.get_object_info(hex_to_sha(b2.id)))
+        self.assertRaises(KeyError, self.store.get_object_info, b"1" * 40)
+
+    def test_iter_raw_objects(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        self.store.add_objects([(b1, None)])
+        self.store.add_object(b2)
+        self.assertEqual(
+            sorted([(b1.id, Blob.type_num, b"yummy data"),
+                    (b2.id, Blob.type_num, b"more yummy data")]),
+            sorted(self.store.iter_raw_objects([b2.id, b1.id, b2.id])))
+        self.assertRaises(KeyError, list,
+                          self.store.iter_raw_objects([b1.id, b"1" * 40]))
+
+    def test_object_store_iterator_streams(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        self.store.add_objects([(b1, None)])
+        def shas():
+            yield b1.id, b"a"
+            self.fail("all SHAs consumed before the first object")
+        self.assertEqual((b1, b"a"),
+                         next(iter(ObjectStoreIterator(self.store, shas()))))
+
+    def test_get_parents(self):
+        c1, c2, c3 = build_commit_graph(self.store, [[1], [2, 1], [3, 1, 2]])
+        self.assertEqual([], self.store.get_parents(c1.id))
+        self.assertEqual([c1.id, c2.id], self.store.get_parents(c3.id))
+        self.assertEqual(c2.commit_time, self.store.get_commit_time(c2.id))
+        self.assertEqual(None, self.store.get_generation(c2.id))
+        self.store.add_object(testobject)
+        self.assertRaises(NotCommitError, self.store.get_parents,
+                          testobject.id)
+        self.assertRaises(KeyError, self.store.get_parents, b'1' * 40)
+
+    def test_thin_pack(self):
+        blob1 = make_object(Blob, data=b'line\n' * 100)
+        blob2 = make_object(Blob, data=b'line\n' * 100 + b'more\n')
+        c1, c2 = build_commit_graph(self.store, [[1], [2, 1]], trees={
+            1: [(b'a', blob1), (b'dir/b', blob1)],
+            2: [(b'a', blob2), (b'dir/b', blob1)]})
+        have_objects = list(self.store.find_missing_objects([], [c1.id]))
+
+        bases = list(self.store.find_thin_pack_bases([c1.id, b'1' * 40]))
+        self.assertEqual(
+            sorted(sha for (sha, path) in have_objects if sha != c1.id),
+            sorted(sha for (sha, path) in bases))
+        self.assertTrue((c1.tree, "") in bases)
+
+        objects = list(self.store.find_missing_objects([c1.id], [c2.id]))
+        records = list(generate_thin_pack_records(self.store, objects, bases))
+        self.assertTrue(
+            (Blob.type_num, blob2.sha().digest(), blob1.sha().digest())
+            in [record[:3] for record in records])
+        f = BytesIO()
+        write_pack_data(f, len(records), records)
+        f.seek(0)
+
+        target = MemoryObjectStore()
+        for sha, path in have_objects:
+            target.add_object(self.store[sha])
+        target.add_thin_pack(f.read, None)
+        self.assertEqual(blob2, target[blob2.id])
+        self.assertEqual(c2, target[c2.id])
+
+    def test_thin_pack_bases_boundary(self):
+        blob1 = make_object(Blob, data=b'one\n')
+        blob2 = make_object(Blob, data=b'two\n')
+        blob3 = make_object(Blob, data=b'three\n')
+        c1, c2, c3 = build_commit_graph(
+            self.store, [[1], [2, 1], [3, 2]], trees={
+                1: [(b'a', blob1), (b'c', blob1)],
+                2: [(b'a', blob2), (b'c', blob2)],
+                3: [(b'a', blob3), (b'c', blob2)]})
+        objects = list(self.store.find_missing_objects([c2.id], [c3.id]))
+        bases = list(self.store.find_thin_pack_bases([c1.id, c2.id], objects))
+        self.assertEqual(
+            sorted([(c2.tree, ""), (blob2.id, b'a')]), sorted(bases))
+
     def test_close(self):
         # For now, just check that close doesn't barf.
         self.store.add_object(testobject)
@@ -256,6 +367,20 @@ class PackBasedObjectStoreTests(ObjectStoreTests):
         self.assertEqual(2, self.store.pack_loose_objects())
         self.assertNotEqual([], list(self.store.packs))
         self.assertEqual(0, self.store.pack_loose_objects())
+        self.assertEqual(1, len(list(self.store.packs)))
+        self.assertFalse(self.store.contains_loose(b1.id))
+        self.assertEqual(b2, self.store[b2.id])
+
+    def test_get_unpacked_object(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        self.store.add_object(b1)
+        self.assertRaises(KeyError, self.store.get_unpacked_object, b1.id)
+        self.store.pack_loose_objects()
+        unpacked = self.store.get_unpacked_object(b1.id, include_comp=True)
+        self.assertEqual(Blob.type_num, unpacked.pack_type_num)
+        self.assertEqual(b1.sha().digest(), unpacked.sha())
+        self.assertEqual(b"yummy data", b"".join(unpacked.decomp_chunks))
+        self.assertNotEqual(None, unpacked.comp_chunks)
 
 
 class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
@@ -305,6 +430,28 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
         self.assertIn(b2.id, store)
         self.assertEqual(b2, store[b2.id])
 
+    def test_add_objects_reverse_index(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        pack = self.store.add_objects([(b1, None), (b2, None)])
+        self.assertTrue(os.path.exists(pack._rev_path))
+        with closing(DiskObjectStore(self.store_dir)) as o:
+            pack = list(o.packs)[0]
+            self.assertEqual(pack.index.object_index(b2.id),
+                             pack.reverse_index.offset(1))
+            self.assertEqual(b2.sha().digest(), pack.offset_to_sha(
+                pack.index.object_index(b2.id)))
+
+    def test_use_mmap(self):
+        b = make_object(Blob, data=b"yummy data")
+        self.store.add_objects([(b, None)])
+        with closing(DiskObjectStore(self.store_dir, use_mmap=True)) as o:
+            pack = list(o.packs)[0]
+            self.assertIsNot(None, pack.data._windows)
+            self.assertEqual(b.as_raw_string(), o[b.id].as_raw_string())
+        with closing(DiskObjectStore(self.store_dir)) as o:
+            self.assertIs(None, list(o.packs)[0].data._windows)
+
     def test_pack_dir(self):
         o = DiskObjectStore(self.store_dir)
         self.assertEqual(os.path.join(self.store_dir, "pack"), o.pack_dir)
@@ -343,6 +490,44 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
         finally:
             o.close()
 
+    def test_add_thin_pack_threads(self):
+        with closing(DiskObjectStore(self.store_dir, index_threads=2)) as o:
+            blobs = [make_object(Blob, data=b'yummy data ' + c)
+                     for c in (b'a', b'b', b'c')]
+            o.add_object(blobs[0])
+            f = BytesIO()
+            entries = build_pack(f, [
+              (REF_DELTA, (blobs[0].id, b'more yummy data')),
+              (Blob.type_num, blobs[1].data),
+              (OFS_DELTA, (1, blobs[2].data)),
+              ], store=o)
+            with o.add_thin_pack(f.read, None) as pack:
+                pack.check_length_and_checksum()
+                self.assertEqual(
+                    sorted([blobs[0].id] +
+                           [sha_to_hex(entry[3]) for entry in entries]),
+                    list(pack))
+                self.assertEqual((Blob.type_num, blobs[2].data),
+                                 o.get_raw(blobs[2].id))
+
+    def test_add_thin_pack_complete(self):
+        with closing(DiskObjectStore(self.store_dir)) as o:
+            blob = make_object(Blob, data=b'yummy data')
+            f = BytesIO()
+            entries = build_pack(f, [
+              (Blob.type_num, blob.data),
+              (OFS_DELTA, (0, b'more yummy data')),
+              ])
+            pack_sha = f.getvalue()[-20:]
+            with o.add_thin_pack(f.read, None) as pack:
+                pack.check_length_and_checksum()
+                self.assertEqual(pack_sha, pack.index.get_pack_checksum())
+                self.assertEqual(
+                    sorted(sha_to_hex(entry[3]) for entry in entries),
+                    list(pack))
+                self.assertEqual((Blob.type_num, b'more yummy data'),
+                                 o.get_raw(sha_to_hex(entries[1][3])))
+
     def test_add_thin_pack_empty(self):
         with closing(DiskObjectStore(self.store_dir)) as o:
             f = BytesIO()
@@ -350,6 +535,259 @@ class DiskObjectStoreTests(PackBasedObjectStoreTests, TestCase):
             self.assertEqual([], entries)
             o.add_thin_pack(f.read, None)
 
+    def test_multi_pack_index(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        b3 = make_object(Blob, data=b"even more yummy data")
+        self.store.add_objects([(b1, None)])
+        self.store.add_objects([(b1, None), (b2, None)])
+        self.store.write_multi_pack_index()
+        self.store.add_objects([(b3, None)])
+        with closing(DiskObjectStore(self.store_dir)) as o:
+            self.assertEqual(3, len(o.packs))
+            self.assertNotEqual(None, o._midx)
+            self.assertEqual(2, len(o._midx.pack_names))
+            self.assertEqual(2, len(o._midx))
+            for b in [b1, b2, b3]:
+                self.assertTrue(o.contains_packed(b.id))
+                self.assertEqual(b, o[b.id])
+                self.assertEqual(
+                    b.id, sha_to_hex(o.get_unpacked_object(b.id).sha()))
+            missing = make_object(Blob, data=b"missing")
+            self.assertFalse(o.contains_packed(missing.id))
+            self.assertRaises(KeyError, o.get_raw, missing.id)
+
+    def test_multi_pack_index_missing_pack(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        self.store.add_objects([(b1, None)])
+        pack = self.store.add_objects([(b1, None), (b2, None)])
+        self.store.write_multi_pack_index()
+        pack.close()
+        os.remove(pack._basename + ".pack")
+        os.remove(pack._basename + ".idx")
+        with closing(DiskObjectStore(self.store_dir)) as o:
+            self.assertEqual(b1, o[b1.id])
+            self.assertFalse(o.contains_packed(b2.id))
+
+    def test_object_cache(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"x" * 1000)
+        self.store.add_objects([(b1, None), (b2, None)])
+        self.assertEqual(None, self.store.object_cache_stats())
+        self.assertIsNot(self.store[b1.id], self.store[b1.id])
+        with closing(DiskObjectStore(self.store_dir,
+                                     object_cache_size=1000)) as o:
+            obj = o[b1.id]
+            self.assertEqual(b1, obj)
+            self.assertIs(obj, o[b1.id])
+            self.assertIs(obj, o[hex_to_sha(b1.id)])
+            # Objects that would fill the cache by themselves aren't cached
+            self.assertIsNot(o[b2.id], o[b2.id])
+            self.assertEqual(
+                {'hits': 2, 'misses': 3, 'count': 1, 'size': len(b"yummy data"),
+                 'max_size': 1000}, o.object_cache_stats())
+            self.assertRaises(KeyError, o.__getitem__, b"1" * 40)
+            o.set_object_cache_size(10000)
+            self.assertEqual(0, o.object_cache_stats()['hits'])
+            self.assertIs(o[b2.id], o[b2.id])
+            o.set_object_cache_size(None)
+            self.assertEqual(None, o.object_cache_stats())
+            self.assertIsNot(o[b1.id], o[b1.id])
+
+    def test_commit_graph(self):
+        c1, c2, c3, c4 = build_commit_graph(
+            self.store, [[1], [2, 1], [3, 1], [4, 2, 3]])
+        self.assertEqual(None, self.store.commit_graph)
+        self.store.write_commit_graph([c2.id])
+        graph = self.store.commit_graph
+        self.assertEqual(2, len(graph))
+        self.assertEqual(2, self.store.get_generation(c2.id))
+        self.assertEqual(None, self.store.get_generation(c4.id))
+        self.store.write_commit_graph([c4.id])
+        with closing(DiskObjectStore(self.store_dir)) as o:
+            self.assertEqual(4, len(o.commit_graph))
+            self.assertEqual(3, o.get_generation(c4.id))
+            self.assertEqual([c2.id, c3.id], o.get_parents(c4.id))
+            self.assertEqual(c3.commit_time, o.get_commit_time(c3.id))
+            # Objects not in the graph are still looked up
+            self.assertRaises(NotCommitError, o.get_parents, c1.tree)
+            self.assertEqual(None, o.get_bloom_filter(c4.id))
+
+    def test_commit_graph_changed_paths(self):
+        blob = make_object(Blob, data=b"yummy data")
+        c1, c2 = build_commit_graph(
+            self.store, [[1], [2, 1]],
+            trees={1: [(b'a', blob)], 2: [(b'a', blob), (b'x/b', blob)]})
+        self.store.write_commit_graph([c2.id], changed_paths=True)
+        bloom_filter = self.store.get_bloom_filter(c2.id)
+        self.assertTrue(bloom_filter.contains(b'x/b'))
+        self.assertTrue(bloom_filter.contains(b'x'))
+        self.assertFalse(bloom_filter.contains(b'a'))
+        self.assertTrue(self.store.get_bloom_filter(c1.id).contains(b'a'))
+        self.assertEqual(None, self.store.get_bloom_filter(blob.id))
+
+    def test_missing_objects(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        b3 = make_object(Blob, data=b"even more yummy data")
+        self.store.use_pack_bloom = True
+        self.store.add_objects([(b1, None)])
+        self.assertNotIn(b2.id, self.store)
+        self.assertIn(b2.id, self.store._missing_objects)
+        self.assertNotIn(b2.sha().digest(), self.store)
+        self.assertTrue(b1.sha().digest() in self.store._pack_bloom)
+        self.assertFalse(b2.sha().digest() in self.store._pack_bloom)
+        self.store.add_object(b2)
+        self.assertIn(b2.id, self.store)
+        self.assertNotIn(b3.id, self.store)
+        self.store.add_objects([(b3, None)])
+        self.assertTrue(b3.sha().digest() in self.store._pack_bloom)
+        self.assertIn(b3.id, self.store)
+        self.assertEqual(b3, self.store[b3.id])
+
+    def test_contains_many(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        b3 = make_object(Blob, data=b"even more yummy data")
+        missing = make_object(Blob, data=b"missing")
+        self.store.add_objects([(b1, None)])
+        self.store.add_objects([(b2, None)])
+        self.store.add_object(b3)
+        shas = [b1.id, b2.id, b3.id, missing.id]
+        self.assertEqual(set([b1.id, b2.id, b3.id]),
+                         self.store.contains_many(shas))
+        self.assertIn(missing.id, self.store._missing_objects)
+        self.assertNotIn(missing.id, self.store)
+        self.assertEqual(set([b1.id, b2.id, b3.id]),
+                         self.store.contains_many(shas))
+
+    def test_missing_objects_loose(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        self.store.add_objects([(b1, None)])
+        self.assertNotIn(b2.id, self.store)
+        self.assertEqual(set(), self.store.contains_many([b2.id]))
+        self.assertEqual(None, self.store._pack_bloom)
+        with closing(DiskObjectStore(self.store_dir)) as o:
+            o.add_object(b2)
+        self.assertIn(b2.id, self.store)
+        self.assertEqual(set([b2.id]), self.store.contains_many([b2.id]))
+
+    def test_missing_objects_new_pack(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        self.store.add_objects([(b1, None)])
+        self.assertNotIn(b2.id, self.store)
+        with closing(DiskObjectStore(self.store_dir)) as o:
+            o.add_objects([(b2, None)])
+        # Make sure the change of the pack directory is noticed
+        self.store._pack_cache_time = 0
+        self.assertIn(b2.id, self.store)
+        self.assertEqual(b2, self.store[b2.id])
+
+    def test_repack(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        b3 = make_object(Blob, data=b"even more yummy data")
+        self.store.add_objects([(b1, None)])
+        self.store.add_objects([(b1, None), (b2, None)])
+        self.store.add_object(b3)
+        self.store.write_multi_pack_index()
+        old_packs = list(self.store.packs)
+        pack = self.store.repack()
+        self.assertEqual([pack], list(self.store.packs))
+        self.assertEqual(3, len(pack))
+        self.assertEqual([], list(self.store._iter_loose_objects()))
+        for old_pack in old_packs:
+            self.assertFalse(os.path.exists(old_pack._basename + ".pack"))
+            self.assertFalse(os.path.exists(old_pack._basename + ".idx"))
+        self.assertEqual([os.path.basename(pack._basename) + ".idx"],
+                         self.store._midx.pack_names)
+        with closing(DiskObjectStore(self.store_dir)) as o:
+            self.assertEqual(1, len(o.packs))
+            for b in [b1, b2, b3]:
+                self.assertEqual(b, o[b.id])
+        self.assertEqual(None, self.store.repack())
+
+    def test_repack_keep(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        kept = self.store.add_objects([(b1, None)])
+        with open(kept._basename + ".keep", 'wb'):
+            pass
+        self.store.add_objects([(b1, None), (b2, None)])
+        self.store.add_objects([(b2, None)])
+        self.store.add_object(b1)
+        pack = self.store.repack()
+        self.assertEqual(set([kept._basename, pack._basename]),
+                         set(p._basename for p in self.store.packs))
+        self.assertEqual([b2.id], list(pack))
+        self.assertEqual([], list(self.store._iter_loose_objects()))
+
+    def test_repack_bitmap(self):
+        c1, c2, c3 = build_commit_graph(self.store, [[1], [2, 1], [3, 1, 2]])
+        pack = self.store.repack(bitmap_commits=[c2.id])
+        self.assertTrue(os.path.exists(pack._basename + ".bitmap"))
+        self.assertEqual([c2.sha().digest()], list(pack.bitmap))
+        # A bitmap can't be written if objects are left in a kept pack.
+        with open(pack._basename + ".keep", 'wb'):
+            pass
+        c4 = build_commit_graph(
+            self.store, [[1]], attrs={1: {'parents': [c3.id]}})[0]
+        pack = self.store.repack(bitmap_commits=[c4.id])
+        self.assertFalse(os.path.exists(pack._basename + ".bitmap"))
+
+    def test_repack_geometric(self):
+        blobs = [make_object(Blob, data=("blob %d" % i).encode('ascii'))
+                 for i in range(8)]
+        big = self.store.add_objects([(b, None) for b in blobs[:6]])
+        self.store.add_objects([(blobs[6], None)])
+        self.store.add_objects([(blobs[7], None)])
+        pack = self.store.repack(geometric_factor=2)
+        self.assertEqual(set([big._basename, pack._basename]),
+                         set(p._basename for p in self.store.packs))
+        self.assertEqual(2, len(pack))
+        self.assertEqual(None, self.store.repack(geometric_factor=2))
+        self.assertRaises(ValueError, self.store.repack, geometric_factor=2,
+                          reachable=[])
+
+    def test_repack_unreachable(self):
+        b1 = make_object(Blob, data=b"yummy data")
+        b2 = make_object(Blob, data=b"more yummy data")
+        b3 = make_object(Blob, data=b"even more yummy data")
+        b4 = make_object(Blob, data=b"old yummy data")
+        pack = self.store.add_objects([(b1, None), (b2, None)])
+        os.utime(pack._data_path, (1000, 1000))
+        self.store.add_objects([(b3, None)])
+        self.store.add_object(b4)
+        os.utime(self.store._get_shafile_path(b4.id), (1000, 1000))
+        pack = self.store.repack(reachable=[(b1.id, None)], expire=2000)
+        self.assertEqual([pack], list(self.store.packs))
+        self.assertEqual([b1.id], list(pack))
+        # b3 is too recent to be pruned, so it is kept as a loose object
+        self.assertEqual([b3.id], list(self.store._iter_loose_objects()))
+        self.assertEqual(b3, self.store[b3.id])
+        self.store.repack(reachable=[(b1.id, None)])
+        self.assertEqual([], list(self.store._iter_loose_objects()))
+
+
+class SplitPackGeometryTests(TestCase):
+
+    def test_progression(self):
+        packs = [[None] * n for n in [1, 2, 4]]
+        self.assertEqual([], _split_pack_geometry(packs, 2))
+
+    def test_merge(self):
+        packs = [[None] * n for n in [1, 1, 1, 2, 100]]
+        self.assertEqual([[None]] * 3 + [[None] * 2],
+                         _split_pack_geometry(packs, 2))
+
+    def test_roll_up(self):
+        packs = [[None] * n for n in [2, 3, 9, 12]]
+        self.assertEqual([[None] * 2, [None] * 3, [None] * 9, [None] * 12],
+                         _split_pack_geometry(packs, 2))
+
 
 class TreeLookupPathTests(TestCase):
 
@@ -30,6 +30,7 @@ from itertools import (
 import os
 import stat
 import warnings
+import zlib
 from contextlib import contextmanager
 
 from dulwich.errors import (
@@ -129,6 +130,20 @@ class BlobReadTests(TestCase):
         b2 = b1.from_file(BytesIO(b_raw))
         self.assertEqual(b1, b2)
 
+    def test_read_header(self):
+        b1 = Blob.from_string(b'foo' * 1000)
+        self.assertEqual(
+            (Blob.type_num, 3000),
+            ShaFile.read_header(BytesIO(b1.as_legacy_object())))
+        dir = os.path.join(os.path.dirname(__file__), 'data', 'blobs')
+        with open(hex_to_filename(dir, c_sha), 'rb') as f:
+            self.assertEqual((Blob.type_num, 7), ShaFile.read_header(f))
+        self.assertEqual(
+            (Blob.type_num, 300),
+            ShaFile.read_header(BytesIO(b'\xbc\x12' + zlib.compress(b'x'))))
+        self.assertRaises(ObjectFormatException, ShaFile.read_header,
+                          BytesIO(b''))
+
     def test_chunks(self):
         string = b'test 5\n'
         b = Blob.from_string(string)
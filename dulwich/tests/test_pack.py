@@ -22,9 +22,15 @@
 
 from io import BytesIO
 from hashlib import sha1
+import gc
+import mmap
+import multiprocessing
 import os
 import shutil
+import sys
 import tempfile
+import threading
+import warnings
 import zlib
 
 from dulwich.errors import (
@@ -41,6 +47,7 @@ from dulwich.objects import (
     hex_to_sha,
     sha_to_hex,
     Commit,
+    Tag,
     Tree,
     Blob,
     )
@@ -49,29 +56,43 @@ from dulwich.pack import (
     REF_DELTA,
     MemoryPackIndex,
     Pack,
+    DeltaBaseCache,
+    DeltaIndex,
     PackData,
+    PackFilePool,
+    PackReverseIndex,
+    PackWindows,
+    SharedIndexMaps,
     apply_delta,
     create_delta,
+    generate_pack_records,
+    order_pack_objects,
     deltify_pack_objects,
     load_pack_index,
+    load_pack_rev,
     UnpackedObject,
     read_zlib_chunks,
     write_pack_header,
     write_pack_index_v1,
     write_pack_index_v2,
+    write_pack_rev,
+    write_pack_data,
     write_pack_object,
     write_pack,
+    write_pack_objects,
     unpack_object,
     compute_file_sha,
     PackStreamReader,
     DeltaChainIterator,
     _delta_encode_size,
     _encode_copy_operation,
+    _split_magic,
     )
 from dulwich.tests import (
     TestCase,
     )
 from dulwich.tests.utils import (
+    make_commit,
     make_object,
     build_pack,
     )
@@ -151,6 +172,65 @@ class PackIndexTests(PackTests):
         p = self.get_pack_index(pack1_sha)
         self.assertEqual(set([tree_sha, commit_sha, a_sha]), set(p))
 
+    def test_object_indexes(self):
+        p = self.get_pack_index(pack1_sha)
+        self.assertEqual(
+            {a_sha: 178, hex_to_sha(tree_sha): 138},
+            p.object_indexes([a_sha, hex_to_sha(tree_sha), pack1_sha]))
+        self.assertEqual(set([commit_sha]),
+                         p.contains_many([commit_sha, pack1_sha]))
+        self.assertEqual({}, p.object_indexes([]))
+
+    def test_lazy_contents(self):
+        p = self.get_pack_index(pack1_sha)
+        self.addCleanup(p.close)
+        self.assertEqual(3, len(p))
+        self.assertEqual(b'721980e866af9a5f93ad674144e1459b8ba3e7b7',
+                         sha_to_hex(p.get_pack_checksum()))
+        # No objects start with a NUL byte, so the fan-out table suffices.
+        self.assertRaises(KeyError, p.object_index, b'\0' * 20)
+        self.assertNotIn('_contents', p.__dict__)
+        self.assertEqual(178, p.object_index(a_sha))
+        self.assertIn('_contents', p.__dict__)
+
+    def test_lazy_contents_threads(self):
+        p = self.get_pack_index(pack1_sha)
+        self.addCleanup(p.close)
+        results = []
+
+        def lookup():
+            results.append((sha_to_hex(p.get_pack_checksum()),
+                            p.object_index(a_sha)))
+        threads = [threading.Thread(target=lookup) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(
+            [(b'721980e866af9a5f93ad674144e1459b8ba3e7b7', 178)] * 8, results)
+
+    def test_shared_maps(self):
+        maps = SharedIndexMaps()
+        path = os.path.join(self.datadir,
+                            'pack-%s.idx' % pack1_sha.decode('ascii'))
+        p1 = load_pack_index(path, shared_maps=maps)
+        p2 = load_pack_index(path, shared_maps=maps)
+        self.assertEqual(178, p1.object_index(a_sha))
+        self.assertEqual(178, p2.object_index(a_sha))
+        self.assertIs(p1._contents, p2._contents)
+        self.assertEqual(1, len(maps))
+        p1.close()
+        self.assertEqual(138, p2.object_index(tree_sha))
+        self.assertSucceeds(p2.check)
+        p2.close()
+
+
+def _incompressible(seed, length):
+    chunks = []
+    for i in range(0, length, 20):
+        chunks.append(sha1(('%s-%d' % (seed, i)).encode('ascii')).digest())
+    return b''.join(chunks)[:length]
+
 
 class TestPackDeltas(TestCase):
 
@@ -188,6 +268,52 @@ class TestPackDeltas(TestCase):
         self._test_roundtrip(self.test_string_huge + self.test_string1,
                              self.test_string_huge + self.test_string2)
 
+    def test_insert_in_large_blob(self):
+        base = _incompressible('base', 1024 * 1024)
+        target = base[:500000] + b'inserted' + base[500000:]
+        delta = create_delta(base, target)
+        # One copy operation per 64K of base and a single insert.
+        self.assertTrue(len(delta) < 200, len(delta))
+        self.assertEqual(target, b''.join(apply_delta(base, delta)))
+
+    def test_reordered_blocks(self):
+        base = _incompressible('base', 4096)
+        target = base[2048:] + b'middle' + base[:2048]
+        delta = create_delta(base, target)
+        self.assertTrue(len(delta) < 100, len(delta))
+        self.assertEqual(target, b''.join(apply_delta(base, delta)))
+
+    def test_delta_index_reuse(self):
+        index = DeltaIndex(self.test_string_huge + self.test_string1)
+        self.assertEqual(len(self.test_string_huge + self.test_string1),
+                         len(index))
+        for target in (self.test_string1, self.test_string2,
+                       self.test_string_huge, self.test_string_empty):
+            self.assertEqual(
+                target, b''.join(apply_delta(index.base_buf,
+                                             index.create_delta(target))))
+
+    def test_delta_index_max_size(self):
+        index = DeltaIndex(self.test_string1)
+        self.assertEqual(None, index.create_delta(self.test_string_big,
+                                                  max_size=100))
+        self.assertEqual(create_delta(self.test_string1, self.test_string2),
+                         index.create_delta(self.test_string2, max_size=100))
+
+    def test_delta_index_max_size_unrelated(self):
+        base = _incompressible('base', 60000)
+        target = _incompressible('target', 60000)
+        index = DeltaIndex(base)
+        probes = []
+        class CountingDict(dict):
+            def __contains__(self, key):
+                probes.append(key)
+                return dict.__contains__(self, key)
+        index._blocks = CountingDict(index._blocks)
+        self.assertEqual(None, index.create_delta(target, max_size=1000))
+        # The scan stops once the pending literal data exceeds max_size.
+        self.assertTrue(len(probes) < 1000, len(probes))
+
     def test_dest_overflow(self):
         self.assertRaises(
             ApplyDeltaError,
@@ -283,6 +409,86 @@ class TestPackData(PackTests):
             end_ofs=-12)
 
 
+class TestMmapPackData(TestPackData):
+    """Tests getting the data from a memory-mapped packfile."""
+
+    def get_pack_data(self, sha):
+        return PackData(
+            os.path.join(self.datadir, 'pack-%s.pack' % sha.decode('ascii')),
+            use_mmap=True)
+
+    def test_mapped(self):
+        with self.get_pack_data(pack1_sha) as p:
+            self.assertNotEqual(None, p._windows)
+
+
+class PackWindowsTests(PackTests):
+
+    def setUp(self):
+        super(PackWindowsTests, self).setUp()
+        # Objects large enough to cross allocation-granularity windows.
+        size = mmap.ALLOCATIONGRANULARITY + 1000
+        self.base = _incompressible('base', size)
+        self.target = self.base[:size // 2] + b'changed' + self.base[size // 2:]
+        self.path = os.path.join(self.tempdir, 'windows.pack')
+        with open(self.path, 'wb') as f:
+            self.entries = build_pack(f, [
+                (Blob.type_num, _incompressible('other', size)),
+                (Blob.type_num, self.base),
+                (OFS_DELTA, (1, self.target)),
+                (REF_DELTA, (1, self.base + b'x')),
+            ])
+
+    def get_pack_data(self):
+        # Windows are rounded up to the allocation granularity, and only one
+        # of them is kept mapped at a time.
+        return PackData(self.path, use_mmap=True, window_size=1,
+                        window_limit=1)
+
+    def test_get_object_at(self):
+        with self.get_pack_data() as p:
+            for offset, type_num, data, sha, crc32 in self.entries[:2]:
+                obj_type_num, chunks = p.get_object_at(offset)
+                self.assertEqual(type_num, obj_type_num)
+                self.assertEqual(data, b''.join(chunks))
+
+    def test_resolve_object(self):
+        with self.get_pack_data() as p:
+            offset = self.entries[2][0]
+            type_num, obj = p.get_object_at(offset)
+            self.assertEqual(
+                Blob.type_num, p.resolve_object(offset, type_num, obj)[0])
+            self.assertEqual(
+                self.target,
+                b''.join(p.resolve_object(offset, type_num, obj)[1]))
+
+    def test_iterentries(self):
+        with self.get_pack_data() as p:
+            self.assertEqual(
+                sorted((sha, offset, crc32)
+                       for offset, _, _, sha, crc32 in self.entries),
+                p.sorted_entries())
+
+    def test_iterobjects(self):
+        with self.get_pack_data() as p:
+            self.assertEqual(
+                [offset for offset, _, _, _, _ in self.entries],
+                [offset for offset, _, _, _ in p.iterobjects()])
+
+    def test_read_across_windows(self):
+        with open(self.path, 'rb') as f:
+            contents = f.read()
+            windows = PackWindows(f.fileno(), len(contents), window_size=1,
+                                  window_limit=1)
+            start = mmap.ALLOCATIONGRANULARITY - 10
+            self.assertEqual(contents[start:start + 20],
+                             windows.read(start, 20))
+            self.assertEqual(contents[start:start + 10],
+                             bytes(windows.slice(start, 20)))
+            self.assertEqual(contents[-5:], windows.read(len(contents) - 5, 20))
+            windows.close()
+
+
 class TestPack(PackTests):
 
     def test_len(self):
@@ -345,6 +551,16 @@ class TestPack(PackTests):
                 new_checksum = newpack.index.get_stored_checksum()
                 self.assertTrue(wrong_version or orig_checksum == new_checksum)
 
+    def test_copy_threads(self):
+        with self.get_pack(pack1_sha) as origpack:
+            basename = os.path.join(self.tempdir, 'Elch')
+            write_pack(basename, origpack.pack_tuples(), deltify=True,
+                       threads=2, deterministic=True)
+            with Pack(basename) as newpack:
+                self.assertEqual(origpack, newpack)
+                self.assertSucceeds(newpack.index.check)
+                self.assertSucceeds(newpack.data.check)
+
     def test_commit_obj(self):
         with self.get_pack(pack1_sha) as p:
             commit = p[commit_sha]
@@ -352,6 +568,51 @@ class TestPack(PackTests):
                              commit.author)
             self.assertEqual([], commit.parents)
 
+    def test_offset_to_sha(self):
+        with self.get_pack(pack1_sha) as p:
+            self.assertEqual(hex_to_sha(commit_sha), p.offset_to_sha(12))
+            self.assertEqual(hex_to_sha(tree_sha), p.offset_to_sha(138))
+            self.assertEqual(hex_to_sha(a_sha), p.offset_to_sha(178))
+            self.assertRaises(KeyError, p.offset_to_sha, 13)
+
+    def test_compressed_size(self):
+        with self.get_pack(pack1_sha) as p:
+            self.assertEqual(126, p.compressed_size(commit_sha))
+            self.assertEqual(40, p.compressed_size(tree_sha))
+            self.assertEqual(
+                os.path.getsize(p._data_path) - 20 - 178,
+                p.compressed_size(a_sha))
+            self.assertRaises(KeyError, p.compressed_size, pack1_sha)
+
+    def test_reverse_index_file(self):
+        with self.get_pack(pack1_sha) as origpack:
+            p = self._copy_pack(origpack)
+        with p:
+            entries = list(p.index.iterentries())
+            with open(p._rev_path, 'wb') as f:
+                write_pack_rev(f, entries, p.index.get_pack_checksum())
+            rev = load_pack_rev(p._rev_path, p.index)
+            self.assertEqual(
+                list(PackReverseIndex.from_index(p.index)._positions),
+                list(rev._positions))
+            self.assertEqual([hex_to_sha(commit_sha), hex_to_sha(tree_sha),
+                              hex_to_sha(a_sha)],
+                             [rev.sha(i) for i in range(len(rev))])
+            self.assertEqual([12, 138, 178],
+                             [rev.offset(i) for i in range(len(rev))])
+            self.assertEqual(2, rev.pack_position(178))
+            self.assertEqual(rev._positions, p.reverse_index._positions)
+            self.assertEqual(hex_to_sha(tree_sha), p.offset_to_sha(138))
+
+    def test_reverse_index_checksum_mismatch(self):
+        with self.get_pack(pack1_sha) as p:
+            f = BytesIO()
+            write_pack_rev(f, list(p.index.iterentries()), b'\x01' * 20)
+            path = os.path.join(self.tempdir, 'bad.rev')
+            with open(path, 'wb') as rev_file:
+                rev_file.write(f.getvalue())
+            self.assertRaises(ChecksumMismatch, load_pack_rev, path, p.index)
+
     def _copy_pack(self, origpack):
         basename = os.path.join(self.tempdir, 'somepack')
         write_pack(basename, origpack.pack_tuples())
@@ -430,6 +691,222 @@ class TestPack(PackTests):
             self.assertTrue(isinstance(objs[commit_sha], Commit))
 
 
+class PackReuseTests(PackTests):
+
+    def setUp(self):
+        super(PackReuseTests, self).setUp()
+        self.basename = os.path.join(self.tempdir, 'pack')
+        with open(self.basename + '.pack', 'wb') as f:
+            self.entries = build_pack(f, [
+                (Blob.type_num, b'base blob contents'),
+                (OFS_DELTA, (0, b'base blob contents, changed')),
+                (Blob.type_num, b'other'),
+            ])
+        with PackData(self.basename + '.pack') as data:
+            data.create_index(self.basename + '.idx')
+        self.pack = Pack(self.basename)
+        self.addCleanup(self.pack.close)
+
+    def sha(self, i):
+        return sha_to_hex(self.entries[i][3])
+
+    def write_records(self, records):
+        f = BytesIO()
+        records = list(records)
+        write_pack_data(f, len(records), records)
+        return PackData.from_file(BytesIO(f.getvalue()), len(f.getvalue()))
+
+    def test_get_unpacked_object(self):
+        unpacked = self.pack.get_unpacked_object(self.sha(1),
+                                                 include_comp=True)
+        self.assertEqual(REF_DELTA, unpacked.pack_type_num)
+        self.assertEqual(self.entries[0][3], unpacked.delta_base)
+        self.assertEqual(self.entries[1][3], unpacked.sha())
+        self.assertEqual(self.entries[1][4], unpacked.crc32)
+        self.assertRaises(KeyError, self.pack.get_unpacked_object, b'1' * 40)
+
+    def test_iter_raw_at(self):
+        offsets = [self.entries[i][0] for i in (2, 1, 0, 1)]
+        self.assertEqual(
+            [(offset, type_num, data)
+             for offset, type_num, data, _, _ in self.entries],
+            list(self.pack.iter_raw_at(offsets)))
+
+    def test_get_object_info(self):
+        self.assertEqual((Blob.type_num, len(b'base blob contents, changed')),
+                         self.pack.get_object_info(self.sha(1)))
+        self.assertEqual((Blob.type_num, len(b'other')),
+                         self.pack.get_object_info(self.sha(2)))
+        # Nothing was inflated
+        self.assertEqual(0, self.pack.data.delta_base_cache_stats()['count'])
+        self.assertRaises(KeyError, self.pack.get_object_info, b'1' * 40)
+
+    def test_delta_base_cache(self):
+        data = self.pack.data
+        self.assertEqual(self.entries[1][1:3], self.pack.get_raw(self.sha(1)))
+        stats = data.delta_base_cache_stats()
+        # Both the base and the resolved delta are cached
+        self.assertEqual((0, 2, 2, len(b'base blob contents') +
+                          len(b'base blob contents, changed')),
+                         (stats['hits'], stats['misses'], stats['count'],
+                          stats['size']))
+        self.assertEqual(self.entries[1][1:3], self.pack.get_raw(self.sha(1)))
+        self.assertEqual(1, data.delta_base_cache_stats()['hits'])
+        # The root of the delta chain is kept
+        data.set_delta_base_cache_limit(len(b'base blob contents'))
+        stats = data.delta_base_cache_stats()
+        self.assertEqual((1, 1, len(b'base blob contents')),
+                         (stats['evictions'], stats['count'], stats['size']))
+        self.assertEqual(self.entries[1][1:3], self.pack.get_raw(self.sha(1)))
+        self.assertEqual(2, data.delta_base_cache_stats()['hits'])
+
+    def test_reuse(self):
+        shas = [self.sha(i) for i in range(3)]
+        records = list(generate_pack_records(self.pack, shas))
+        self.assertTrue(all(isinstance(r, UnpackedObject) for r in records))
+        with self.write_records(records) as data:
+            self.assertEqual(
+                sorted((sha, crc32) for _, _, _, sha, crc32 in self.entries),
+                sorted((sha, crc32) for sha, _, crc32 in data.iterentries()))
+            self.assertEqual(
+                [Blob.type_num, OFS_DELTA, Blob.type_num],
+                [type_num for _, type_num, _, _ in data.iterobjects()])
+
+    def test_delta_base_first(self):
+        records = list(generate_pack_records(
+            self.pack, [self.sha(1), self.sha(2), self.sha(0)]))
+        self.assertEqual(
+            [self.entries[0][3], self.entries[1][3], self.entries[2][3]],
+            [record.sha() for record in records])
+        with self.write_records(records) as data:
+            self.assertEqual(
+                [Blob.type_num, OFS_DELTA, Blob.type_num],
+                [type_num for _, type_num, _, _ in data.iterobjects()])
+
+    def test_delta_base_not_sent(self):
+        records = list(generate_pack_records(
+            self.pack, [self.sha(1), self.sha(2)]))
+        self.assertEqual(
+            (Blob.type_num, self.entries[1][3], None, self.entries[1][2]),
+            records[0])
+        self.assertTrue(isinstance(records[1], UnpackedObject))
+
+    def test_crc32_mismatch(self):
+        entries = [(sha, offset, crc32 ^ 1)
+                   for sha, offset, crc32 in self.pack.index.iterentries()]
+        pack = Pack.from_objects(
+            self.pack.data,
+            MemoryPackIndex(entries, self.pack.index.get_pack_checksum()))
+        self.assertRaises(ChecksumMismatch, pack.get_unpacked_object,
+                          self.sha(0))
+        self.assertEqual(
+            [(Blob.type_num, self.entries[0][3], None, self.entries[0][2])],
+            list(generate_pack_records(pack, [self.sha(0)])))
+
+
+class PackFilePoolTests(PackTests):
+
+    def get_pack(self, sha, pool):
+        return Pack(
+            os.path.join(self.datadir, 'pack-%s' % sha.decode('ascii')),
+            file_pool=pool)
+
+    def test_evict(self):
+        pool = PackFilePool(3)
+        p1 = self.get_pack(pack1_sha, pool)
+        self.addCleanup(p1.close)
+        p2 = self.get_pack(pack1_sha, pool)
+        self.addCleanup(p2.close)
+        self.assertEqual(commit_sha, p1[commit_sha].id)
+        stats = pool.stats()
+        self.assertEqual((2, 0, 2, 3), (stats['opens'], stats['evictions'],
+                                        stats['open'], stats['max_open']))
+        self.assertTrue(stats['reuses'] > 0)
+        self.assertEqual(commit_sha, p2[commit_sha].id)
+        # The index of p1 was least recently used.
+        self.assertIs(None, p1._idx)
+        self.assertIsNot(None, p1._data)
+        stats = pool.stats()
+        self.assertEqual((4, 1, 3), (stats['opens'], stats['evictions'],
+                                     stats['open']))
+        # It is opened again when needed.
+        self.assertEqual(commit_sha, p1[commit_sha].id)
+        self.assertIsNot(None, p1._idx)
+        self.assertEqual(3, pool.stats()['evictions'])
+
+    def test_evict_closes(self):
+        pool = PackFilePool(2)
+        packs = [self.get_pack(pack1_sha, pool) for i in range(5)]
+        for p in packs:
+            self.addCleanup(p.close)
+        gc.collect()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            data = packs[0].data
+            for p in packs:
+                self.assertEqual(commit_sha, p[commit_sha].id)
+            self.assertIs(None, packs[0]._data)
+            self.assertTrue(data._file.closed)
+            del data
+            gc.collect()
+        # ResourceWarning only exists on Python 3.
+        self.assertEqual([], [w for w in caught
+                              if w.category.__name__ == 'ResourceWarning'])
+        self.assertEqual(2, pool.stats()['open'])
+
+    def test_evict_in_use(self):
+        pool = PackFilePool(2)
+        p1 = self.get_pack(pack1_sha, pool)
+        self.addCleanup(p1.close)
+        p2 = self.get_pack(pack1_sha, pool)
+        self.addCleanup(p2.close)
+        data = p1._acquire('data')
+        self.assertEqual(commit_sha, p2[commit_sha].id)
+        self.assertIs(None, p1._data)
+        # The pack data is only closed once it is released.
+        self.assertFalse(data._file.closed)
+        self.assertEqual(commit_sha, p1[commit_sha].id)
+        self.assertIsNot(data, p1._data)
+        p1._release(data)
+        self.assertTrue(data._file.closed)
+
+    def test_collected(self):
+        pool = PackFilePool(3)
+        p1 = self.get_pack(pack1_sha, pool)
+        self.assertEqual(commit_sha, p1[commit_sha].id)
+        self.assertEqual(2, pool.stats()['open'])
+        # Close the files, but not the pack, which leaves it in the pool.
+        p1._data.close()
+        p1._idx.close()
+        del p1
+        gc.collect()
+        self.assertEqual(0, pool.stats()['open'])
+
+    def test_close(self):
+        pool = PackFilePool(3)
+        p1 = self.get_pack(pack1_sha, pool)
+        self.assertEqual(commit_sha, p1[commit_sha].id)
+        p1.close()
+        self.assertEqual(0, pool.stats()['open'])
+        self.assertEqual(0, pool.stats()['evictions'])
+
+    def test_resize(self):
+        pool = PackFilePool(3)
+        p1 = self.get_pack(pack1_sha, pool)
+        self.addCleanup(p1.close)
+        self.assertEqual(commit_sha, p1[commit_sha].id)
+        pool.resize(1)
+        self.assertEqual(1, pool.stats()['open'])
+        self.assertIs(None, p1._idx)
+
+    def test_from_objects(self):
+        with self.get_pack_data(pack1_sha) as data:
+            idx = self.get_pack_index(pack1_sha)
+            p = Pack.from_objects(data, idx)
+            self.assertEqual(commit_sha, p[commit_sha].id)
+            self.assertIs(None, p._file_pool)
+
+
 class TestThinPack(PackTests):
 
     def setUp(self):
@@ -476,6 +953,16 @@ class TestThinPack(PackTests):
                 (3, b'foo1234'),
                 p.get_raw(self.blobs[b'foo1234'].id))
 
+    def test_get_object_info(self):
+        with self.make_pack(False) as p:
+            self.assertRaises(
+                KeyError, p.get_object_info, self.blobs[b'foo1234'].id)
+            self.assertEqual((3, 7), p.get_object_info(
+                self.blobs[b'bar2468'].id))
+        with self.make_pack(True) as p:
+            self.assertEqual((3, 7), p.get_object_info(
+                self.blobs[b'foo1234'].id))
+
     def test_iterobjects(self):
         with self.make_pack(False) as p:
             self.assertRaises(KeyError, list, p.iterobjects())
@@ -486,6 +973,59 @@ class TestThinPack(PackTests):
                 sorted(o.id for o in p.iterobjects()))
 
 
+class DeltaBaseCacheTests(TestCase):
+
+    def test_add(self):
+        cache = DeltaBaseCache(10)
+        cache.add(12, Blob.type_num, [b'abc', b'de'])
+        self.assertTrue(12 in cache)
+        self.assertEqual((Blob.type_num, [b'abc', b'de']), cache[12])
+        self.assertRaises(KeyError, cache.__getitem__, 13)
+        self.assertEqual(
+            {'hits': 1, 'misses': 1, 'evictions': 0, 'count': 1, 'size': 5,
+             'max_size': 10}, cache.stats())
+
+    def test_too_large(self):
+        cache = DeltaBaseCache(10)
+        cache.add(12, Blob.type_num, [b'x' * 11])
+        self.assertFalse(12 in cache)
+        self.assertEqual(0, len(cache))
+
+    def test_evict_lru(self):
+        cache = DeltaBaseCache(10)
+        cache.add(12, Blob.type_num, [b'aaaa'])
+        cache.add(20, Blob.type_num, [b'bbbb'])
+        cache[12]
+        cache.add(30, Blob.type_num, [b'cccc'])
+        self.assertEqual([True, False, True],
+                         [o in cache for o in (12, 20, 30)])
+        self.assertEqual(1, cache.stats()['evictions'])
+
+    def test_keep_roots(self):
+        cache = DeltaBaseCache(10)
+        cache.add(12, Blob.type_num, [b'aaaa'], root=True)
+        cache.add(20, Blob.type_num, [b'bbbb'])
+        cache.add(30, Blob.type_num, [b'cccc'])
+        self.assertEqual([True, False, True],
+                         [o in cache for o in (12, 20, 30)])
+        cache.add(40, Blob.type_num, [b'dddd'], root=True)
+        self.assertEqual([True, False, True],
+                         [o in cache for o in (12, 30, 40)])
+        # Roots are evicted once there is nothing else to evict
+        cache.add(50, Blob.type_num, [b'eeee'])
+        self.assertEqual([False, True, True],
+                         [o in cache for o in (12, 40, 50)])
+
+    def test_set_max_size(self):
+        cache = DeltaBaseCache(10)
+        cache.add(12, Blob.type_num, [b'aaaa'], root=True)
+        cache.add(20, Blob.type_num, [b'bbbb'])
+        cache.set_max_size(5)
+        self.assertEqual([True, False], [o in cache for o in (12, 20)])
+        cache.clear()
+        self.assertEqual(0, cache.stats()['size'])
+
+
 class WritePackTests(TestCase):
 
     def test_write_pack_header(self):
@@ -521,6 +1061,121 @@ class WritePackTests(TestCase):
         sha_b.update(f.getvalue()[offset:])
         self.assertEqual(sha_a.digest(), sha_b.digest())
 
+    def test_write_pack_object_compression_level(self):
+        f = BytesIO()
+        write_pack_object(f, Blob.type_num, b'blob' * 100,
+                          compression_level=0)
+        self.assertTrue(len(f.getvalue()) > 400)
+        f.write(b'x')  # unpack_object needs extra trailing data.
+        f.seek(0)
+        unpacked, _ = unpack_object(f.read)
+        self.assertEqual(b'blob' * 100, b''.join(unpacked.decomp_chunks))
+
+    def write_pack_data(self, records, **kwargs):
+        f = BytesIO()
+        entries, sha = write_pack_data(f, len(records), records, **kwargs)
+        data = f.getvalue()
+        self.assertEqual(sha, data[-20:])
+        return entries, data
+
+    def test_write_pack_data_threads(self):
+        contents = [('blob %d' % i).encode('ascii') + b'x' * i
+                    for i in range(50)]
+        blobs = [make_object(Blob, data=c) for c in contents]
+        records = [(b.type_num, b.sha().digest(), None, b.as_raw_string())
+                   for b in blobs]
+        delta = create_delta(blobs[0].as_raw_string(), b'delta')
+        records.append((Blob.type_num, sha1(b'delta').digest(),
+                        blobs[0].sha().digest(), delta))
+        expected = self.write_pack_data(records)
+        self.assertEqual(expected,
+                         self.write_pack_data(records, threads=1))
+        self.assertEqual(expected,
+                         self.write_pack_data(records, threads=3))
+        entries, data = expected
+        with PackData.from_file(BytesIO(data), len(data)) as pack_data:
+            self.assertEqual(
+                contents,
+                [b''.join(obj) for _, type_num, obj, _
+                 in pack_data.iterobjects() if type_num == Blob.type_num])
+
+    def test_write_pack_data_unknown_length(self):
+        blobs = [make_object(Blob, data=('blob %d' % i).encode('ascii'))
+                 for i in range(10)]
+        records = [(b.type_num, b.sha().digest(), None, b.as_raw_string())
+                   for b in blobs]
+        delta = create_delta(blobs[0].as_raw_string(), b'delta')
+        records.append((Blob.type_num, sha1(b'delta').digest(),
+                        blobs[0].sha().digest(), delta))
+        expected = self.write_pack_data(records)
+
+        f = BytesIO()
+        entries, sha = write_pack_data(f, None, iter(records), seekable=True)
+        self.assertEqual(expected, (entries, f.getvalue()))
+        self.assertEqual(sha, f.getvalue()[-20:])
+
+        # A small spool spills to disk.
+        for spool_size in (10, 1 << 20):
+            f = BytesIO()
+            entries, sha = write_pack_data(f, None, iter(records),
+                                           spool_size=spool_size)
+            self.assertEqual(expected, (entries, f.getvalue()))
+
+    def test_write_pack_data_unknown_length_duplicates(self):
+        blob = make_object(Blob, data=b'blob')
+        record = (blob.type_num, blob.sha().digest(), None,
+                  blob.as_raw_string())
+        for seekable in (True, False):
+            f = BytesIO()
+            write_pack_data(f, None, iter([record, record]),
+                            seekable=seekable)
+            data = f.getvalue()
+            with PackData.from_file(BytesIO(data), len(data)) as pack_data:
+                self.assertEqual(2, len(pack_data))
+                pack_data.check()
+                self.assertEqual(2, len(list(pack_data.iterobjects())))
+
+    def test_write_pack_objects_iterator(self):
+        blobs = [make_object(Blob, data=('blob %d' % i).encode('ascii'))
+                 for i in range(10)]
+        f = BytesIO()
+        entries, sha = write_pack_objects(f, ((b, None) for b in blobs))
+        data = f.getvalue()
+        self.assertEqual(sha, data[-20:])
+        with PackData.from_file(BytesIO(data), len(data)) as pack_data:
+            self.assertEqual(len(blobs), len(pack_data))
+            self.assertEqual(sorted(b.sha().digest() for b in blobs),
+                             sorted(entries))
+
+    def test_write_pack_data_ofs_delta(self):
+        base = make_object(Blob, data=b'base' * 10)
+        delta = create_delta(base.as_raw_string(), b'delta')
+        records = [
+            (Blob.type_num, base.sha().digest(), None, base.as_raw_string()),
+            (Blob.type_num, sha1(b'delta').digest(), base.sha().digest(),
+             delta),
+            ]
+        for ofs_delta, delta_type in [(True, OFS_DELTA), (False, REF_DELTA)]:
+            entries, data = self.write_pack_data(records, ofs_delta=ofs_delta)
+            with PackData.from_file(BytesIO(data), len(data)) as pack_data:
+                self.assertEqual(
+                    [Blob.type_num, delta_type],
+                    [unpacked.pack_type_num
+                     for unpacked in pack_data._iter_unpacked()])
+
+    def test_write_pack_data_compression_level(self):
+        records = [(Blob.type_num, b'\x01' * 20, None, b'x' * 1000)]
+        _, data0 = self.write_pack_data(records, compression_level=0)
+        _, data9 = self.write_pack_data(records, compression_level=9,
+                                        threads=2)
+        self.assertTrue(len(data0) > len(data9))
+        for data in (data0, data9):
+            with PackData.from_file(BytesIO(data), len(data)) as pack_data:
+                self.assertEqual(
+                    [b'x' * 1000],
+                    [b''.join(obj) for _, _, obj, _
+                     in pack_data.iterobjects()])
+
 
 pack_checksum = hex_to_sha('721980e866af9a5f93ad674144e1459b8ba3e7b7')
 
@@ -565,6 +1220,24 @@ class BaseTestPackIndexWriting(object):
             else:
                 self.assertTrue(actual_crc is None)
 
+    def test_object_indexes(self):
+        # Lots of objects in the first fan-out group, and a few in others.
+        shas = sorted([b'\x00' + sha1(('%d' % i).encode('ascii')).digest()[1:]
+                       for i in range(300)] +
+                      [sha1(('%d' % i).encode('ascii')).digest()
+                       for i in range(10)])
+        entries = [(sha, i * 10, i) for (i, sha) in enumerate(shas)]
+        idx = self.index('many.idx', entries, pack_checksum)
+        missing = b'\x00' * 20
+        self.assertEqual({shas[5]: 50}, idx.object_indexes([shas[5], missing]))
+        self.assertEqual(
+            {shas[3]: 30, sha_to_hex(shas[200]): 2000},
+            idx.object_indexes([sha_to_hex(shas[200]), missing, shas[3]]))
+        self.assertEqual(dict((sha, i * 10) for (i, sha) in enumerate(shas)),
+                         idx.object_indexes(shas + [missing]))
+        self.assertEqual(set(shas[-5:]),
+                         idx.contains_many(shas[-5:] + [missing]))
+
     def test_single(self):
         entry_sha = hex_to_sha('6f670c0fb53f9463760b7295fbb814e965fb20c8')
         my_entries = [(entry_sha, 178, 42)]
@@ -731,6 +1404,10 @@ class ReadZlibTests(TestCase):
         self.assertEqual(self.comp, b''.join(self.unpacked.comp_chunks))
 
 
+def _deltify_in_daemon(objects, queue):
+    queue.put(list(deltify_pack_objects(objects, threads=2)))
+
+
 class DeltifyTests(TestCase):
 
     def test_empty(self):
@@ -752,6 +1429,116 @@ class DeltifyTests(TestCase):
             ],
             list(deltify_pack_objects([(b1, b""), (b2, b"")])))
 
+    def test_threads(self):
+        objects = []
+        for path in (b'a', b'b', b'c', b'd'):
+            for i in range(5):
+                blob = Blob.from_string(path * 100 + str(i).encode('ascii'))
+                objects.append((blob, path))
+        serial = list(deltify_pack_objects(objects))
+        parallel = list(deltify_pack_objects(
+            objects, threads=4, deterministic=True))
+        self.assertEqual(parallel, list(deltify_pack_objects(
+            objects, threads=4, deterministic=True)))
+        self.assertEqual(sorted(serial), sorted(parallel))
+        unordered = list(deltify_pack_objects(objects, threads=4))
+        self.assertEqual(sorted(serial), sorted(unordered))
+
+    def test_threads_daemon(self):
+        # Daemonic processes can't have children, so the search is serial.
+        if sys.platform == 'win32':
+            self.skipTest('worker processes are not forked on Windows')
+        objects = [(Blob.from_string(path * 100 + str(i).encode('ascii')),
+                    path)
+                   for path in (b'a', b'b') for i in range(3)]
+        context = getattr(multiprocessing, 'get_context', None)
+        context = multiprocessing if context is None else context('fork')
+        queue = context.Queue()
+        process = context.Process(target=_deltify_in_daemon,
+                                  args=(objects, queue))
+        process.daemon = True
+        process.start()
+        results = queue.get()
+        process.join()
+        self.assertEqual(list(deltify_pack_objects(objects)), results)
+
+    def test_bases(self):
+        b1 = Blob.from_string(b"a" * 101)
+        b2 = Blob.from_string(b"a" * 100)
+        b3 = Blob.from_string(b"b" * 100)
+        delta = create_delta(b1.as_raw_string(), b2.as_raw_string())
+        self.assertEqual([
+            (b2.type_num, b2.sha().digest(), b1.sha().digest(), delta),
+            (b3.type_num, b3.sha().digest(), None, b3.as_raw_string()),
+            ],
+            list(deltify_pack_objects([(b2, b"x"), (b3, b"y")],
+                                      bases=[(b1, b"x")])))
+
+    def delta_depths(self, results):
+        depths = {}
+        for type_num, sha, delta_base, content in results:
+            if delta_base is None:
+                depths[sha] = 0
+            else:
+                depths[sha] = depths[delta_base] + 1
+        return depths
+
+    def test_max_depth(self):
+        objects = [(Blob.from_string(b'a' * 100 + b'b' * i), b'a')
+                   for i in range(10)]
+        depths = self.delta_depths(deltify_pack_objects(objects))
+        self.assertEqual(9, max(depths.values()))
+        depths = self.delta_depths(deltify_pack_objects(objects, max_depth=2))
+        self.assertEqual(2, max(depths.values()))
+        depths = self.delta_depths(deltify_pack_objects(objects, max_depth=0))
+        self.assertEqual(set([0]), set(depths.values()))
+
+
+        magic = [(3, path, -1, i) for i, path in
+                 enumerate([b'a', b'a', b'a', b'b', b'c', b'c'])]
+        self.assertEqual(
+            [[m[3] for m in segment] for segment in _split_magic(magic, 3)],
+            [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual(
+            [[m[3] for m in segment] for segment in _split_magic(magic, 10)],
+            [[0, 1, 2], [3], [4, 5]])
+        self.assertEqual([], list(_split_magic([], 4)))
+
+
+class OrderPackObjectsTests(TestCase):
+
+    def test_order(self):
+        types = {b'c1': Commit.type_num, b'c2': Commit.type_num,
+                 b't1': Tree.type_num, b't2': Tree.type_num,
+                 b'b1': Blob.type_num, b'b2': Blob.type_num,
+                 b'b3': Blob.type_num, b'g1': Tag.type_num}
+        objects = [(b'c2', None), (b't2', b''), (b'b3', b'y'),
+                   (b'b2', b'x'), (b'g1', None), (b'c1', None),
+                   (b't1', b''), (b'b1', b'y')]
+        self.assertEqual(
+            [(b'c2', None), (b'c1', None), (b'g1', None), (b't2', b''),
+             (b't1', b''), (b'b3', b'y'), (b'b1', b'y'), (b'b2', b'x')],
+            order_pack_objects(objects, types.__getitem__))
+
+    def test_write_pack_objects_deltify(self):
+        blobs = [make_object(Blob, data=b'blob contents' * 10 + c)
+                 for c in (b'1', b'22', b'333')]
+        tree = Tree()
+        tree.add(b'a', 0o100644, blobs[0].id)
+        commit = make_commit(tree=tree.id)
+        objects = [(blobs[0], b'a'), (tree, b''), (blobs[1], b'a'),
+                   (commit, None), (blobs[2], b'a')]
+        f = BytesIO()
+        write_pack_objects(f, objects, deltify=True)
+        data = f.getvalue()
+        with PackData.from_file(BytesIO(data), len(data)) as pack_data:
+            unpacked = list(pack_data._iter_unpacked())
+        # Delta bases come before their deltas, so all deltas are OFS_DELTA.
+        self.assertEqual(
+            [Commit.type_num, Tree.type_num, Blob.type_num, OFS_DELTA,
+             OFS_DELTA],
+            [u.pack_type_num for u in unpacked])
+
 
 class TestPackStreamReader(TestCase):
 
@@ -824,8 +1611,15 @@ class TestPackIterator(DeltaChainIterator):
           offset, pack_type_num, base_chunks)
 
 
+class ResolvingPackIterator(TestPackIterator):
+
+    _resolve_while_recording = True
+
+
 class DeltaChainIteratorTests(TestCase):
 
+    iterator_class = TestPackIterator
+
     def setUp(self):
         super(DeltaChainIteratorTests, self).setUp()
         self.store = MemoryObjectStore()
@@ -852,7 +1646,7 @@ class DeltaChainIteratorTests(TestCase):
             thin = bool(list(self.store))
         resolve_ext_ref = thin and self.get_raw_no_repeat or None
         data = PackData('test.pack', file=f)
-        return TestPackIterator.for_pack_data(
+        return self.iterator_class.for_pack_data(
           data, resolve_ext_ref=resolve_ext_ref)
 
     def assertEntriesMatch(self, expected_indexes, entries, pack_iter):
@@ -1035,6 +1829,87 @@ class DeltaChainIteratorTests(TestCase):
             self.assertEqual((sorted([b2.id, b3.id]),), (sorted(e.args[0]),))
 
 
+class ThreadedDeltaChainIteratorTests(DeltaChainIteratorTests):
+
+    def make_pack_iter(self, f, thin=None):
+        if thin is None:
+            thin = bool(list(self.store))
+        resolve_ext_ref = thin and self.get_raw_no_repeat or None
+        fd, path = tempfile.mkstemp(suffix='.pack')
+        self.addCleanup(os.remove, path)
+        pack_file = os.fdopen(fd, 'w+b')
+        self.addCleanup(pack_file.close)
+        pack_file.write(f.getvalue())
+        pack_file.seek(0)
+        data = PackData(path, file=pack_file)
+        pack_iter = self.iterator_class.for_pack_data(
+          data, resolve_ext_ref=resolve_ext_ref, threads=3)
+        mapped = pack_iter._map_file()
+        self.assertNotEqual(None, mapped)
+        mapped.close()
+        return pack_iter
+
+    def assertEntriesMatch(self, expected_indexes, entries, pack_iter):
+        expected = [entries[i] for i in expected_indexes]
+        self.assertEqual(sorted(expected),
+                         sorted(pack_iter._walk_all_chains()))
+
+
+class ResolveWhileRecordingTests(DeltaChainIteratorTests):
+
+    iterator_class = ResolvingPackIterator
+
+    def assertEntriesMatch(self, expected_indexes, entries, pack_iter):
+        expected = [entries[i] for i in expected_indexes]
+        self.assertEqual(sorted(expected),
+                         sorted(pack_iter._walk_all_chains()))
+
+    def make_recorded_pack_iter(self, f, cache_size=None):
+        data = PackData('test.pack', file=f)
+        pack_iter = self.iterator_class(None)
+        pack_iter._recent.set_max_size(cache_size)
+        pack_iter.set_pack_data(data)
+        for unpacked in data._iter_unpacked(compute_crc32=True):
+            pack_iter.record(unpacked)
+        return pack_iter
+
+    def test_resolved_while_recording(self):
+        f = BytesIO()
+        entries = build_pack(f, [
+            (Blob.type_num, b'blob'),
+            (OFS_DELTA, (0, b'blob1')),
+            (REF_DELTA, (1, b'blob12')),
+        ])
+        pack_iter = self.make_recorded_pack_iter(f)
+        # Everything was resolved from memory.
+        self.assertEqual(set(), pack_iter._unpacked_offsets)
+        self.assertEntriesMatch([0, 1, 2], entries, pack_iter)
+        self.assertEqual(set(), pack_iter._unpacked_offsets)
+
+    def test_evicted_bases(self):
+        f = BytesIO()
+        entries = build_pack(f, [
+            (REF_DELTA, (2, b'blob12')),
+            (Blob.type_num, b'blob'),
+            (OFS_DELTA, (1, b'blob1')),
+            (OFS_DELTA, (1, b'blob2')),
+        ])
+        pack_iter = self.make_recorded_pack_iter(f)
+        pack_iter._recent.clear()
+        self.assertEntriesMatch([0, 1, 2, 3], entries, pack_iter)
+        self.assertEqual(set([entries[0][0]]), pack_iter._unpacked_offsets)
+
+    def test_no_cache(self):
+        f = BytesIO()
+        entries = build_pack(f, [
+            (Blob.type_num, b'blob'),
+            (OFS_DELTA, (0, b'blob1')),
+            (OFS_DELTA, (1, b'blob12')),
+        ])
+        pack_iter = self.make_recorded_pack_iter(f, cache_size=0)
+        self.assertEntriesMatch([0, 1, 2], entries, pack_iter)
+
+
 class DeltaEncodeSizeTests(TestCase):
 
     def test_basic(self):
@@ -85,6 +85,70 @@ class UpdateServerInfoTests(PorcelainTestCase):
             'info', 'refs')))
 
 
+class MultiPackIndexWriteTests(PorcelainTestCase):
+
+    def test_simple(self):
+        self.repo.object_store.add_objects(
+            [(make_object(Blob, data=b"yummy data"), None)])
+        porcelain.multi_pack_index_write(self.repo.path)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.repo.object_store.pack_dir, 'multi-pack-index')))
+
+
+class RepackTests(PorcelainTestCase):
+
+    def test_simple(self):
+        c1, c2, c3 = build_commit_graph(self.repo.object_store, [[1], [2, 1],
+            [3, 1, 2]])
+        self.repo.refs[b"refs/heads/foo"] = c3.id
+        pack = porcelain.repack(self.repo.path)
+        self.assertEqual(4, len(pack))
+        self.assertEqual(None, porcelain.repack(self.repo.path))
+
+    def test_write_bitmaps(self):
+        c1, c2, c3 = build_commit_graph(self.repo.object_store, [[1], [2, 1],
+            [3, 1, 2]])
+        self.repo.refs[b"refs/heads/foo"] = c3.id
+        self.repo.refs[b"refs/heads/bar"] = c2.id
+        porcelain.repack(self.repo.path, write_bitmaps=True)
+        [pack] = self.repo.object_store.packs
+        self.assertEqual(set([c2.sha().digest(), c3.sha().digest()]),
+                         set(pack.bitmap))
+
+
+class GcTests(PorcelainTestCase):
+
+    def test_prune(self):
+        c1, c2, c3 = build_commit_graph(self.repo.object_store, [[1], [2, 1],
+            [3, 1, 2]])
+        self.repo.refs[b"refs/heads/foo"] = c2.id
+        pack = porcelain.gc(self.repo.path, grace_period=0)
+        self.assertEqual(3, len(pack))
+        self.assertNotIn(c3.id, self.repo.object_store)
+        self.assertEqual([], list(
+            self.repo.object_store._iter_loose_objects()))
+
+    def test_grace_period(self):
+        c1, c2, c3 = build_commit_graph(self.repo.object_store, [[1], [2, 1],
+            [3, 1, 2]])
+        self.repo.refs[b"refs/heads/foo"] = c2.id
+        pack = porcelain.gc(self.repo.path)
+        self.assertEqual(3, len(pack))
+        self.assertEqual(c3, self.repo[c3.id])
+
+    def test_shallow(self):
+        blob1 = make_object(Blob, data=b'a')
+        blob2 = make_object(Blob, data=b'b')
+        c1, c2 = build_commit_graph(self.repo.object_store, [[1], [2, 1]],
+            trees={1: [(b'a', blob1)], 2: [(b'a', blob2)]})
+        os.remove(self.repo.object_store._get_shafile_path(c1.id))
+        self.repo._put_named_file('shallow', c2.id + b'\n')
+        self.repo.refs[b"refs/heads/master"] = c2.id
+        pack = porcelain.gc(self.repo.path, grace_period=0)
+        self.assertEqual(3, len(pack))
+        self.assertEqual(c2, self.repo[c2.id])
+
+
 class CommitTests(PorcelainTestCase):
 
     def test_custom_author(self):
@@ -183,6 +183,12 @@ class UploadPackHandlerTestCase(TestCase):
         self._handler.progress(b'second message')
         self.assertRaises(IndexError, self._handler.proto.get_received_line, 2)
 
+    def test_ofs_delta_optional(self):
+        caps = self._handler.required_capabilities()
+        self.assertFalse(b'ofs-delta' in caps)
+        self._handler.set_client_capabilities(caps)
+        self.assertFalse(self._handler.has_capability(b'ofs-delta'))
+
     def test_get_tagged(self):
         refs = {
             b'refs/tags/tag1': ONE,
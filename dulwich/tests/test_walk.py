@@ -22,6 +22,10 @@ from itertools import (
     permutations,
     )
 
+from dulwich.bloom import (
+    BloomFilter,
+    commit_changed_paths,
+    )
 from dulwich.diff_tree import (
     CHANGE_MODIFY,
     CHANGE_RENAME,
@@ -70,6 +74,17 @@ class TestWalkEntry(object):
         return self.changes == other.changes()
 
 
+class BloomFilterObjectStore(MemoryObjectStore):
+    """Object store with changed-path Bloom filters for some commits."""
+
+    def __init__(self):
+        super(BloomFilterObjectStore, self).__init__()
+        self.bloom_filters = {}
+
+    def get_bloom_filter(self, sha):
+        return self.bloom_filters.get(sha)
+
+
 class WalkerTest(TestCase):
 
     def setUp(self):
@@ -246,6 +261,30 @@ class WalkerTest(TestCase):
         self.assertWalkYields([c2], [c2.id], paths=[b'b'], max_entries=1)
         self.assertWalkYields([c1], [c1.id], paths=[b'a'], max_entries=1)
 
+    def test_paths_bloom_filters(self):
+        self.store = BloomFilterObjectStore()
+        blob_a1 = make_object(Blob, data=b'a1')
+        blob_b2 = make_object(Blob, data=b'b2')
+        blob_a3 = make_object(Blob, data=b'a3')
+        c1, c2, c3 = self.make_linear_commits(
+            3, trees={1: [(b'a', blob_a1)],
+                      2: [(b'a', blob_a1), (b'x/b', blob_b2)],
+                      3: [(b'a', blob_a3), (b'x/b', blob_b2)]})
+        for c in (c1, c2, c3):
+            self.store.bloom_filters[c.id] = BloomFilter.from_paths(
+                commit_changed_paths(self.store, c))
+        self.assertWalkYields([c3, c1], [c3.id], paths=[b'a'])
+        self.assertWalkYields([c2], [c3.id], paths=[b'x/b'])
+        self.assertWalkYields([c2], [c3.id], paths=[b'x'])
+        self.assertWalkYields([], [c3.id], paths=[b'y'])
+
+        # Commits are skipped if their filter rules out changes
+        self.store.bloom_filters[c3.id] = BloomFilter.from_paths(set())
+        self.assertWalkYields([c1], [c3.id], paths=[b'a'])
+        # ... unless parents are looked up in a different way
+        self.assertWalkYields([c3, c1], [c3.id], paths=[b'a'],
+                              get_parents=lambda commit: commit.parents)
+
     def test_paths_merge(self):
         blob_a1 = make_object(Blob, data=b'a1')
         blob_a2 = make_object(Blob, data=b'a2')
@@ -25,6 +25,9 @@ import collections
 import heapq
 from itertools import chain
 
+from dulwich.bloom import (
+    bloom_key,
+    )
 from dulwich.diff_tree import (
     RENAME_CHANGE_TYPES,
     tree_changes,
@@ -89,14 +92,14 @@ class _CommitTimeQueue(object):
     def __init__(self, walker):
         self._walker = walker
         self._store = walker.store
-        self._get_parents = walker.get_parents
+        self._get_parents = walker._get_parent_ids
         self._excluded = walker.excluded
         self._pq = []
         self._pq_set = set()
         self._seen = set()
         self._done = set()
         self._min_time = walker.since
-        self._last = None
+        self._last_time = None
         self._extra_commits_left = _MAX_EXTRA_COMMITS
         self._is_finished = False
 
@@ -104,52 +107,49 @@ class _CommitTimeQueue(object):
             self._push(commit_id)
 
     def _push(self, commit_id):
-        try:
-            commit = self._store[commit_id]
-        except KeyError:
-            raise MissingCommitError(commit_id)
         if commit_id not in self._pq_set and commit_id not in self._done:
-            heapq.heappush(self._pq, (-commit.commit_time, commit))
+            try:
+                commit_time = self._store.get_commit_time(commit_id)
+            except KeyError:
+                raise MissingCommitError(commit_id)
+            heapq.heappush(self._pq, (-commit_time, commit_id))
             self._pq_set.add(commit_id)
             self._seen.add(commit_id)
 
-    def _exclude_parents(self, commit):
+    def _exclude_parents(self, commit_id):
         excluded = self._excluded
         seen = self._seen
-        todo = [commit]
+        todo = [commit_id]
         while todo:
-            commit = todo.pop()
-            for parent in self._get_parents(commit):
+            commit_id = todo.pop()
+            for parent in self._get_parents(commit_id):
                 if parent not in excluded and parent in seen:
-                    # TODO: This is inefficient unless the object store does
-                    # some caching (which DiskObjectStore currently does not).
-                    # We could either add caching in this class or pass around
-                    # parsed queue entry objects instead of commits.
-                    todo.append(self._store[parent])
+                    todo.append(parent)
                 excluded.add(parent)
 
     def next(self):
         if self._is_finished:
             return None
         while self._pq:
-            _, commit = heapq.heappop(self._pq)
-            sha = commit.id
+            neg_time, sha = heapq.heappop(self._pq)
+            commit_time = -neg_time
             self._pq_set.remove(sha)
             if sha in self._done:
                 continue
             self._done.add(sha)
 
-            for parent_id in self._get_parents(commit):
+            for parent_id in self._get_parents(sha):
                 self._push(parent_id)
 
             reset_extra_commits = True
             is_excluded = sha in self._excluded
             if is_excluded:
-                self._exclude_parents(commit)
-                if self._pq and all(c.id in self._excluded
+                self._exclude_parents(sha)
+                if self._pq and all(c in self._excluded
                                     for _, c in self._pq):
-                    _, n = self._pq[0]
-                    if self._last and n.commit_time >= self._last.commit_time:
+                    n_time = -self._pq[0][0]
+                    if (self._last_time is not None and
+                            n_time >= self._last_time):
                         # If the next commit is newer than the last one, we need
                         # to keep walking in case its parents (which we may not
                         # have seen yet) are excluded. This gives the excluded
@@ -160,7 +160,7 @@ class _CommitTimeQueue(object):
                         reset_extra_commits = False
 
             if (self._min_time is not None and
-                commit.commit_time < self._min_time):
+                commit_time < self._min_time):
                 # We want to stop walking at min_time, but commits at the
                 # boundary may be out of order with respect to their parents. So
                 # we walk _MAX_EXTRA_COMMITS more commits once we hit this
@@ -176,8 +176,8 @@ class _CommitTimeQueue(object):
                     break
 
             if not is_excluded:
-                self._last = commit
-                return WalkEntry(self._walker, commit)
+                self._last_time = commit_time
+                return WalkEntry(self._walker, self._store[sha])
         self._is_finished = True
         return None
 
@@ -194,8 +194,7 @@ class Walker(object):
     def __init__(self, store, include, exclude=None, order=ORDER_DATE,
                  reverse=False, max_entries=None, paths=None,
                  rename_detector=None, follow=False, since=None, until=None,
-                 get_parents=lambda commit: commit.parents,
-                 queue_cls=_CommitTimeQueue):
+                 get_parents=None, queue_cls=_CommitTimeQueue):
         """Constructor.
 
         :param store: ObjectStore instance for looking up objects.
@@ -216,7 +215,9 @@ class Walker(object):
             default rename_detector.
         :param since: Timestamp to list commits after.
         :param until: Timestamp to list commits before.
-        :param get_parents: Method to retrieve the parents of a commit
+        :param get_parents: Method to retrieve the parents of a commit. By
+            default the parents are looked up with the get_parents method of
+            the store, which can avoid parsing commits.
         :param queue_cls: A class to use for a queue of commits, supporting the
             iterator protocol. The constructor takes a single argument, the
             Walker.
@@ -237,7 +238,18 @@ class Walker(object):
         if follow and not rename_detector:
             rename_detector = RenameDetector(store)
         self.rename_detector = rename_detector
-        self.get_parents = get_parents
+        if get_parents is None:
+            self.get_parents = lambda commit: commit.parents
+            self._get_parent_ids = lambda sha: store.get_parents(sha)
+        else:
+            self.get_parents = get_parents
+            self._get_parent_ids = lambda sha: get_parents(store[sha])
+        # Changed-path Bloom filters are computed against the first real
+        # parent, and don't know about copies from unchanged files.
+        self._use_bloom_filters = (
+            get_parents is None and
+            not getattr(rename_detector, '_find_copies_harder', False))
+        self._bloom_keys = {}
         self.follow = follow
         self.since = since
         self.until = until
@@ -272,6 +284,28 @@ class Walker(object):
             return True
         return False
 
+    def _paths_unchanged(self, commit):
+        """Check whether the Bloom filter of a commit rules out changes.
+
+        :param commit: The commit to check
+        :return: True if the commit definitely doesn't change any of the
+            requested paths, False if it may
+        """
+        if not self._use_bloom_filters or len(commit.parents) > 1:
+            return False
+        bloom_filter = self.store.get_bloom_filter(commit.id)
+        if bloom_filter is None:
+            return False
+        for path in self.paths:
+            cache_key = (path, bloom_filter.num_hashes)
+            key = self._bloom_keys.get(cache_key)
+            if key is None:
+                key = bloom_key(path, bloom_filter.num_hashes)
+                self._bloom_keys[cache_key] = key
+            if bloom_filter.contains_key(key):
+                return False
+        return True
+
     def _should_return(self, entry):
         """Determine if a walk entry should be returned..
 
@@ -290,6 +324,9 @@ class Walker(object):
         if self.paths is None:
             return True
 
+        if self._paths_unchanged(commit):
+            return None
+
         if len(self.get_parents(commit)) > 1:
             for path_changes in entry.changes():
                 # For merge commits, only include changes with conflicts for